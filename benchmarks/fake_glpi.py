@@ -0,0 +1,541 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Local stand-in for the GLPI REST API, serving a synthetic dataset.
+
+Implements the methods used by the collection and the inventory script
+(``initSession``, ``killSession``, ``getGlpiConfig``, ``changeActiveEntities``,
+``changeActiveProfile``, ``listSearchOptions``, ``search``, ``getMultipleItems``
+and getting, adding, updating and deleting items) on generated computers and
+network equipments, with a configurable latency and a configurable rate of
+requests failing with a 503 error (answered as ``error`` method). Calls by
+method and transferred bytes are counted (see ``FakeGLPI.stats``). It can be
+used from the benchmarks or run standalone::
+
+    $ python benchmarks/fake_glpi.py --hosts 10000 --latency 20 --port 8080
+"""
+
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qsl
+
+# Search options (uid by field id) of the item types. Rows of the dataset are
+# indexed by field id, like search results.
+SEARCH_OPTIONS = {
+    'Computer': {
+        '1': 'Computer.name',
+        '2': 'Computer.id',
+        '4': 'Computer.ComputerType.name',
+        '19': 'Computer.date_mod',
+        '23': 'Computer.Manufacturer.name',
+        '31': 'Computer.State.completename',
+        '33': 'Computer.Domain.name',
+        '45': 'Computer.Item_OperatingSystem.OperatingSystem.name',
+        '46': 'Computer.Item_OperatingSystem.OperatingSystemVersion.name',
+        '80': 'Computer.Entity.completename',
+        '160': 'Computer.ComputerVirtualMachine.name',
+        '161': 'Computer.ComputerVirtualMachine.VirtualMachineState.name',
+        '163': 'Computer.ComputerVirtualMachine.VirtualMachineType.name',
+    },
+    'NetworkEquipment': {
+        '1': 'NetworkEquipment.name',
+        '2': 'NetworkEquipment.id',
+        '19': 'NetworkEquipment.date_mod',
+        '31': 'NetworkEquipment.State.completename',
+        '80': 'NetworkEquipment.Entity.completename',
+    },
+}
+
+# Fields of the tables joined with several rows by item, by item type. Values
+# of theses fields are lists (one element by joined row) and, like in the SQL
+# request of GLPI, criteria on them are evaluated on each joined row and only
+# the matching rows are returned.
+JOINED_TABLES = {
+    'Computer': [('160', '161', '163')],
+}
+
+# Join parameters of the raw search options (other options have none).
+RAW_SEARCH_OPTIONS = {
+    'Computer': {
+        '45': {'joinparams': {'beforejoin': {'table': 'glpi_items_operatingsystems',
+                                             'joinparams': {'jointype': 'itemtype_item'}}}},
+        '46': {'joinparams': {'beforejoin': {'table': 'glpi_items_operatingsystems',
+                                             'joinparams': {'jointype': 'itemtype_item'}}}},
+        '160': {'forcegroupby': True, 'joinparams': {'jointype': 'child'}},
+        '161': {'forcegroupby': True,
+                'joinparams': {'beforejoin': {'table': 'glpi_computervirtualmachines',
+                                              'joinparams': {'jointype': 'child'}}}},
+        '163': {'forcegroupby': True,
+                'joinparams': {'beforejoin': {'table': 'glpi_computervirtualmachines',
+                                              'joinparams': {'jointype': 'child'}}}},
+    },
+}
+
+# Fields returned by searches in addition of the fields of the criteria and
+# of 'forcedisplay'.
+DEFAULT_FIELDS = ['1', '80']
+
+# Item attributes (as used by add, update and get methods) stored in fields.
+ATTRIBUTES = {'id': '2', 'name': '1', 'date_mod': '19'}
+
+# Number of search results kept for serving the next pages of a search.
+RESULTS_CACHE_SIZE = 64
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+OPERATING_SYSTEMS = [
+    ('Ubuntu', '18.04'), ('Ubuntu', '16.04'), ('Ubuntu', '14.04'),
+    ('CentOS', '7'), ('CentOS', '6'), ('Debian', '10'),
+    ('Windows', '2016'), ('Windows', '2012'), ('FreeBSD', '10.4'),
+]
+
+def generate_dataset(nb_hosts, seed=0):
+    '''
+    Helper function that generate ``nb_hosts`` computers (one in ten being a
+    KVM hypervisor and one in twenty a Docker host) and ``nb_hosts / 10``
+    network equipments. One in thirty computers runs both KVM and Docker
+    virtual machines and, on one in forty, the first virtual machine is
+    stopped. Return items by item type and by id.
+    '''
+    rnd = random.Random(seed)
+    date_mod = time.strftime(DATE_FORMAT, time.gmtime(1577836800))
+    computers = OrderedDict()
+    for idx in range(1, nb_hosts + 1):
+        os_name, os_version = rnd.choice(OPERATING_SYSTEMS)
+        computer = {
+            '1': 'host{:06d}'.format(idx),
+            '2': idx,
+            '4': rnd.choice(['Rack Mount Chassis', 'Blade', 'Virtual Machine']),
+            '19': date_mod,
+            '23': rnd.choice(['Dell Inc.', 'HP', 'Lenovo', None]),
+            '31': rnd.choice(['Running', 'Running', 'Running', 'Stopped']),
+            '33': rnd.choice(['exemple.org', 'lab.exemple.org']),
+            '45': os_name,
+            '46': os_version,
+            '80': 'Root entity',
+            '160': None,
+            '161': None,
+            '163': None,
+        }
+        if idx % 10 == 0 or idx % 20 == 5:
+            nb_vms = rnd.randint(1, 5)
+            computer['160'] = ['{:s}-vm{:d}'.format(computer['1'], vm) for vm in range(nb_vms)]
+            computer['161'] = ['running'] * nb_vms
+            computer['163'] = ['libvirt' if idx % 10 == 0 else 'docker'] * nb_vms
+            if idx % 30 == 0:
+                computer['160'].append('{:s}-ct0'.format(computer['1']))
+                computer['161'].append('running')
+                computer['163'].append('docker')
+            if idx % 40 == 0:
+                computer['161'][0] = 'stopped'
+        computers[idx] = computer
+
+    equipments = OrderedDict()
+    for idx in range(1, nb_hosts // 10 + 1):
+        equipments[idx] = {
+            '1': 'switch{:05d}'.format(idx),
+            '2': idx,
+            '19': date_mod,
+            '31': rnd.choice(['Running', 'Stopped']),
+            '80': 'Root entity',
+        }
+    return {'Computer': computers, 'NetworkEquipment': equipments}
+
+def unflatten(params):
+    '''
+    Helper function that convert query parameters like ``criteria[0][field]``
+    to nested lists and dictionaries.
+    '''
+    result = {}
+    for key, value in params:
+        keys = re.findall(r'^[^\[]+|(?<=\[)[^\]]*(?=\])', key)
+        node = result
+        for subkey in keys[:-1]:
+            node = node.setdefault(subkey, {})
+        node[keys[-1]] = value
+
+    def to_lists(node):
+        if not isinstance(node, dict):
+            return node
+        if node and all(key.isdigit() for key in node):
+            return [to_lists(node[key]) for key in sorted(node, key=int)]
+        return {key: to_lists(value) for key, value in node.items()}
+    return to_lists(result)
+
+def match_criterion(criterion, row):
+    '''Helper function that return whether ``row`` matches ``criterion``.'''
+    if 'criteria' in criterion:
+        return match_criteria(criterion['criteria'], row)
+    values = row.get(str(criterion.get('field')))
+    values = values if isinstance(values, list) else [values]
+    values = [str(value) for value in values if value is not None]
+    searchtype = criterion.get('searchtype', 'contains')
+    pattern = criterion.get('value', '')
+    if searchtype == 'contains':
+        return any(re.search(pattern, value, re.I) for value in values)
+    if searchtype == 'notcontains':
+        return not any(re.search(pattern, value, re.I) for value in values)
+    if searchtype == 'equals':
+        return pattern in values
+    if searchtype == 'notequals':
+        return pattern not in values
+    if searchtype == 'morethan':
+        return any(value > pattern for value in values)
+    if searchtype == 'lessthan':
+        return any(value < pattern for value in values)
+    raise ValueError('unsupported search type: {:s}'.format(searchtype))
+
+def match_criteria(criteria, row):
+    '''
+    Helper function that return whether ``row`` matches ``criteria`` (links
+    are evaluated from left to right). Metacriteria are evaluated on the
+    fields of the row.
+    '''
+    result = None
+    for criterion in criteria:
+        link = criterion.get('link', 'AND')
+        matched = match_criterion(criterion, row)
+        if link.endswith('NOT'):
+            matched = not matched
+        if result is None:
+            result = matched
+        elif link.startswith('OR'):
+            result = result or matched
+        else:
+            result = result and matched
+    return True if result is None else result
+
+def criteria_fields(criteria):
+    '''Helper function that return the fields used by ``criteria``.'''
+    fields = []
+    for criterion in criteria:
+        fields.extend(criteria_fields(criterion.get('criteria', [])))
+        if 'field' in criterion and not criterion.get('meta'):
+            fields.append(str(criterion['field']))
+    return fields
+
+
+def joined_rows(itemtype, item):
+    '''
+    Helper function that return the rows of the join of ``item`` with its
+    joined tables (one row by combination of the rows of each table, or the
+    item itself when no table has rows). Rows contain the index of the row of
+    each table (in ``#<table index>`` keys).
+    '''
+    rows = [item]
+    for table, fields in enumerate(JOINED_TABLES.get(itemtype, [])):
+        values = item.get(fields[0])
+        if not isinstance(values, list):
+            continue
+        rows = [dict(row, **dict([('#{:d}'.format(table), idx)]
+                                 + [(field, item[field][idx]) for field in fields]))
+                for row in rows
+                for idx in range(len(values))]
+    return rows
+
+def group_rows(itemtype, item, rows, fields):
+    '''
+    Helper function that return the search result of ``item`` with ``fields``
+    from its joined ``rows`` matching the criteria (the values of the fields
+    of joined tables being the values of the matching rows).
+    '''
+    result = {field: item.get(field) for field in fields}
+    for table, table_fields in enumerate(JOINED_TABLES.get(itemtype, [])):
+        key = '#{:d}'.format(table)
+        indexes = list(OrderedDict.fromkeys(row[key] for row in rows if key in row))
+        if not indexes:
+            continue
+        result.update((field, [item[field][idx] for idx in indexes])
+                      for field in table_fields if field in fields)
+    return result
+
+
+class FakeGLPI(object):
+    """Fake GLPI platform with ``nb_hosts`` computers, answering each request
+    after ``latency`` seconds. A ratio of ``error_rate`` requests (randomly
+    chosen) fail with a 503 error."""
+
+    def __init__(self, nb_hosts, latency=0.0, seed=0, error_rate=0.0):
+        self.items = generate_dataset(nb_hosts, seed)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.tokens = set()
+        self.lock = threading.Lock()
+        self.results = OrderedDict()
+        self.server = None
+        self.thread = None
+        self.reset_stats()
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve in a thread and return the URL of the API."""
+        self.server = ThreadingHTTPServer((host, port), FakeGLPIHandler)
+        self.server.daemon_threads = True
+        self.server.glpi = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return 'http://{:s}:{:d}/apirest.php'.format(host, self.server.server_address[1])
+
+    def stop(self):
+        """Stop serving."""
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def reset_stats(self):
+        """Reset counters."""
+        with self.lock:
+            self._stats = {'calls': {}, 'bytes_received': 0, 'bytes_sent': 0}
+
+    def stats(self):
+        """Return the number of calls by method and the number of bytes received
+        and sent (bodies and headers)."""
+        with self.lock:
+            stats = dict(self._stats, calls=dict(self._stats['calls']))
+        stats['api_calls'] = sum(stats['calls'].values())
+        return stats
+
+    def count(self, method, received, sent):
+        with self.lock:
+            self._stats['calls'][method] = self._stats['calls'].get(method, 0) + 1
+            self._stats['bytes_received'] += received
+            self._stats['bytes_sent'] += sent
+
+    def fail(self):
+        """Return whether the current request must fail."""
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def search(self, itemtype, params):
+        """Return the status and the body of a search."""
+        params = unflatten(params)
+        criteria = params.get('criteria', [])
+        fields = []
+        for field in (DEFAULT_FIELDS + criteria_fields(criteria)
+                      + params.get('forcedisplay', [])):
+            if field not in fields:
+                fields.append(field)
+
+        # Results are kept for the next pages (and invalidated by writes).
+        key = json.dumps([itemtype, criteria, fields, params.get('sort'), params.get('order')])
+        with self.lock:
+            rows = self.results.get(key)
+        if rows is None:
+            rows = []
+            for item in list(self.items.get(itemtype, {}).values()):
+                matching = [row for row in joined_rows(itemtype, item)
+                            if match_criteria(criteria, row)]
+                if matching:
+                    rows.append(group_rows(itemtype, item, matching, fields))
+            if params.get('sort'):
+                sort = str(params['sort'])
+                rows.sort(key=lambda row: str(row.get(sort) or ''),
+                          reverse=params.get('order', 'ASC').upper() == 'DESC')
+            with self.lock:
+                self.results[key] = rows
+                while len(self.results) > RESULTS_CACHE_SIZE:
+                    self.results.popitem(last=False)
+
+        start, end = (int(value) for value in params.get('range', '0-49').split('-'))
+        page = rows[start:end + 1]
+        body = {'totalcount': len(rows), 'count': len(page), 'data': page}
+        return (206 if len(page) < len(rows) else 200), body
+
+    def get_item(self, itemtype, item_id, expand=()):
+        """Return the attributes of an item (None if it does not exist) with its
+        related items of ``expand`` (names of `with_*` parameters). Only
+        network ports are generated (with an IP address by port), the others
+        related items are empty."""
+        item = self.items.get(itemtype, {}).get(int(item_id))
+        if item is None:
+            return None
+        attributes = dict(item.get('attributes', {}))
+        attributes.update((attr, item.get(field)) for attr, field in ATTRIBUTES.items())
+        for name in expand:
+            attributes['_' + name] = []
+            if name == 'networkports':
+                item_id = int(item_id)
+                attributes['_networkports'] = {'NetworkPortEthernet': [{
+                    'id': item_id * 2 + port,
+                    'name': 'eth{:d}'.format(port),
+                    'mac': '52:54:00:{:02x}:{:02x}:{:02x}'.format(
+                        item_id >> 16 & 255, item_id >> 8 & 255, item_id & 255),
+                    'NetworkName': {
+                        'id': item_id * 2 + port,
+                        'name': item.get('1'),
+                        'IPAddress': [{
+                            'id': item_id * 2 + port,
+                            'name': '10.{:d}.{:d}.{:d}'.format(
+                                port, item_id >> 8 & 255, item_id & 255),
+                            'IPNetwork': []
+                        }]
+                    }
+                } for port in range(2)]}
+        return attributes
+
+    def write(self, method, itemtype, items):
+        """Add, update or delete items and return the results by item."""
+        results = []
+        now = time.strftime(DATE_FORMAT, time.gmtime())
+        with self.lock:
+            self.results.clear()
+            dataset = self.items.setdefault(itemtype, OrderedDict())
+            for item in items:
+                if method == 'add':
+                    item_id = max(dataset) + 1 if dataset else 1
+                    dataset[item_id] = {'2': item_id, 'attributes': {}}
+                    results.append({'id': item_id, 'message': ''})
+                else:
+                    item_id = int(item['id'])
+                    found = item_id in dataset
+                    results.append({str(item_id): found,
+                                    'message': '' if found else 'Item not found'})
+                    if not found:
+                        continue
+                if method == 'delete':
+                    del dataset[item_id]
+                    continue
+                current = dataset[item_id]
+                for attr, value in item.items():
+                    if attr == 'id':
+                        continue
+                    if attr in ATTRIBUTES:
+                        current[ATTRIBUTES[attr]] = value
+                    else:
+                        current.setdefault('attributes', {})[attr] = value
+                current['19'] = now
+        return results
+
+
+class FakeGLPIHandler(BaseHTTPRequestHandler):
+    """Handler of the requests to the fake GLPI API."""
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def handle_request(self, http_method):
+        glpi = self.server.glpi
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        received = len(self.requestline) + len(str(self.headers)) + len(body)
+        time.sleep(glpi.latency)
+
+        url = urlparse(self.path)
+        path = [part for part in url.path.split('/') if part][1:]
+        params = parse_qsl(url.query, keep_blank_values=True)
+        if glpi.fail():
+            method, status, result = 'error', 503, ['ERROR', 'Service unavailable']
+        else:
+            method, status, result = self.dispatch(glpi, http_method, path, params, body)
+
+        data = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        sent = len(data) + sum(len(line) for line in self._headers_buffer)
+        self.end_headers()
+        self.wfile.write(data)
+        glpi.count(method, received, sent)
+
+    def dispatch(self, glpi, http_method, path, params, body):
+        """Return the called method, the status and the body of the response."""
+        if path == ['initSession']:
+            token = uuid.uuid4().hex
+            with glpi.lock:
+                glpi.tokens.add(token)
+            return 'initSession', 200, {'session_token': token}
+
+        token = self.headers.get('Session-Token')
+        if token not in glpi.tokens:
+            return (path[0] if path else 'unknown', 401,
+                    ['ERROR_SESSION_TOKEN_INVALID', 'session_token seems invalid'])
+
+        if path == ['killSession']:
+            with glpi.lock:
+                glpi.tokens.discard(token)
+            return 'killSession', 200, {}
+        if path in (['changeActiveEntities'], ['changeActiveProfile']):
+            # Items are not restricted by entity or profile.
+            return path[0], 200, True
+        if path == ['getGlpiConfig']:
+            return 'getGlpiConfig', 200, {'cfg_glpi': {'version': '9.5.0'}}
+        if len(path) == 2 and path[0] == 'listSearchOptions':
+            options = {'common': {'name': 'Characteristics'}}
+            raw = 'raw' in dict(params)
+            for field, uid in SEARCH_OPTIONS.get(path[1], {}).items():
+                # Raw options have join parameters but no uid.
+                options[field] = (dict(RAW_SEARCH_OPTIONS.get(path[1], {}).get(field, {}),
+                                       name=uid.split('.')[-1])
+                                  if raw else
+                                  {'name': uid.split('.')[-1], 'uid': uid})
+            return 'listSearchOptions', 200, options
+        if len(path) == 2 and path[0] == 'search':
+            status, result = glpi.search(path[1], params)
+            return 'search', status, result
+        if path == ['getMultipleItems']:
+            params = unflatten(params)
+            expand = [param[5:] for param, value in params.items()
+                      if param.startswith('with_') and value == 'true']
+            return 'getMultipleItems', 200, [
+                glpi.get_item(item['itemtype'], item['items_id'], expand) or {}
+                for item in params.get('items', [])
+            ]
+        if len(path) == 2 and http_method == 'GET':
+            item = glpi.get_item(path[0], path[1])
+            if item is None:
+                return 'getItem', 404, ['ERROR_ITEM_NOT_FOUND', 'Item not found']
+            return 'getItem', 200, item
+        if len(path) == 1 and http_method in ('POST', 'PUT', 'DELETE'):
+            method = {'POST': 'add', 'PUT': 'update', 'DELETE': 'delete'}[http_method]
+            items = json.loads(body.decode('utf-8') or '{}').get('input', [])
+            items = items if isinstance(items, list) else [items]
+            status = 201 if method == 'add' else 200
+            return method, status, glpi.write(method, path[0], items)
+        return 'unknown', 400, ['ERROR_RESOURCE_NOT_FOUND_NOR_COMMONDBTM', 'unknown resource']
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hosts', type=int, default=1000,
+                        help='Number of computers (default: 1000).')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Latency of each request in milliseconds (default: 0).')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Ratio of requests failing with a 503 error (default: 0).')
+    parser.add_argument('--port', type=int, default=8080,
+                        help='Listening port (default: 8080).')
+    args = parser.parse_args()
+
+    glpi = FakeGLPI(args.hosts, args.latency / 1000, error_rate=args.error_rate)
+    url = glpi.start(port=args.port)
+    sys.stderr.write('serving {:d} hosts on {:s}\n'.format(args.hosts, url))
+    try:
+        while True:
+            time.sleep(60)
+    except KeyboardInterrupt:
+        sys.stderr.write('{:s}\n'.format(json.dumps(glpi.stats())))
+    glpi.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Benchmark of the inventory plugin and the inventory script against a local
+fake GLPI server (see ``fake_glpi.py``).
+
+For each number of hosts, a synthetic dataset is served and the inventory is
+generated from the groups of a configuration (by default the groups of
+``exemples/glpi-api.yml``) by ``ansible-inventory`` with the plugin and by the
+script (optionally by several concurrent processes). Wall time, API calls,
+transferred bytes and peak RSS of each run are output as JSON so results can be
+compared between commits::
+
+    $ python benchmarks/inventory.py --hosts 1000 10000 100000 --latency 20 \\
+        --output results.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import yaml
+
+from fake_glpi import FakeGLPI
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+DEFAULT_CONFIG = os.path.join(ROOT_DIR, 'exemples', 'glpi-api.yml')
+SCRIPT_PATH = os.path.join(ROOT_DIR, 'scripts', 'inventory', 'glpi-api.py')
+TARGETS = ['plugin', 'script']
+
+def load_groups(path):
+    '''Helper function that return the groups of a configuration file.'''
+    with open(path) as fhandler:
+        config = yaml.safe_load(fhandler)
+    # Configurations of the plugin contain the groups in 'queries'.
+    return config['queries'] if 'plugin' in config else config
+
+def parse_option(value):
+    '''Helper function that parse a ``key=value`` option (value being YAML).'''
+    key, _, value = value.partition('=')
+    return key, yaml.safe_load(value)
+
+def run(command, env, output_path, processes=1):
+    '''
+    Helper function that run ``command`` in ``processes`` concurrent processes
+    and return the wall time, the highest peak RSS (in KiB) and the first non
+    zero exit status. The standard output of the first process is written to
+    ``output_path``.
+    '''
+    start = time.perf_counter()
+    children = []
+    for index in range(processes):
+        path = output_path if index == 0 else '{:s}.{:d}'.format(output_path, index)
+        with open(path, 'w') as output, open(path + '.err', 'w') as errors:
+            children.append(subprocess.Popen(command, env=env, stdout=output, stderr=errors))
+    peak_rss, returncode = 0, 0
+    for process in children:
+        # wait4 returns the resources usage of this child only.
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        peak_rss = max(peak_rss, rusage.ru_maxrss)
+        returncode = returncode or process.returncode
+    return time.perf_counter() - start, peak_rss, returncode
+
+def count_hosts(output_path):
+    '''Helper function that return the number of hosts of a JSON inventory.'''
+    try:
+        with open(output_path) as fhandler:
+            return len(json.load(fhandler).get('_meta', {}).get('hostvars', {}))
+    except (IOError, ValueError):
+        return None
+
+def benchmark(target, glpi, url, groups, args, work_dir):
+    '''Generate the inventory with ``target`` and return the measures.'''
+    env = dict(os.environ,
+               GLPI_SEARCH_OPTIONS_CACHE_DIR=os.path.join(work_dir, 'search-options'))
+    output_path = os.path.join(work_dir, '{:s}.json'.format(target))
+    if target == 'plugin':
+        # The collection is loaded from the repository.
+        collections_dir = os.path.join(work_dir, 'collections')
+        namespace_dir = os.path.join(collections_dir, 'ansible_collections', 'unistra')
+        if not os.path.isdir(namespace_dir):
+            os.makedirs(namespace_dir)
+            os.symlink(ROOT_DIR, os.path.join(namespace_dir, 'glpi'))
+        config = {'plugin': 'unistra.glpi.inv', 'glpi_url': url,
+                  'glpi_apptoken': 'apptoken', 'glpi_usertoken': 'usertoken',
+                  'page_size': args.page_size}
+        if args.cached_run:
+            config.update(cache=True, cache_plugin='jsonfile',
+                          cache_connection=os.path.join(work_dir, 'inventory-cache'))
+        config.update(parse_option(option) for option in args.plugin_option)
+        config['queries'] = groups
+        config_path = os.path.join(work_dir, 'glpi.yml')
+        env.update(ANSIBLE_COLLECTIONS_PATH=collections_dir,
+                   ANSIBLE_INVENTORY_ENABLED='unistra.glpi.inv',
+                   ANSIBLE_INVENTORY_UNPARSED_FAILED='1')
+        command = [args.ansible_inventory, '-i', config_path, '--list']
+    else:
+        config = groups
+        config_path = os.path.join(work_dir, 'glpi-api.yml')
+        env.update(ANSIBLE_GLPI_URL=url, ANSIBLE_GLPI_APPTOKEN='apptoken',
+                   ANSIBLE_GLPI_USERTOKEN='usertoken')
+        command = ([sys.executable, SCRIPT_PATH, '--list', '--config-file', config_path,
+                    '--page-size', str(args.page_size)]
+                   + args.script_option)
+    with open(config_path, 'w') as fhandler:
+        yaml.safe_dump(config, fhandler, sort_keys=False)
+
+    glpi.reset_stats()
+    wall_time, peak_rss, returncode = run(command, env, output_path, args.processes)
+    stats = glpi.stats()
+    if returncode != 0:
+        with open(output_path + '.err') as fhandler:
+            sys.stderr.write('{:s} failed:\n{:s}'.format(target, fhandler.read()))
+    result = {
+        'target': target,
+        'processes': args.processes,
+        'hosts': len(glpi.items['Computer']),
+        'returncode': returncode,
+        'inventory_hosts': count_hosts(output_path),
+        'wall_time': round(wall_time, 3),
+        'api_calls': stats['api_calls'],
+        'calls': stats['calls'],
+        'bytes_received': stats['bytes_received'],
+        'bytes_sent': stats['bytes_sent'],
+        'peak_rss': peak_rss,
+    }
+    if args.cached_run and target == 'plugin':
+        # The inventory is generated again from the cache of the first run.
+        glpi.reset_stats()
+        run(command, env, output_path, args.processes)
+        result['cached_api_calls'] = glpi.stats()['api_calls']
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--hosts', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Numbers of hosts of the datasets (default: 1000 10000 100000).')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Latency of each request in milliseconds (default: 0).')
+    parser.add_argument('--error-rate', type=float, default=0,
+                        help='Ratio of requests failing with a 503 error, retried by '
+                             'the plugin and the script (default: 0).')
+    parser.add_argument('--targets', nargs='+', choices=TARGETS, default=TARGETS,
+                        help='Implementations to run (default: plugin script).')
+    parser.add_argument('--config', default=DEFAULT_CONFIG,
+                        help='Configuration whose groups are generated (default: '
+                             'exemples/glpi-api.yml).')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='Number of rows retrieved by each request (default: 1000).')
+    parser.add_argument('--processes', type=int, default=1,
+                        help='Number of processes generating the inventory at the '
+                             'same time (default: 1).')
+    parser.add_argument('--plugin-option', action='append', default=[],
+                        metavar='KEY=VALUE',
+                        help='Option of the plugin (like max_workers=4), can be repeated.')
+    parser.add_argument('--script-option', action='append', default=[],
+                        metavar='OPTION',
+                        help='Option of the script, can be repeated.')
+    parser.add_argument('--cached-run', action='store_true',
+                        help='Generate the inventory of the plugin again from the '
+                             'cache of the first run (with the "cache" option), '
+                             'which must not call GLPI.')
+    parser.add_argument('--ansible-inventory',
+                        default=shutil.which('ansible-inventory') or 'ansible-inventory',
+                        help='Path of ansible-inventory command.')
+    parser.add_argument('--output',
+                        help='File in which results are written (default: standard output).')
+    args = parser.parse_args()
+
+    groups = load_groups(args.config)
+    results = []
+    failed = False
+    for nb_hosts in args.hosts:
+        glpi = FakeGLPI(nb_hosts, args.latency / 1000, error_rate=args.error_rate)
+        url = glpi.start()
+        try:
+            for target in args.targets:
+                work_dir = tempfile.mkdtemp(prefix='glpi-benchmark-')
+                try:
+                    result = benchmark(target, glpi, url, groups, args, work_dir)
+                finally:
+                    shutil.rmtree(work_dir)
+                sys.stderr.write('{:s} {:d} hosts: {:.2f}s, {:d} calls\n'.format(
+                    target, nb_hosts, result['wall_time'], result['api_calls']))
+                if result.get('cached_api_calls'):
+                    sys.stderr.write('{:s} {:d} hosts: {:d} calls from the cache\n'.format(
+                        target, nb_hosts, result['cached_api_calls']))
+                    failed = True
+                results.append(result)
+        finally:
+            glpi.stop()
+
+    report = {
+        'parameters': {
+            'config': os.path.relpath(args.config, ROOT_DIR),
+            'latency': args.latency,
+            'error_rate': args.error_rate,
+            'page_size': args.page_size,
+            'processes': args.processes,
+            'cached_run': args.cached_run,
+            'plugin_options': dict(parse_option(option) for option in args.plugin_option),
+            'script_options': args.script_option,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fhandler:
+            json.dump(report, fhandler, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Benchmark of the memory used by the rows of GLPI searches kept by the
+inventory plugin (for the cache, the local filtering, ...).
+
+Rows decoded from the JSON pages of a search (like the GLPI client does) are
+kept either as decoded dictionaries (former implementation) or as compact rows
+(``compact_rows``), then hostvars of each row are rendered. Memory allocated
+(traced by ``tracemalloc``) and time of each step are displayed.
+"""
+
+import gc
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+from fake_glpi import generate_dataset
+from templates import HOSTNAME, HOSTVARS, load_plugin
+
+MIB = 1024 * 1024
+
+def generate_pages(nb_rows, page_size):
+    """Generate the JSON pages of a search of ``nb_rows`` computers."""
+    rows = list(generate_dataset(nb_rows)['Computer'].values())
+    return [json.dumps(rows[start:start + page_size])
+            for start in range(0, len(rows), page_size)]
+
+def decoded_rows(pages):
+    """Yield the rows of ``pages``, decoding each page when it is reached."""
+    for page in pages:
+        for row in json.loads(page):
+            yield row
+
+def render(plugin, rows):
+    """Render hostnames and hostvars of ``rows``."""
+    hostname = plugin.compile_template(HOSTNAME)
+    hostvars = [(param, plugin.compile_template(value)) for param, value in HOSTVARS.items()]
+    return [
+        (plugin.render_template(hostname, row),
+         {param: plugin.render_template(template, row) for param, template in hostvars})
+        for row in rows
+    ]
+
+def measure(function, *args):
+    """Return the result of ``function``, the memory it allocated and kept, its
+    peak of allocated memory and its duration."""
+    gc.collect()
+    start_size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    result = function(*args)
+    duration = time.perf_counter() - start
+    gc.collect()
+    size, peak = tracemalloc.get_traced_memory()
+    return result, size - start_size, peak - start_size, duration
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=50000,
+                        help='Number of rows (default: 50000).')
+    parser.add_argument('--page-size', type=int, default=1000,
+                        help='Number of rows by page (default: 1000).')
+    args = parser.parse_args()
+
+    plugin = load_plugin()
+    pages = generate_pages(args.rows, args.page_size)
+
+    tracemalloc.start()
+    results = []
+    for name, store in (('dictionaries', list), ('compact rows', plugin.compact_rows)):
+        rows, rows_size, rows_peak, rows_time = measure(store, decoded_rows(pages))
+        hosts, hosts_size, _, hosts_time = measure(render, plugin, rows)
+        results.append((name, hosts, rows_size, rows_peak, rows_time, hosts_size, hosts_time))
+        del rows, hosts
+    tracemalloc.stop()
+
+    # Both representations must generate the same values.
+    if results[0][1] != results[1][1]:
+        sys.stderr.write('error: representations generate different values\n')
+        sys.exit(1)
+
+    print('rows: {:d}, fields: {:d}, hostvars: {:d}'.format(
+        args.rows, len(json.loads(pages[0])[0]), len(HOSTVARS)))
+    print('{:14s} {:>12s} {:>12s} {:>10s} {:>14s} {:>10s}'.format(
+        '', 'rows (MiB)', 'peak (MiB)', 'time (ms)', 'hostvars (MiB)', 'time (ms)'))
+    for name, _, rows_size, rows_peak, rows_time, hosts_size, hosts_time in results:
+        print('{:14s} {:12.1f} {:12.1f} {:10.1f} {:14.1f} {:10.1f}'.format(
+            name, rows_size / MIB, rows_peak / MIB, rows_time * 1000,
+            hosts_size / MIB, hosts_time * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""Micro-benchmark of the generation of hostname and hostvars from templates.
+
+Compare the former implementation of ``replace_fields_values`` (one regular
+expression substitution by field and by row) with the templates compiled once
+by group (``compile_template``/``render_template``) of the inventory plugin.
+"""
+
+import os
+import re
+import sys
+import atexit
+import random
+import shutil
+import argparse
+import tempfile
+import importlib.util
+from timeit import timeit
+
+ROOT_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+PLUGIN_PATH = os.path.join(ROOT_DIR, 'plugins', 'inventory', 'inv.py')
+
+# Hostname and hostvars of a group (as in exemples/glpi-api.yml).
+HOSTNAME = '$1.$33'
+HOSTVARS = {
+    'type': '$4',
+    'manufacturer': '$23',
+    'state': '$31',
+    'domain': '$33',
+    'os_name': '$45',
+    'os_version': '$46',
+}
+
+def legacy_replace_fields_values(value, data, default=''):
+    """Former implementation of ``replace_fields_values``."""
+    value = str(value)
+    for field_idx in re.findall(r'\$(\d*)', value):
+        if not data[field_idx]:
+            value = re.sub(r'\${}'.format(field_idx), default, value)
+        elif isinstance(data[field_idx], list):
+            return data[field_idx]
+        else:
+            value = re.sub(r'\${}'.format(field_idx), str(data[field_idx]), value)
+    return value
+
+def load_plugin():
+    """Load the inventory plugin module from its path. The collection is made
+    importable (for the modules utilities) from a temporary
+    ``ansible_collections`` directory."""
+    collections_dir = tempfile.mkdtemp(prefix='glpi-benchmark-')
+    atexit.register(shutil.rmtree, collections_dir)
+    namespace_dir = os.path.join(collections_dir, 'ansible_collections', 'unistra')
+    os.makedirs(namespace_dir)
+    os.symlink(ROOT_DIR, os.path.join(namespace_dir, 'glpi'))
+    sys.path.insert(0, collections_dir)
+
+    spec = importlib.util.spec_from_file_location('glpi_inventory', PLUGIN_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def generate_rows(nb_rows, seed=0):
+    """Generate ``nb_rows`` rows like the ones returned by a GLPI search."""
+    rnd = random.Random(seed)
+    return [
+        {
+            '1': 'host{:d}'.format(idx),
+            '4': rnd.choice(['Rack Mount Chassis', 'Blade', 'Virtual Machine']),
+            '23': rnd.choice(['Dell Inc.', 'HP', None]),
+            '31': rnd.choice(['Running', 'Stopped']),
+            '33': rnd.choice(['exemple.org', 'lab.exemple.org', None]),
+            '45': rnd.choice(['Ubuntu', 'CentOS', 'Windows']),
+            '46': rnd.choice(['16.04', '18.04', '7', '2016']),
+        }
+        for idx in range(nb_rows)
+    ]
+
+def legacy_render(rows):
+    """Generate hostnames and hostvars of ``rows`` with the former implementation."""
+    return [
+        (legacy_replace_fields_values(HOSTNAME, row),
+         {param: legacy_replace_fields_values(value, row)
+          for param, value in HOSTVARS.items()})
+        for row in rows
+    ]
+
+def compiled_render(plugin, rows):
+    """Generate hostnames and hostvars of ``rows`` with compiled templates."""
+    hostname = plugin.compile_template(HOSTNAME)
+    hostvars = [(param, plugin.compile_template(value)) for param, value in HOSTVARS.items()]
+    return [
+        (plugin.render_template(hostname, row),
+         {param: plugin.render_template(template, row) for param, template in hostvars})
+        for row in rows
+    ]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000,
+                        help='Number of rows (default: 20000).')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='Number of runs of each implementation (default: 5).')
+    args = parser.parse_args()
+
+    plugin = load_plugin()
+    rows = generate_rows(args.rows)
+
+    # Both implementations must generate the same values.
+    if legacy_render(rows) != compiled_render(plugin, rows):
+        sys.stderr.write('error: implementations generate different values\n')
+        sys.exit(1)
+
+    legacy = timeit(lambda: legacy_render(rows), number=args.repeat) / args.repeat
+    compiled = timeit(lambda: compiled_render(plugin, rows), number=args.repeat) / args.repeat
+    print('rows: {:d}, hostvars: {:d}'.format(args.rows, len(HOSTVARS)))
+    print('legacy replace_fields_values: {:8.1f} ms'.format(legacy * 1000))
+    print('compiled templates:           {:8.1f} ms'.format(compiled * 1000))
+    print('speedup:                      {:8.1f}x'.format(legacy / compiled))
+
+    # Fields sharing a prefix ($1 and $160) are badly replaced by the former
+    # implementation.
+    row = {'1': 'hypervisor', '160': 'vm'}
+    print("'$1@$160' -> legacy: {!r}, compiled: {!r}".format(
+        legacy_replace_fields_values('$1@$160', row),
+        plugin.render_template(plugin.compile_template('$1@$160'), row)))
+
+if __name__ == '__main__':
+    main()
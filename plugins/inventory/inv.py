@@ -1,9 +1,295 @@
-import os
 import re
-from ansible.plugins.inventory import BaseInventoryPlugin
+import copy
+import json
+import time
+import threading
+from itertools import islice
+from collections import ChainMap
+from collections.abc import Mapping
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from jinja2 import Environment, nodes
+from ansible.inventory.data import InventoryData
+from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable, Constructable
 from ansible.module_utils._text import to_native
 from ansible.errors import AnsibleError
-from glpi_api import GLPI, GLPIError
+from ansible.utils.display import Display
+from glpi_api import GLPIError
+from ansible_collections.unistra.glpi.plugins.module_utils.lock import LockTimeout
+from ansible_collections.unistra.glpi.plugins.module_utils.shared_cache import share
+from ansible_collections.unistra.glpi.plugins.module_utils.session import (
+    glpi_client, connection_params)
+from ansible_collections.unistra.glpi.plugins.module_utils.search import (
+    search_pages, current_search)
+from ansible_collections.unistra.glpi.plugins.module_utils.scheduler import RequestScheduler
+from ansible_collections.unistra.glpi.plugins.module_utils.search_options import (
+    SearchOptions, DEFAULT_CACHE_DIR)
+
+DOCUMENTATION = '''
+    name: inv
+    short_description: GLPI inventory source
+    description:
+        - Generate an Ansible dynamic inventory from a configuration file describing
+          groups and how to generate them from GLPI API.
+        - Rows returned by GLPI searches can be cached (see I(cache) options).
+        - Searches are done page by page (see I(page_size) option).
+        - Searches can be run concurrently (see I(max_workers) option).
+        - Children of retrieved groups can be filtered locally from the data of
+          their parent (see I(local_filtering) option).
+        - Searches of groups sharing an item type can be merged into one search
+          (see I(query_planner) option).
+        - Rows can be synchronized incrementally from a snapshot kept in the cache
+          (see I(incremental) option).
+        - GLPI sessions can be reused between runs (see I(session_cache_dir) option).
+        - Results of the searches can be shared by concurrent Ansible processes,
+          only the first one searching GLPI (see I(shared_cache_dir) option).
+        - Fields can be referenced by their uid (like C(Domain.name)) in I(fields),
+          I(criteria), I(metacriteria) and templates (like C(${Domain.name})).
+        - Related items of the hosts (network ports with their IP addresses,
+          disks, ...) can be added to their variables, retrieved by batches (see
+          I(expand) parameter of groups in README).
+        - Groups can be generated locally from the hosts of other groups (see
+          I(union), I(intersection) and I(difference) parameters of groups in
+          README).
+        - Statistics of each group (search time, API requests, rows, size of the
+          responses, templates rendering time and hosts) are displayed with
+          C(-vvv) and can be written in a file (see I(stats_file) option).
+        - Variables and groups can be generated locally from the variables of
+          the hosts (like C(glpi.os_name)) with I(compose), I(groups) and
+          I(keyed_groups) options, which are applied once all the groups of the
+          configuration are generated.
+        - The inventory can be generated from several GLPI instances (or several
+          entities or profiles of an instance) at the same time (see I(sources)
+          option).
+    extends_documentation_fragment:
+        - inventory_cache
+        - constructed
+    options:
+        plugin:
+            description: Token that ensures this is a source file for this plugin.
+            required: true
+        glpi_url:
+            description: URL of the GLPI REST API.
+            env:
+                - name: GLPI_URL
+        glpi_apptoken:
+            description: Application token of the API client.
+            env:
+                - name: GLPI_APPTOKEN
+        glpi_usertoken:
+            description: User token (alternatively to username and password).
+            env:
+                - name: GLPI_USERTOKEN
+        glpi_username:
+            description: Username (alternatively to the user token).
+            env:
+                - name: GLPI_USERNAME
+        glpi_password:
+            description: Password (alternatively to the user token).
+            env:
+                - name: GLPI_PASSWORD
+        glpi_verify_certs:
+            description: Whether to check SSL certificates.
+            env:
+                - name: GLPI_VERIFY_CERTS
+        glpi_use_headers:
+            description: Whether to send authentication parameters as HTTP headers.
+            env:
+                - name: GLPI_USE_HEADERS
+        session_cache_dir:
+            description:
+                - Directory in which GLPI session tokens are cached (by URL and
+                  credentials). When set, the session is reused by the next runs
+                  and by the C(unistra.glpi.api) module using the same directory
+                  instead of opening a new session; it is renewed when GLPI
+                  rejects it.
+            type: path
+            env:
+                - name: GLPI_SESSION_CACHE_DIR
+        search_options_cache_dir:
+            description:
+                - Directory in which the search options of the item types (used for
+                  resolving fields uids) are cached, by GLPI URL. This cache is
+                  shared with the C(unistra.glpi.api) module.
+            type: path
+            default: ~/.ansible/tmp/glpi-search-options
+            env:
+                - name: GLPI_SEARCH_OPTIONS_CACHE_DIR
+        search_options_cache_ttl:
+            description:
+                - Number of seconds the search options of an item type are cached.
+                  All item types are retrieved again when the version of GLPI changed.
+            type: int
+            default: 86400
+        page_size:
+            description:
+                - Number of rows retrieved by each request to GLPI. Searches are done
+                  page by page and, when rows are not needed afterward (by the cache,
+                  local filtering, ...), hosts are added to the inventory as each page
+                  is retrieved.
+            type: int
+            default: 1000
+        max_workers:
+            description:
+                - Maximum number of GLPI searches run concurrently. Searches share
+                  the same session and the inventory is always generated in the
+                  order of the configuration.
+                - C(1) means searches are run sequentially.
+            type: int
+            default: 1
+        max_in_flight:
+            description:
+                - Maximum number of requests sent to GLPI at the same time and
+                  waiting for their response.
+                - C(0) means no limit (at most I(max_workers) requests).
+            type: int
+            default: 0
+        rate_limit:
+            description:
+                - Maximum number of requests sent to GLPI by second. The rate is
+                  halved each time GLPI fails with a server error or a timeout and
+                  restored progressively as requests succeed.
+                - C(0) means no limit.
+            type: float
+            default: 0
+        retries:
+            description:
+                - Number of times a request failing with a server error (5xx or 429
+                  status) or a timeout is sent again.
+            type: int
+            default: 3
+        retry_backoff:
+            description:
+                - Delay, in seconds, before the first retry of a request. The delay
+                  is doubled on each retry (up to 30 seconds) and randomized; the
+                  delay of the C(Retry-After) header of the response is used when
+                  set.
+            type: float
+            default: 0.5
+        request_timeout:
+            description:
+                - Number of seconds to wait for GLPI to respond to a request before
+                  retrying it. C(0) means no timeout.
+            type: float
+            default: 0
+        local_filtering:
+            description:
+                - Evaluate locally, on the data retrieved for the parent group, the
+                  criteria of children of groups having I(retrieve) set, instead of
+                  searching GLPI again.
+                - This is only done when the child does not change the item type and
+                  the metacriteria, retrieves no new fields and its criteria only
+                  use C(AND) links, C(contains), C(notcontains), C(equals) and
+                  C(notequals) search types and fields retrieved by the parent,
+                  except fields that may have several values by item (fields of
+                  tables joined with several rows by item, like virtual machines).
+            type: bool
+            default: false
+        query_planner:
+            description:
+                - Before retrieving data, merge the searches of groups whose data is
+                  a subset of the data of another group (same item type and
+                  metacriteria, criteria ending with the criteria of the other group
+                  and other criteria evaluable locally). Only the search of the most
+                  general group is done, with the fields of all merged groups, and
+                  the data of the others are filtered locally.
+                - This extends I(local_filtering) to all groups. The number of saved
+                  API calls is displayed in verbose mode.
+            type: bool
+            default: false
+        incremental:
+            description:
+                - Keep a snapshot of the rows of each search in the cache and, on
+                  each run, only retrieve the items modified (C(date_mod) field)
+                  since the last synchronization. I(cache) option must be set.
+                - Items deleted, moved to the trash or no longer matching the
+                  criteria are removed by periodically retrieving only the ids of
+                  the items of each search (see I(sweep_interval)).
+                - Changes that don't update the modification date of the items
+                  (like changes of linked items) are only retrieved on full refresh
+                  (see I(full_refresh_interval)).
+            type: bool
+            default: false
+        sweep_interval:
+            description:
+                - Minimal number of seconds between two retrievals of the ids of
+                  the items of a search, in incremental mode.
+            type: int
+            default: 3600
+        full_refresh_interval:
+            description:
+                - Maximal age, in seconds, of the snapshot of a search before all
+                  its rows are retrieved again, in incremental mode.
+            type: int
+            default: 86400
+        expand_batch_size:
+            description:
+                - Number of items whose related items (see I(expand) parameter of
+                  groups) are retrieved by each request to GLPI.
+            type: int
+            default: 100
+        expand_workers:
+            description:
+                - Maximum number of requests retrieving related items sent
+                  concurrently for a group.
+            type: int
+            default: 4
+        shared_cache_dir:
+            description:
+                - Directory in which the results of the searches are shared by the
+                  Ansible processes parsing the inventory at the same time. The
+                  first process doing a search holds a lock on it while the others
+                  wait for its result, so GLPI is searched once. Unset for
+                  disabling this cache.
+            type: path
+            env:
+                - name: GLPI_INVENTORY_SHARED_CACHE_DIR
+        shared_cache_ttl:
+            description:
+                - Maximum number of seconds a shared result is used by the other
+                  processes.
+            type: int
+            default: 60
+        shared_cache_max_wait:
+            description:
+                - Maximum number of seconds a process waits for the result of a
+                  search done by another process. The process then searches GLPI
+                  itself.
+            type: int
+            default: 300
+        sources:
+            description:
+                - GLPI sources from which the groups of I(queries) are generated
+                  concurrently, instead of the connection defined by the I(glpi_*)
+                  options. Each source is a dictionary with a unique C(name), the
+                  I(glpi_*) options overriding the ones of the configuration, the
+                  C(entity) (and C(entity_recursive)) and the C(profile) activated
+                  on the session and a C(timeout) (in seconds).
+                - Inventories of the sources are merged in the order of the list. A
+                  host generated by several sources only gets the groups and the
+                  variables of the first one (set in C(glpi_source) variable).
+                - A source whose inventory is not generated before its C(timeout)
+                  (counted from the start of the generation) is skipped with a
+                  warning and its searches go on in the background.
+            type: list
+            elements: dict
+        stats_file:
+            description:
+                - File in which statistics of the generation of the inventory are
+                  written as JSON (by group and by search, and totals).
+            type: path
+        profile:
+            description:
+                - Display, at the end of the generation of the inventory, the
+                  slowest groups and the total time spent rendering hostnames and
+                  hostvars templates.
+            type: bool
+            default: false
+        queries:
+            description: Ordered groups definitions (see README).
+            type: dict
+            required: true
+'''
 
 # Configuration parameters of a group.
 GROUP_PARAMS = ('itemtype',         # GLPI item type
@@ -14,31 +300,412 @@ GROUP_PARAMS = ('itemtype',         # GLPI item type
                 'vars',             # Ansible vars for the group
                 'hostvars',         # Ansible hostvars attached to group hosts
                 'children',         # Children of the group
-                'retrieve')         # Force retrieval of data
+                'retrieve',         # Force retrieval of data
+                'expand',           # Related items added to hostvars
+                'union',            # Hosts of any of the listed groups
+                'intersection',     # Hosts of all the listed groups
+                'difference')       # Hosts of the first listed group only
 
-def replace_fields_values(value, data, default=''):
+# Operations of the groups generated from the hosts of other groups (see
+# `InventoryModule.update_set_groups`) and the other parameters they accept.
+SET_OPERATIONS = ('union', 'intersection', 'difference')
+SET_GROUP_PARAMS = ('vars',)
+
+# Parameters of a GLPI source (see 'sources' option).
+SOURCE_PARAMS = ('name',                # Unique name of the source
+                 'glpi_url',            # Connection parameters (the ones of the
+                 'glpi_apptoken',       # configuration by default)
+                 'glpi_usertoken',
+                 'glpi_username',
+                 'glpi_password',
+                 'glpi_verify_certs',
+                 'glpi_use_headers',
+                 'entity',              # Active entity of the session
+                 'entity_recursive',    # Whether the sub-entities are active
+                 'profile',             # Active profile of the session
+                 'timeout')             # Seconds for generating the source
+
+# Related items that can be added to the hostvars of the hosts of a group
+# (`with_<name>` parameters of getMultipleItems, returned in `_<name>`).
+EXPANSIONS = ('devices', 'disks', 'softwares', 'connections', 'networkports',
+              'infocoms', 'contracts', 'documents', 'tickets', 'problems',
+              'changes', 'notes', 'logs')
+
+# Search types that can be evaluated locally on retrieved data.
+LOCAL_SEARCHTYPES = ('contains', 'notcontains', 'equals', 'notequals')
+
+# Fields of the id and of the modification date of the items (used by
+# incremental synchronization) and format of dates returned by GLPI.
+ID_FIELD = 2
+DATE_MOD_FIELD = 19
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Number of seconds subtracted from the start of a synchronization for the
+# next one (see `sync_watermark`), covering the clock differences between the
+# servers of GLPI.
+SYNC_MARGIN = 60
+
+# Number of groups displayed by the profiling.
+PROFILE_GROUPS = 10
+
+# Maximum number of distinct values of a field shared by the rows of a search
+# (see `compact_rows`); values of fields having more values (like names) are
+# not shared.
+MAX_SHARED_VALUES = 1024
+
+# Filters whose results are not determined by their input (expressions using
+# them, or calling functions like lookups, are evaluated for each host).
+RANDOM_FILTERS = ('random', 'shuffle')
+
+display = Display()
+
+# Classes of compact rows by fields (see `row_type`).
+ROW_TYPES = {}
+
+# Environment used for parsing the expressions of constructed options (see
+# `expression_paths`).
+jinja_env = Environment()
+
+def compile_template(value):
     '''
-    Helper function that replace all occurences starting by a dollar and followed
-    by a number with the corresponding field index in the data.
+    Helper function that split a template, in which occurences starting by a
+    dollar and followed by a number (optionally between braces) are fields
+    index, into its literal strings and its fields index. The result is a tuple
+    of two tuples, the literal strings having one more element than the fields
+    index.
+    '''
+    parts = re.split(r'\$(?:\{(\d+)\}|(\d+))', str(value))
+    return (tuple(parts[0::3]),
+            tuple(braced or field for braced, field in zip(parts[1::3], parts[2::3])))
+
+def render_template(template, data, default=''):
+    '''
+    Helper function that generate a value from a template compiled by
+    `compile_template` by replacing fields index with the corresponding values
+    in the data.
     '''
-    value = str(value)
-    for field_idx in re.findall(r'\$(\d*)', value):
+    literals, fields = template
+    if not fields:
+        return literals[0]
+
+    parts = [literals[0]]
+    for field_idx, literal in zip(fields, literals[1:]):
+        field_value = data[field_idx]
         # If current field is not defined or empty, add the default value.
-        if not data[field_idx]:
-            value = re.sub(r'\${}'.format(field_idx), default, value)
+        if not field_value:
+            parts.append(default)
         # If the current field is a list, return it (all other elements
         # will be ignored).
-        elif isinstance(data[field_idx], list):
-            return data[field_idx]
-        # Replace in string with the value from data.
+        elif isinstance(field_value, list):
+            return field_value
+        # Add the value from data (ensuring values are str).
         else:
-            # Ugly hack for Python 2.7 and ensuring values are str/unicode.
-            #data_value = (unicode(data[field_idx])
-            #              if PY_VERSION < 3
-            #              else str(data[field_idx]))
-            data_value = to_native(data[field_idx])
-            value = re.sub(r'\${}'.format(field_idx), data_value, value)
-    return value
+            parts.append(to_native(field_value))
+        parts.append(literal)
+    # The value of a template made of one field is not copied so hosts share
+    # the values shared by the rows (see `compact_rows`).
+    if len(parts) == 3 and not parts[0] and not parts[2]:
+        return parts[1]
+    return ''.join(parts)
+
+def replace_fields_values(value, data, default=''):
+    '''
+    Helper function that replace all occurences starting by a dollar and followed
+    by a number with the corresponding field index in the data.
+    '''
+    return render_template(compile_template(value), data, default)
+
+class Row(tuple):
+    '''
+    Compact row of a GLPI search: the values of the row in the order of the
+    fields of its class (see `row_type`). Like the dictionaries returned by the
+    API, values are accessed by field index (``row['1']`` or ``row.get('1')``).
+    '''
+    __slots__ = ()
+    fields = ()
+    index = {}
+
+    def __getitem__(self, field):
+        return tuple.__getitem__(self, self.index[field])
+
+    def get(self, field, default=None):
+        idx = self.index.get(field)
+        return default if idx is None else tuple.__getitem__(self, idx)
+
+    def keys(self):
+        return self.fields
+
+    def items(self):
+        return zip(self.fields, tuple.__iter__(self))
+
+def row_type(fields):
+    '''
+    Helper function that return the class of the compact rows having ``fields``
+    (a tuple of fields index), created once for all the rows.
+    '''
+    cls = ROW_TYPES.get(fields)
+    if cls is None:
+        cls = ROW_TYPES.setdefault(fields, type('Row', (Row,), {
+            '__slots__': (),
+            'fields': fields,
+            'index': dict((field, idx) for idx, field in enumerate(fields))
+        }))
+    return cls
+
+def compact_rows(rows):
+    '''
+    Helper function that return ``rows`` (dictionaries returned by the API) as
+    compact rows (see `Row`). Equal strings of a field are shared by all the
+    rows instead of being decoded in a new string for each row, unless the
+    field has more than `MAX_SHARED_VALUES` distinct values. ``rows`` can be an
+    iterator so pages are released as they are compacted.
+    '''
+    shared = {}
+    compacted = []
+    for row in rows:
+        if isinstance(row, Row):
+            compacted.append(row)
+            continue
+        values = []
+        for field, value in row.items():
+            field_values = shared.setdefault(field, {})
+            if field_values is not None:
+                if isinstance(value, str):
+                    value = field_values.setdefault(value, value)
+                elif isinstance(value, list):
+                    value = [field_values.setdefault(item, item)
+                             if isinstance(item, str) else item
+                             for item in value]
+                if len(field_values) > MAX_SHARED_VALUES:
+                    shared[field] = None
+            values.append(value)
+        compacted.append(row_type(tuple(row.keys()))(values))
+    return compacted
+
+def pack_rows(rows):
+    '''
+    Helper function that return compact ``rows`` in a serializable form for
+    the cache: the fields of the first row and the values of each row (rows
+    having other fields being kept as dictionaries).
+    '''
+    fields = rows[0].fields if rows else ()
+    return {'fields': list(fields),
+            'rows': [list(row) if row.fields == fields else dict(row.items())
+                     for row in rows]}
+
+def unpack_rows(packed):
+    '''
+    Helper function that return the compact rows packed by `pack_rows` (the
+    lists of dictionaries cached by previous versions are also accepted).
+    '''
+    if isinstance(packed, list):
+        return compact_rows(packed)
+    fields = packed['fields']
+    return compact_rows(row if isinstance(row, dict) else dict(zip(fields, row))
+                        for row in packed['rows'])
+
+def pack_snapshot(snapshot):
+    '''
+    Helper function that return ``snapshot`` (see `InventoryModule.sync`) with
+    its rows packed (see `pack_rows`).
+    '''
+    return dict(snapshot, rows=pack_rows(list(snapshot['rows'].values())))
+
+def unpack_snapshot(snapshot):
+    '''
+    Helper function that return the snapshot packed by `pack_snapshot` (rows of
+    snapshots cached by previous versions are indexed by item id).
+    '''
+    rows = snapshot['rows']
+    rows = unpack_rows(rows if 'fields' in rows else list(rows.values()))
+    return dict(snapshot, rows=dict((str(row[str(ID_FIELD)]), row) for row in rows))
+
+def sync_fields(forcedisplay):
+    '''
+    Helper function that return ``forcedisplay`` with the fields needed by
+    incremental synchronization (id and modification date of the items).
+    '''
+    fields = [str(field) for field in forcedisplay]
+    return forcedisplay + [field
+                           for field in (ID_FIELD, DATE_MOD_FIELD)
+                           if str(field) not in fields]
+
+def sync_watermark(glpi, itemtype, stats=None):
+    '''
+    Helper function that return the modification date from which the items of
+    ``itemtype`` must be retrieved by the next synchronization: the start of
+    the current one on the clock of GLPI (the most recent modification date of
+    the items, retrieved before the rows) minus `SYNC_MARGIN` seconds. So items
+    modified while the rows are retrieved, or whose modification date is older
+    than the one of other rows, are retrieved again the next time.
+    '''
+    # Only the first row (and so the first page of one row) is retrieved.
+    row = next(search_pages(glpi, 1, stats, itemtype=itemtype,
+                            forcedisplay=[DATE_MOD_FIELD], sort=DATE_MOD_FIELD,
+                            order='DESC'), None)
+    date_mod = row.get(str(DATE_MOD_FIELD)) if row else None
+    if not date_mod:
+        return None
+    try:
+        return (datetime.strptime(date_mod, DATE_FORMAT) - timedelta(seconds=SYNC_MARGIN)
+               ).strftime(DATE_FORMAT)
+    except ValueError:
+        return date_mod
+
+def delta_criteria(criteria, date_mod):
+    '''
+    Helper function that return the criteria for searching the items matching
+    ``criteria`` and modified since ``date_mod``. As GLPI dates have a precision
+    of one second, items modified during this second are searched again.
+    '''
+    if date_mod is None:
+        return criteria
+    try:
+        date_mod = (datetime.strptime(date_mod, DATE_FORMAT) - timedelta(seconds=1)
+                   ).strftime(DATE_FORMAT)
+    except ValueError:
+        pass
+
+    # Criteria are nested for not mixing the new criterion with their links.
+    delta = [{'link': 'AND', 'field': DATE_MOD_FIELD,
+              'searchtype': 'morethan', 'value': date_mod}]
+    return ([{'criteria': criteria}] if criteria else []) + delta
+
+def text_search_regex(value):
+    '''
+    Helper function that convert the value of a GLPI text search (`contains`
+    search type) to a compiled regular expression. Like GLPI, the search is
+    case insensitive, ``^`` and ``$`` anchor the value at the start and the
+    end of the field, ``^`` alone match non empty fields and ``NULL`` (or an
+    empty value) match empty fields.
+    '''
+    value = str(value).strip()
+    if value in ('', '^$', '$', 'NULL', 'null'):
+        return re.compile(r'^$')
+    if value == '^':
+        return re.compile(r'.')
+
+    start, end = value.startswith('^'), value.endswith('$')
+    value = value[1 if start else 0:-1 if end else None]
+    return re.compile(
+        '{:s}{:s}{:s}'.format('^' if start else '', re.escape(value), '$' if end else ''),
+        re.IGNORECASE
+    )
+
+def compile_criterion(criterion):
+    '''
+    Helper function that return a function checking whether an entry of the
+    data returned by the API match ``criterion``. Multi-valued fields match
+    when one of their values match.
+    '''
+    field = str(criterion['field'])
+    searchtype = criterion.get('searchtype', 'contains')
+    if searchtype in ('contains', 'notcontains'):
+        regex = text_search_regex(criterion['value'])
+        test = lambda value: regex.search(value) is not None
+    else:
+        expected = to_native(criterion['value']).lower()
+        test = lambda value: value.lower() == expected
+    negate = searchtype.startswith('not')
+
+    def match(entry):
+        values = entry.get(field)
+        if not isinstance(values, list):
+            values = [values]
+        return any(test('' if value is None else to_native(value))
+                   for value in values) != negate
+    return match
+
+def compile_criteria(criteria):
+    '''
+    Helper function that return a function checking whether an entry of the
+    data returned by the API match GLPI search ``criteria``. Like in the SQL
+    request generated by GLPI, `AND` links take precedence over `OR` links and
+    the link of the first criterion is ignored (except for the negation).
+    '''
+    # Criteria are converted to a disjunction of conjunctions of matching
+    # functions (with their negation).
+    terms = []
+    for idx, criterion in enumerate(criteria):
+        link = criterion.get('link', 'AND').upper()
+        match = (compile_criteria(criterion['criteria'])
+                 if 'criteria' in criterion
+                 else compile_criterion(criterion))
+        if idx == 0 or link.startswith('OR'):
+            terms.append([])
+        terms[-1].append((match, link.endswith('NOT')))
+
+    if not terms:
+        return lambda entry: True
+    return lambda entry: any(all(match(entry) != negate for match, negate in term)
+                             for term in terms)
+
+def is_local_criteria(criteria, multivalued, fields=None):
+    '''
+    Helper function that check whether ``criteria`` can be evaluated locally
+    on data containing ``fields`` (which are fields id; any field if not set).
+    As `equals` search type compare ids for dropdowns, numeric values are not
+    evaluated locally. Criteria on ``multivalued`` fields (see
+    `SearchOptions.multivalued`) are not evaluated locally either: GLPI only
+    keeps the joined rows matching them, which changes the values returned
+    for the other fields of the joined tables. When ``multivalued`` is None
+    (unknown), no criteria is evaluated locally.
+    '''
+    if multivalued is None:
+        return False
+    for criterion in criteria:
+        if 'criteria' in criterion:
+            if not is_local_criteria(criterion['criteria'], multivalued, fields):
+                return False
+        elif (criterion.get('meta')
+                or not re.match(r'^\d+$', str(criterion.get('field')))
+                or str(criterion.get('field')) in multivalued
+                or (fields is not None and str(criterion.get('field')) not in fields)
+                or criterion.get('searchtype', 'contains') not in LOCAL_SEARCHTYPES
+                or (criterion.get('searchtype', 'contains').endswith('equals')
+                    and re.match(r'^\d+$', str(criterion.get('value'))))):
+            return False
+    return True
+
+def criteria_fields(criteria):
+    '''
+    Helper function that return the fields used by ``criteria``.
+    '''
+    fields = []
+    for criterion in criteria:
+        fields.extend(criteria_fields(criterion['criteria'])
+                      if 'criteria' in criterion
+                      else [criterion['field']])
+    return fields
+
+def local_criteria(group_conf, base_conf):
+    '''
+    Helper function that return the criteria to evaluate on the data of the
+    search of ``base_conf`` for generating the data of ``group_conf`` (both
+    being merged configurations), or None if the data of the group is not
+    a subset of the data of the search.
+
+    Both must have the same item type and metacriteria and the criteria of
+    ``base_conf`` must end the criteria of ``group_conf``. The first criteria
+    (ie: the own criteria of a child group) must be linked with `AND` to each
+    other and to the other criteria. When the criteria of ``base_conf`` are
+    also only linked with `AND`, only the first criteria need to be evaluated.
+    '''
+    nb_criteria = len(group_conf['criteria']) - len(base_conf['criteria'])
+    if (nb_criteria < 0
+            or group_conf['itemtype'] != base_conf['itemtype']
+            or group_conf['metacriteria'] != base_conf['metacriteria']
+            or group_conf['criteria'][nb_criteria:] != base_conf['criteria']):
+        return None
+
+    # Links of the criteria (except the first one which is ignored).
+    links = [criterion.get('link', 'AND').upper()
+             for criterion in group_conf['criteria'][1:]]
+    if not all(link in ('AND', 'AND NOT') for link in links[:nb_criteria]):
+        return None
+    if all(link in ('AND', 'AND NOT') for link in links[nb_criteria:]):
+        return group_conf['criteria'][:nb_criteria]
+    return group_conf['criteria']
 
 def merge_parents_conf(group_conf, parents_conf):
     '''
@@ -57,13 +724,113 @@ def merge_parents_conf(group_conf, parents_conf):
     group_conf['forcedisplay'] = group_conf.pop('fields', [])
     group_conf['forcedisplay'].extend(parents_conf.get('forcedisplay', []))
 
-    # Merge vars and hostvars parameters (set to an empty dict if not defined).
+    # Merge vars and hostvars parameters (set to an empty dict if not defined).
     for param in ('vars', 'hostvars'):
         group_conf[param] = group_conf.get(param, {})
         group_conf[param].update(parents_conf.get(param, {}))
 
-class InventoryModule(BaseInventoryPlugin):
-    NAME = 'unistra.glpi.glpi'
+    # Merge related items (set to an empty list if not defined).
+    group_conf['expand'] = group_conf.get('expand', [])
+    group_conf['expand'].extend(name for name in parents_conf.get('expand', [])
+                                if name not in group_conf['expand'])
+
+def expression_paths(expression):
+    '''
+    Helper function that return the paths of the variables used by a Jinja
+    ``expression`` (tuples like ``('glpi', 'os_name')`` for ``glpi.os_name``),
+    or None if its result does not only depend on them (functions calls,
+    random filters, ...) or if it can't be parsed.
+    '''
+    paths = set()
+    def visit(node):
+        # Follow attributes and constant items up to the variable.
+        path = []
+        while (isinstance(node, nodes.Getattr)
+               or isinstance(node, nodes.Getitem) and isinstance(node.arg, nodes.Const)):
+            path.insert(0, node.attr if isinstance(node, nodes.Getattr) else node.arg.value)
+            node = node.node
+        if isinstance(node, nodes.Name):
+            paths.add((node.name,) + tuple(path))
+            return True
+        if ((isinstance(node, nodes.Call) and isinstance(node.node, nodes.Name))
+                or (isinstance(node, nodes.Filter)
+                    and node.name.split('.')[-1] in RANDOM_FILTERS)):
+            return False
+        return all(visit(child) for child in node.iter_child_nodes())
+
+    try:
+        template = jinja_env.parse('{{ ' + str(expression) + ' }}')
+    except Exception:
+        return None
+    return paths if visit(template) else None
+
+def variables_key(paths, variables):
+    '''
+    Helper function that return a key identifying the values of the variables
+    at ``paths`` (see `expression_paths`) in ``variables``.
+    '''
+    key = []
+    for path in sorted(paths, key=str):
+        value = variables
+        for name in path:
+            if not isinstance(value, Mapping):
+                break
+            if name not in value:
+                value = KeyError
+                break
+            value = value[name]
+        key.append(repr(value) if value is KeyError
+                   else json.dumps(value, sort_keys=True, default=repr))
+    return tuple(key)
+
+class MemoizedTemplar(object):
+    '''
+    Proxy of the templar of the plugin memoizing the results of the evaluation
+    of the expressions and conditionals of `compose`, `groups` and
+    `keyed_groups` options by the values of the variables they use, as each
+    evaluation compiles the expression again. Hosts with the same values (like
+    the same operating system) reuse the result of the first one. Other
+    attributes are the ones of the templar.
+    '''
+
+    def __init__(self, templar):
+        self._templar = templar
+        self._variables = {}
+        self._paths = {}
+        self._results = {}
+
+    def __getattr__(self, name):
+        return getattr(self._templar, name)
+
+    @property
+    def available_variables(self):
+        return self._variables
+
+    @available_variables.setter
+    def available_variables(self, variables):
+        self._variables = self._templar.available_variables = variables
+
+    def _evaluate(self, method, expression, *args, **kwargs):
+        key = (method, str(expression))
+        if key not in self._paths:
+            self._paths[key] = expression_paths(expression)
+        paths = self._paths[key]
+        if paths is None or args or kwargs:
+            return getattr(self._templar, method)(expression, *args, **kwargs)
+
+        key += variables_key(paths, self._variables)
+        if key not in self._results:
+            self._results[key] = getattr(self._templar, method)(expression)
+        return self._results[key]
+
+    def evaluate_expression(self, expression, *args, **kwargs):
+        return self._evaluate('evaluate_expression', expression, *args, **kwargs)
+
+    def evaluate_conditional(self, conditional, *args, **kwargs):
+        return self._evaluate('evaluate_conditional', conditional, *args, **kwargs)
+
+class InventoryModule(BaseInventoryPlugin, Cacheable, Constructable):
+    NAME = 'unistra.glpi.inv'
 
     def verify_file(self, path):
         ''' return true/false if this is possibly a valid file for this plugin to consume '''
@@ -77,60 +844,602 @@ class InventoryModule(BaseInventoryPlugin):
     def parse(self, inventory, loader, path, cache=True):
         super(InventoryModule, self).parse(inventory, loader, path, cache)
         config = self._read_config_data(path)
+        started = time.perf_counter()
+        self.init_stats()
+        # Hosts generated by the groups, in order (keys of a dictionary).
+        self.generated_hosts = {}
 
-        glpi_url = config.get('glpi_url', os.environ.get('GLPI_URL'))
-        glpi_apptoken = config.get('glpi_apptoken', os.environ.get('GLPI_APPTOKEN'))
-        glpi_usertoken = config.get('glpi_usertoken', os.environ.get('GLPI_USERTOKEN'))
-        glpi_username = config.get('glpi_username', os.environ.get('GLPI_USERNAME'))
-        glpi_password = config.get('glpi_password', os.environ.get('GLPI_PASSWORD'))
-        glpi_verify_certs = config.get(
-            'glpi_verify_certs',
-            os.environ.get('GLPI_VERIFY_CERTS', 'True').lower() not in ('false', '0')
-        )
-        glpi_use_headers = config.get(
-            'glpi_use_headers',
-            os.environ.get('GLPI_USE_HEADERS', 'True').lower() not in ('false', '0')
-        )
-
-        if glpi_url is None:
-            raise AnsibleError('GLPI url not provided')
-
-        if glpi_apptoken is None:
-            raise AnsibleError('GLPI application token not provided')
-
-        if glpi_usertoken is not None:
-            # Force str for vaulted string
-            glpi_auth = str(glpi_usertoken)
+        sources = self.get_option('sources')
+        if sources:
+            self.federate(config, sources, self.get_cache_key(path), cache)
         else:
-            if glpi_username is None or glpi_password is None:
-                raise AnsibleError('GLPI auth invalid: usertoken or username/password required ')
-            # Force str for vaulted strings
-            glpi_auth = (str(glpi_username), str(glpi_password))
+            try:
+                self.glpi_params = connection_params(config)
+            except ValueError as err:
+                raise AnsibleError(to_native(err))
+            # Profile and entity activated on the session (see `connect`).
+            self.active_params = {'profile': None, 'entity': None, 'recursive': False}
+            self.generate(config['queries'], self.get_cache_key(path), cache)
 
-        try:
-            # Force str for vaulted strings
-            self.glpi = GLPI(
-                url=str(glpi_url),
-                apptoken=str(glpi_apptoken),
-                auth=glpi_auth,
-                verify_certs=glpi_verify_certs,
-                use_headers=glpi_use_headers
-            )
+        self.construct()
+        self.report_stats(time.perf_counter() - started)
+
+    def init_stats(self):
+        """Initialize the statistics of the generation of the inventory (see
+        `report_stats`)."""
+        self.stats = {'api_calls': 0, 'response_size': 0, 'retries': 0,
+                      'construct_time': 0.0, 'searches': {}, 'groups': {}}
+        self.stats_lock = threading.Lock()
+        self.connect_lock = threading.Lock()
+        # The session is only opened when data need to be retrieved from GLPI
+        # (see `connect`).
+        self.glpi = None
 
+    def generate(self, queries, cache_key, cache=True):
+        """Generate the groups of ``queries`` from GLPI (or the cache, stored in
+        ``cache_key``, when ``cache`` is set).
+        """
+        # Rows of the searches are cached (when 'cache' option is set) so the
+        # inventory can be rebuilt without connecting to GLPI. 'cache' parameter
+        # is unset when the cache must be refreshed (ie: --flush-cache).
+        # In incremental mode, snapshots of the searches are cached instead (see
+        # `sync`).
+        use_cache = self.get_option('cache')
+        incremental = self.get_option('incremental')
+        if incremental:
+            if not use_cache:
+                raise AnsibleError("'incremental' option requires 'cache' option")
+            cache_key += '_snapshots'
+        cached_rows = {}
+        if use_cache and cache:
+            try:
+                cached_rows = self._cache[cache_key]
+            except KeyError:
+                pass
+        self.cached_rows = cached_rows
+        self.rows = {}
+        self.expanded_items = {}
+        self.snapshots = {}
+        # Start of the synchronizations by item type (see `sync_watermark`).
+        self.watermarks = {}
+        self.watermarks_lock = threading.Lock()
+        self.set_groups = {}
+
+        try:
             # Recursively update inventory from configuration. Groups are popped
-            # from config as they are parsed so this loop only pop root groups.
-            self.queries = config['queries']
+            # from config as they are parsed so this loop only pop root groups.
+            # Groups for which data must be retrieved are only registered (with
+            # their merged configuration) as searches are done afterward.
+            self.queries = queries
+            self.retrieved_groups = []
+            self.local_groups = {}
+            self.groups_data = {}
+            self.search_options = SearchOptions(
+                self.connect,
+                self.glpi_params['url'],
+                self.get_option('search_options_cache_dir') or DEFAULT_CACHE_DIR,
+                self.get_option('search_options_cache_ttl')
+            )
             while self.queries:
                 group = list(self.queries.keys())[0]
                 group_conf = self.queries.pop(group)
                 self.update_inventory_from_group(group, group_conf, parents_conf={})
+            self.groups_conf = dict(self.retrieved_groups)
+            if self.get_option('query_planner'):
+                self.plan()
+
+            # Rows of searches are kept when they are needed more than once or
+            # for the caches. Data of groups are kept when other groups are
+            # filtered from them. Otherwise, rows are used as they are retrieved.
+            searches = [self.search_params(group_conf)[0]
+                        for group, group_conf in self.groups_conf.items()
+                        if group not in self.local_groups]
+            keep_all = use_cache or bool(self.get_option('shared_cache_dir'))
+            self.kept_searches = set(search_key
+                                     for search_key in searches
+                                     if keep_all or searches.count(search_key) > 1)
+            self.bases = set(base for base, _ in self.local_groups.values())
+
+            # Retrieve data of all groups (concurrently if needed) and update
+            # inventory in the order of the configuration.
+            if self.get_option('max_workers') > 1:
+                self.fetch([group_conf
+                            for group, group_conf in self.groups_conf.items()
+                            if group not in self.local_groups])
+            for group, group_conf in self.retrieved_groups:
+                self.update_inventory(group, group_conf)
+            self.update_set_groups()
         except GLPIError as err:
             raise AnsibleError('GLPI error: {:s}'.format(to_native(err)))
 
-    def update_inventory_from_group(self, group, group_conf, parents_conf):
+        # Only keep rows of the current searches in the cache (packed as the
+        # classes of compact rows are not serializable).
+        if incremental:
+            self._cache[cache_key] = dict((search_key, pack_snapshot(snapshot))
+                                          for search_key, snapshot in self.snapshots.items())
+        elif use_cache and (self.glpi is not None or set(self.rows) != set(cached_rows)):
+            self._cache[cache_key] = dict((search_key, pack_rows(rows))
+                                          for search_key, rows in self.rows.items())
+
+    def federate(self, config, sources, cache_key, cache=True):
+        """Generate the inventory from each GLPI source of ``sources``. The groups
+        of the configuration are generated concurrently for all sources, each
+        in its own inventory, and these inventories are merged in the order of
+        the sources (see `merge_source`). A source whose inventory is not
+        generated within its `timeout` is skipped.
+        """
+        names = [source.get('name') for source in sources]
+        if not all(isinstance(name, str) and name for name in names):
+            raise AnsibleError("GLPI sources must have a name")
+        duplicates = sorted(set(name for name in names if names.count(name) > 1))
+        if duplicates:
+            raise AnsibleError("GLPI sources names must be unique: '{:s}'"
+                               .format("', '".join(duplicates)))
+
+        # Each source is generated by a shallow copy of the plugin in a daemon
+        # thread, so the process does not wait for a source that timed out.
+        started = time.time()
+        generations = []
+        for source in sources:
+            unknown_params = [param for param in source if param not in SOURCE_PARAMS]
+            if unknown_params:
+                raise AnsibleError("GLPI source '{:s}' has invalid parameters: '{:s}'"
+                                   .format(source['name'], ', '.join(unknown_params)))
+            worker = copy.copy(self)
+            worker.inventory = InventoryData()
+            worker.init_stats()
+            worker.generated_hosts = {}
+            try:
+                # Sources inherit the connection parameters of the configuration.
+                worker.glpi_params = connection_params(ChainMap(source, config))
+            except ValueError as err:
+                raise AnsibleError("GLPI source '{:s}': {:s}".format(source['name'],
+                                                                     to_native(err)))
+            worker.active_params = {'profile': source.get('profile'),
+                                    'entity': source.get('entity'),
+                                    'recursive': bool(source.get('entity_recursive', False))}
+            future = Future()
+            def run(worker=worker, future=future, name=source['name']):
+                try:
+                    worker.generate(copy.deepcopy(config['queries']),
+                                    '{:s}_{:s}'.format(cache_key, name), cache)
+                except Exception as err:
+                    future.set_exception(err)
+                else:
+                    future.set_result(worker)
+            thread = threading.Thread(target=run)
+            thread.daemon = True
+            thread.start()
+            generations.append((source, future))
+
+        # Hosts are owned by the first source generating them.
+        owners = {}
+        for source, future in generations:
+            name, timeout = source['name'], source.get('timeout')
+            try:
+                worker = future.result(None if timeout is None
+                                       else max(0, started + timeout - time.time()))
+            except FutureTimeoutError:
+                display.warning("GLPI source '{:s}' not generated within {}s, its "
+                                "hosts are skipped".format(name, timeout))
+                continue
+            except AnsibleError as err:
+                raise AnsibleError("GLPI source '{:s}': {:s}".format(name, to_native(err)))
+            self.merge_source(name, worker, owners)
+
+    def merge_source(self, name, worker, owners):
+        """Add the groups and the hosts generated from the source ``name`` (in
+        the inventory of ``worker``) to the inventory. Hosts already generated
+        from another source (``owners`` contains the source of each host) are
+        skipped: variables and groups of a host come from one source only.
+        Hosts have their source in `glpi_source` variable.
+        """
+        inventory = worker.inventory
+        for group in inventory.groups.values():
+            self.inventory.add_group(group.name)
+            for var, value in group.vars.items():
+                self.inventory.set_variable(group.name, var, value)
+        for group in inventory.groups.values():
+            for child in group.child_groups:
+                self.inventory.add_child(group.name, child.name)
+
+        skipped = 0
+        for host in worker.generated_hosts:
+            if owners.setdefault(host, name) != name:
+                skipped += 1
+                display.vv("GLPI source '{:s}': host '{:s}' skipped (generated from "
+                           "source '{:s}')".format(name, host, owners[host]))
+                continue
+            self.inventory.add_host(host)
+            self.generated_hosts[host] = None
+            self.inventory.set_variable(host, 'glpi_source', name)
+            for var, value in inventory.hosts[host].vars.items():
+                if var not in ('inventory_file', 'inventory_dir'):
+                    self.inventory.set_variable(host, var, value)
+        for group in inventory.groups.values():
+            for host in group.hosts:
+                if owners.get(host.name) == name:
+                    self.inventory.add_host(host.name, group=group.name)
+
+        for stat in ('api_calls', 'response_size', 'retries'):
+            self.stats[stat] += worker.stats[stat]
+        for stat in ('groups', 'searches'):
+            self.stats[stat].update(('{:s}/{:s}'.format(name, key), value)
+                                    for key, value in worker.stats[stat].items())
+        display.v("GLPI source '{:s}': {:d} hosts ({:d} skipped, generated from "
+                  "another source)".format(name, len(worker.generated_hosts) - skipped,
+                                           skipped))
+
+    def resolve_fields(self, group, group_conf):
+        """Replace, in-place, fields uids by fields ids in the merged
+        configuration ``group_conf`` of the retrieved ``group`` (fields, criteria,
+        metacriteria and templates). Search options are cached so GLPI is only
+        requested when the cache is not valid.
+        """
+        itemtype = group_conf['itemtype']
+        try:
+            group_conf['forcedisplay'] = self.search_options.fields_ids(
+                itemtype, group_conf['forcedisplay'])
+            for param in ('criteria', 'metacriteria'):
+                group_conf[param] = self.search_options.criteria(itemtype, group_conf[param])
+            if isinstance(group_conf['hostname'], str):
+                group_conf['hostname'] = self.search_options.template(
+                    itemtype, group_conf['hostname'])
+            group_conf['hostvars'] = dict(
+                (param, self.search_options.template(itemtype, value)
+                        if isinstance(value, str) else value)
+                for param, value in group_conf['hostvars'].items()
+            )
+        except ValueError as err:
+            raise AnsibleError("group '{:s}': {:s}".format(group, to_native(err)))
+
+    def plan(self):
+        """Merge the searches of the retrieved groups.
+
+        Groups whose search is in the cache are taken from it. First, for each
+        other group, the most general group (ie: with the less criteria) of
+        which the data contains the group's data is searched (see
+        `local_criteria`). If there is one, the group's data will be filtered
+        locally from the data of this group.
+
+        Then, remaining groups sharing the same item type and the end of their
+        criteria are merged into one search using theses common criteria (the
+        criteria shared by most groups being used first).
+
+        Fields needed by the merged groups are added to the searches that are
+        finally done.
+        """
+        nb_searches = len(set(self.search_params(group_conf)[0]
+                              for group_conf in self.groups_conf.values()))
+
+        self.local_groups = {}
+        for idx, (group, group_conf) in enumerate(self.retrieved_groups):
+            # Groups served from the cache are not filtered.
+            if self.is_cached(group_conf):
+                continue
+            multivalued = self.multivalued(group_conf['itemtype'])
+            best = (len(group_conf['criteria']), idx)
+            for base_idx, (base, base_conf) in enumerate(self.retrieved_groups):
+                if (len(base_conf['criteria']), base_idx) >= best:
+                    continue
+                criteria = local_criteria(group_conf, base_conf)
+                if criteria is not None and is_local_criteria(criteria, multivalued):
+                    self.local_groups[group] = (base, criteria)
+                    best = (len(base_conf['criteria']), base_idx)
+
+        # Index remaining groups by the searches (on the end of their criteria)
+        # that could be used for filtering them.
+        shared_searches = {}
+        for group, group_conf in self.retrieved_groups:
+            if group in self.local_groups or self.is_cached(group_conf):
+                continue
+            multivalued = self.multivalued(group_conf['itemtype'])
+            for idx in range(len(group_conf['criteria'])):
+                search_conf = {
+                    'itemtype': group_conf['itemtype'],
+                    'criteria': group_conf['criteria'][idx:],
+                    'metacriteria': group_conf['metacriteria'],
+                    'forcedisplay': []
+                }
+                criteria = local_criteria(group_conf, search_conf)
+                if criteria is not None and is_local_criteria(criteria, multivalued):
+                    search_key, _ = self.search_params(search_conf)
+                    (shared_searches.setdefault(search_key, (search_conf, []))[1]
+                        .append((group, criteria)))
+
+        # Merge groups, the most shared searches first then the most specific.
+        for search_key, (search_conf, groups) in sorted(
+                shared_searches.items(),
+                key=lambda item: (-len(item[1][1]), -len(item[1][0]['criteria']))):
+            groups = [(group, criteria)
+                      for group, criteria in groups
+                      if group not in self.local_groups]
+            if len(groups) < 2:
+                continue
+
+            # A group with exactly theses criteria is used as base, otherwise
+            # a new search is added (identified by its key).
+            base = next((group
+                         for group, _ in groups
+                         if self.groups_conf[group]['criteria'] == search_conf['criteria']),
+                        search_key)
+            self.groups_conf.setdefault(base, search_conf)
+            for group, criteria in groups:
+                if group != base:
+                    self.local_groups[group] = (base, criteria)
+
+        # Add needed fields to the searches that are done (groups may be
+        # filtered from groups that are filtered themselves).
+        searched_bases = {}
+        for group, (base, criteria) in self.local_groups.items():
+            while base in self.local_groups:
+                base = self.local_groups[base][0]
+            searched_bases[group] = base
+            forcedisplay = self.groups_conf[base]['forcedisplay']
+            for field in self.groups_conf[group]['forcedisplay'] + criteria_fields(criteria):
+                if str(field) not in [str(f) for f in forcedisplay]:
+                    forcedisplay.append(field)
+
+        searches = [(base, self.search_params(base_conf))
+                    for base, base_conf in self.groups_conf.items()
+                    if base not in self.local_groups]
+        retrieved_groups = [group for group, _ in self.retrieved_groups]
+        for base, (search_key, _) in searches:
+            merged_groups = [group
+                             for group in retrieved_groups
+                             if searched_bases.get(group) == base]
+            display.vvv('GLPI query planner: search {:s} for groups: {:s}'.format(
+                search_key,
+                ', '.join(([base] if base in retrieved_groups else []) + merged_groups)
+            ))
+        nb_planned = len(set(search_key for _, (search_key, _) in searches))
+        display.v('GLPI query planner: {:d} searches instead of {:d} ({:d} API calls saved)'
+                  .format(nb_planned, nb_searches, nb_searches - nb_planned))
+
+    def connect(self):
+        """Return the GLPI object, opening a session on first call (which may be
+        done by concurrent searches)."""
+        with self.connect_lock:
+            if self.glpi is None:
+                self.scheduler = RequestScheduler(
+                    max_in_flight=self.get_option('max_in_flight'),
+                    rate_limit=self.get_option('rate_limit'),
+                    retries=self.get_option('retries'),
+                    backoff=self.get_option('retry_backoff'),
+                    timeout=self.get_option('request_timeout'),
+                    on_retry=self.count_retry
+                )
+                # Sessions whose profile or entity are changed are not reused.
+                active = self.active_params
+                switched = active['profile'] is not None or active['entity'] is not None
+                glpi = glpi_client(session_cache_dir=(None if switched else
+                                                      self.get_option('session_cache_dir')),
+                                   scheduler=self.scheduler, **self.glpi_params)
+                glpi.session.hooks['response'].append(self.count_response)
+                if active['profile'] is not None:
+                    glpi.set_active_profile(active['profile'])
+                if active['entity'] is not None:
+                    glpi.set_active_entities(active['entity'], active['recursive'])
+                max_workers = self.get_option('max_workers')
+                if max_workers > 1:
+                    # Allow as many connections to GLPI as threads.
+                    glpi.session.mount(glpi.url,
+                                       self.scheduler.adapter(pool_maxsize=max_workers))
+                self.glpi = glpi
+        return self.glpi
+
+    def count_response(self, response, **kwargs):
+        """Hook of the HTTP session counting API requests and the size of the
+        responses (in total and for the search in progress in the thread)."""
+        size = len(response.content)
+        search_stats = getattr(current_search, 'stats', None)
+        with self.stats_lock:
+            self.stats['api_calls'] += 1
+            self.stats['response_size'] += size
+            if search_stats is not None:
+                search_stats['response_size'] += size
+
+    def count_retry(self, request, result):
+        """Count the retries of requests (in total and for the search in progress
+        in the thread), ``result`` being the response or the exception of the
+        failed request."""
+        search_stats = getattr(current_search, 'stats', None)
+        with self.stats_lock:
+            self.stats['retries'] += 1
+            if search_stats is not None:
+                search_stats['retries'] += 1
+        display.vvv('GLPI request {:s} {:s} failed ({:s}), retrying'.format(
+            request.method, request.url.split('?')[0],
+            str(result.status_code) if hasattr(result, 'status_code') else str(result)))
+
+    def search_stats(self, search_key):
+        """Return the statistics of the search ``search_key``."""
+        with self.stats_lock:
+            return self.stats['searches'].setdefault(search_key, {
+                'requests': 0,
+                'search_time': 0.0,
+                'response_size': 0,
+                'retries': 0,
+                'rows': 0,
+                'cached': False,
+                'shared': False
+            })
+
+    def search_params(self, group_conf):
+        """Return the key identifying the GLPI search generated from ``group_conf``
+        and the parameters of this search.
+        """
+        search_params = {
+            'itemtype': group_conf['itemtype'],
+            'forcedisplay': group_conf['forcedisplay'],
+            'criteria': group_conf['criteria'],
+            'metacriteria': group_conf['metacriteria']
+        }
+        return json.dumps(search_params, sort_keys=True), search_params
+
+    def fetch(self, groups_conf):
+        """Retrieve the rows of the searches generated from ``groups_conf``.
+        Rows are taken from the cache if a search has already been done and
+        GLPI is only requested for the others (or, in incremental mode, cached
+        snapshots are synchronized). When `max_workers` option is greater than
+        one, theses searches are run concurrently. When `shared_cache_dir`
+        option is set, results are shared with concurrent processes (see
+        `share`). Rows are kept as compact rows (see `compact_rows`).
+        """
+        incremental = self.get_option('incremental')
+        searches = {}
+        for group_conf in groups_conf:
+            search_key, search_params = self.search_params(group_conf)
+            if search_key in self.rows:
+                continue
+            if search_key in self.cached_rows and not incremental:
+                self.rows[search_key] = unpack_rows(self.cached_rows[search_key])
+                self.search_stats(search_key)['cached'] = True
+            else:
+                searches[search_key] = search_params
+        if not searches:
+            return
+
+        # The session is only opened when a search is not shared by another
+        # process.
+        page_size = self.get_option('page_size')
+        def search(search_key):
+            stats = self.search_stats(search_key)
+            if incremental:
+                def sync():
+                    snapshot = self.cached_rows.get(search_key)
+                    return self.sync(self.connect(), searches[search_key],
+                                     unpack_snapshot(snapshot) if snapshot else None, stats)
+                snapshot = self.shared(search_key, sync, pack_snapshot, unpack_snapshot)
+                self.snapshots[search_key] = snapshot
+                return list(snapshot['rows'].values())
+            return self.shared(
+                search_key,
+                lambda: compact_rows(search_pages(self.connect(), page_size, stats,
+                                                  **searches[search_key])),
+                pack_rows, unpack_rows
+            )
+
+        max_workers = min(self.get_option('max_workers'), len(searches))
+        if max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(search, searches.keys()))
+        else:
+            results = [search(search_key) for search_key in searches.keys()]
+        self.rows.update(zip(searches.keys(), results))
+
+    def shared(self, search_key, fetch, pack, unpack):
+        """Return the result of ``fetch`` function for the search ``search_key``,
+        shared with concurrent processes (through `shared_cache_dir`, packed by
+        ``pack`` and unpacked by ``unpack``) when `shared_cache_dir` option is
+        set."""
+        shared_cache_dir = self.get_option('shared_cache_dir')
+        if not shared_cache_dir:
+            return fetch()
+        # Results depend on the GLPI platform, the credentials (rights of the
+        # user, profile and entity) and the mode (snapshots are shared in
+        # incremental mode).
+        key = json.dumps([self.glpi_params['url'], self.glpi_params['apptoken'],
+                          self.glpi_params['auth'], self.active_params,
+                          self.get_option('incremental'), search_key])
+        max_wait = self.get_option('shared_cache_max_wait')
+        try:
+            result, shared = share(shared_cache_dir, self.get_option('shared_cache_ttl'),
+                                   key, fetch, pack, max_wait)
+        except LockTimeout:
+            display.warning('GLPI shared cache: result not available after {:d}s, '
+                            'searching GLPI'.format(max_wait))
+            return fetch()
+        if not shared:
+            return result
+        self.search_stats(search_key)['shared'] = True
+        return unpack(result)
+
+    def sync(self, glpi, search_params, snapshot=None, stats=None):
+        """Synchronize and return the ``snapshot`` of the rows of the search
+        ``search_params`` (requests being added to ``stats``).
+
+        A snapshot is a dictionary containing the rows indexed by item id
+        (`rows`), the modification date from which the items are retrieved
+        by the next synchronization (`date_mod`, see `sync_watermark`; it is
+        retrieved once by item type) and the times of the last full refresh
+        (`refreshed`) and of the last sweep (`swept`). Only the items modified
+        since the last synchronization are retrieved and merged into the
+        snapshot. Every `sweep_interval` seconds, only the ids of the items of
+        the search are retrieved for removing the others (deleted, moved to the
+        trash or no longer matching the criteria). All rows are retrieved again
+        when there is no snapshot, when it is older than `full_refresh_interval`
+        seconds or when the sweep finds items missing from the snapshot.
+        """
+        page_size = self.get_option('page_size')
+        now = time.time()
+        search_params = dict(search_params,
+                             forcedisplay=sync_fields(search_params['forcedisplay']))
+        id_field = str(ID_FIELD)
+
+        # The watermark is searched outside of the lock so concurrent searches
+        # are not serialized behind it (each search uses the watermark taken
+        # before its own rows).
+        itemtype = search_params['itemtype']
+        with self.watermarks_lock:
+            searched = itemtype in self.watermarks
+            date_mod = self.watermarks.get(itemtype)
+        if not searched:
+            date_mod = sync_watermark(glpi, itemtype, stats)
+            with self.watermarks_lock:
+                self.watermarks.setdefault(itemtype, date_mod)
+
+        if (snapshot is None
+                or now - snapshot['refreshed'] >= self.get_option('full_refresh_interval')):
+            rows = compact_rows(search_pages(glpi, page_size, stats, **search_params))
+            display.vv('GLPI incremental sync: {:d} rows retrieved for search {:s}'
+                       .format(len(rows), json.dumps(search_params, sort_keys=True)))
+            return {'rows': dict((str(row[id_field]), row) for row in rows),
+                    'date_mod': date_mod,
+                    'refreshed': now,
+                    'swept': now}
+
+        rows = compact_rows(search_pages(
+            glpi, page_size, stats,
+            **dict(search_params,
+                   criteria=delta_criteria(search_params['criteria'], snapshot['date_mod']))
+        ))
+        snapshot['rows'].update((str(row[id_field]), row) for row in rows)
+        snapshot['date_mod'] = date_mod
+
+        removed = []
+        if now - snapshot['swept'] >= self.get_option('sweep_interval'):
+            ids = set(str(row[id_field])
+                      for row in search_pages(glpi, page_size, stats,
+                                              **dict(search_params, forcedisplay=[ID_FIELD])))
+            if ids - set(snapshot['rows']):
+                return self.sync(glpi, search_params, stats=stats)
+            removed = set(snapshot['rows']) - ids
+            for item_id in removed:
+                del snapshot['rows'][item_id]
+            snapshot['swept'] = now
+        display.vv('GLPI incremental sync: {:d} rows updated and {:d} removed for search {:s}'
+                   .format(len(rows), len(removed), json.dumps(search_params, sort_keys=True)))
+        return snapshot
+
+    def search(self, group_conf):
+        """Return the rows of the GLPI search generated from ``group_conf``. If
+        the rows don't need to be kept, an iterator on the rows (retrieved page
+        by page) is returned.
+        """
+        search_key, search_params = self.search_params(group_conf)
+        if search_key not in self.rows:
+            if search_key not in self.kept_searches and search_key not in self.cached_rows:
+                return search_pages(self.connect(), self.get_option('page_size'),
+                                    self.search_stats(search_key), **search_params)
+            self.fetch([group_conf])
+        return self.rows[search_key]
+
+    def update_inventory_from_group(self, group, group_conf, parents_conf, parent=None):
         """Recursively update ``inventory`` with group ``group`` and self.queries
         ``group_conf``. ``parents_conf`` contains the parameters (`criteria`,
-        `hostvars`, ...) merged from parents of the current group.
+        `hostvars`, ...) merged from parents of the current group and ``parent``
+        is the name of the parent group.
 
         ``group_conf`` is a structure (ie: a dictionary) containing theses parameters:
 
@@ -150,6 +1459,10 @@ class InventoryModule(BaseInventoryPlugin):
         *hostname* and *hostvars* are generated from string in which fields number,
         prefixed by a dollar, are replaced by the corresponding values from retrieve
         data.
+
+        Groups with a `union`, `intersection` or `difference` parameter are
+        only registered, their hosts being computed once all groups are
+        generated (see `update_set_groups`).
         """
         # Check input configuration.
         unknow_params = [param for param in group_conf if param not in GROUP_PARAMS]
@@ -159,6 +1472,11 @@ class InventoryModule(BaseInventoryPlugin):
                 .format(group, ', '.join(unknow_params))
             )
 
+        operations = [param for param in SET_OPERATIONS if param in group_conf]
+        if operations:
+            self.register_set_group(group, group_conf, operations)
+            return
+
         # Get children list.
         children = group_conf.pop('children', [])
         if children:
@@ -175,55 +1493,387 @@ class InventoryModule(BaseInventoryPlugin):
             ]
 
         # Data are retrieved when there is no children or when 'retrieve'
-        # parameter is set.
+        # parameter is set. Ensure we have at least an item type.
         retrieve = True if not children else group_conf.get('retrieve', False)
         if retrieve:
-            self.update_inventory(group, group_conf)
+            if not group_conf.get('itemtype', None):
+                raise AnsibleError(
+                    "group '{:s}' has no itemtype defined when calling API"
+                    .format(group)
+                )
+            unknown_expansions = [name for name in group_conf['expand']
+                                  if name not in EXPANSIONS]
+            if unknown_expansions:
+                raise AnsibleError(
+                    "group '{:s}' has invalid expansions: '{:s}'"
+                    .format(group, ', '.join(unknown_expansions))
+                )
+            self.resolve_fields(group, group_conf)
+            # Related items are retrieved by item id.
+            if (group_conf['expand']
+                    and str(ID_FIELD) not in [str(field)
+                                              for field in group_conf['forcedisplay']]):
+                group_conf['forcedisplay'].append(ID_FIELD)
+            # The group is added now so groups are in the order of the
+            # configuration whatever the order searches end.
+            self.inventory.add_group(group)
+            self.retrieved_groups.append((group, group_conf))
+
+            # When the parent has been retrieved, data may be generated by
+            # filtering parent's data if the group does not need other fields.
+            if self.get_option('local_filtering') and parents_conf.get('retrieve', False):
+                fields = set(str(field) for field in parents_conf['forcedisplay'])
+                criteria = local_criteria(group_conf, parents_conf)
+                if (criteria is not None
+                        and set(str(field) for field in group_conf['forcedisplay']) <= fields
+                        and not self.is_cached(group_conf)
+                        and is_local_criteria(criteria,
+                                              self.multivalued(group_conf['itemtype']),
+                                              fields)):
+                    self.local_groups[group] = (parent, criteria)
 
         # For each children, pop child configuration from config and recursively
         # update inventory from child.
         for child in children:
             child_conf = self.queries.pop(child)
-            self.update_inventory_from_group(child, child_conf, group_conf)
+            self.update_inventory_from_group(child, child_conf, group_conf, group)
+
+    def is_cached(self, group_conf):
+        """Return whether the search of ``group_conf`` is served from the cache,
+        in which case its data is not filtered locally from another search."""
+        return (not self.get_option('incremental')
+                and self.search_params(group_conf)[0] in self.cached_rows)
+
+    def multivalued(self, itemtype):
+        """Return the fields of ``itemtype`` that may have several values (see
+        `SearchOptions.multivalued`), or None when they are unknown. While the
+        inventory may be rebuilt from the cache, GLPI is not requested for
+        them (cached search options are used, even expired)."""
+        connect = (self.glpi is not None or not self.cached_rows
+                   or self.get_option('incremental'))
+        return self.search_options.multivalued(itemtype, connect)
+
+    def register_set_group(self, group, group_conf, operations):
+        """Check and register the group ``group`` whose hosts are computed by
+        the set ``operations`` of ``group_conf`` (only one is allowed) from the
+        hosts of its member groups, and set its variables."""
+        if len(operations) > 1:
+            raise AnsibleError("group '{:s}' has several set operations: '{:s}'"
+                               .format(group, ', '.join(operations)))
+        operation = operations[0]
+        invalid_params = [param for param in group_conf
+                          if param != operation and param not in SET_GROUP_PARAMS]
+        if invalid_params:
+            raise AnsibleError(
+                "group '{:s}' has invalid parameters for a '{:s}' group: '{:s}'"
+                .format(group, operation, ', '.join(invalid_params))
+            )
+        members = group_conf[operation]
+        if (not isinstance(members, list) or not members
+                or not all(isinstance(member, str) for member in members)):
+            raise AnsibleError("group '{:s}' must have a list of groups in '{:s}'"
+                               .format(group, operation))
+
+        self.inventory.add_group(group)
+        for var, value in group_conf.get('vars', {}).items():
+            self.inventory.set_variable(group, var, value)
+        self.set_groups[group] = (operation, members)
+
+    def update_set_groups(self):
+        """Add to the groups having a set operation (`union`, `intersection` or
+        `difference`) the hosts computed from the hosts of their member groups
+        (with the hosts of their children), once all the groups of the
+        configuration are generated. No GLPI search is done and the hosts keep
+        the variables generated by their groups. Members can be other set
+        groups, which are computed first.
+        """
+        updated = set()
+
+        def update(group, dependents):
+            if group in updated:
+                return
+            if group in dependents:
+                raise AnsibleError("group '{:s}' is a member of itself"
+                                   .format(group))
+            started = time.perf_counter()
+            operation, members = self.set_groups[group]
+            for member in members:
+                if member in self.set_groups:
+                    update(member, dependents + (group,))
+                elif member not in self.inventory.groups:
+                    raise AnsibleError("group '{:s}' has an unknown member group: '{:s}'"
+                                       .format(group, member))
+
+            # Hosts are added in the order of their groups.
+            members_hosts = [[host.name for host in self.inventory.groups[member].get_hosts()]
+                             for member in members]
+            if operation == 'union':
+                hosts = dict.fromkeys(host
+                                      for member_hosts in members_hosts
+                                      for host in member_hosts)
+            elif operation == 'intersection':
+                others = [set(member_hosts) for member_hosts in members_hosts[1:]]
+                hosts = [host for host in members_hosts[0]
+                         if all(host in other for other in others)]
+            else:
+                others = set(host for member_hosts in members_hosts[1:] for host in member_hosts)
+                hosts = [host for host in members_hosts[0] if host not in others]
+            for host in hosts:
+                self.inventory.add_host(host, group=group)
+            updated.add(group)
+            display.vvv("GLPI stats: group '{:s}': {:d} hosts, {:s} of '{:s}', total "
+                        "{:.3f}s".format(group, len(hosts), operation, "', '".join(members),
+                                         time.perf_counter() - started))
+
+        for group in self.set_groups:
+            update(group, ())
+
+    def group_data(self, group):
+        """Return the data of ``group``, either from the GLPI search of the group
+        or by filtering the data of the group it depends on. Data is only kept
+        when other groups depend on it.
+        """
+        if group in self.groups_data:
+            return self.groups_data[group]
+
+        if group in self.local_groups:
+            base, criteria = self.local_groups[group]
+            match = compile_criteria(criteria)
+            data = (entry for entry in self.group_data(base) if match(entry))
+        else:
+            data = self.search(self.groups_conf[group])
+
+        if group in self.bases:
+            data = self.groups_data[group] = compact_rows(data)
+        return data
 
     def update_inventory(self, group, group_conf):
         """Update Ansible ``inventory`` with ``group`` based on ``group_conf``
         containing parameters for generating the API request and generating
         hostname, hostvars and vars values.
         """
-        # Ensure we have at least an item type.
-        if not group_conf.get('itemtype', None):
-            raise AnsibleError(
-                "group '{:s}' has no itemtype defined when calling API"
-                .format(group)
-            )
+        # The search of the group is the one of the group its data is filtered
+        # from, if any. The time spent in this search while updating the group
+        # (when rows are used as they are retrieved) is not processing time.
+        started = time.perf_counter()
+        base = group
+        while base in self.local_groups:
+            base = self.local_groups[base][0]
+        search_key, _ = self.search_params(self.groups_conf[base])
+        search_stats = self.search_stats(search_key)
+        search_time = search_stats['search_time']
+
+        # Retrieve data using GLPI API (or the cache) or filter the data of
+        # another group.
+        data = self.group_data(group)
 
-        # Retrieve data using GLPI API.
-        data = self.glpi.search(
-            itemtype=group_conf['itemtype'],
-            forcedisplay=group_conf['forcedisplay'],
-            criteria=group_conf['criteria'],
-            metacriteria=group_conf['metacriteria'],
-            range='0-9999'
-        )
+        # Templates of hostname and hostvars are compiled once for all entries.
+        hostname = compile_template(group_conf['hostname'])
+        hostvars = [(param, compile_template(value))
+                    for param, value in group_conf['hostvars'].items()]
 
         # Retrieve group's hosts and manage hostvars.
         self.inventory.add_group(group)
         hosts = []
-        for entry in data:
-            # Generate hostvars from the current entry.
-            entry_hostvars = {param: replace_fields_values(value, entry)
-                              for param, value in group_conf['hostvars'].items()}
+        nb_rows = nb_hosts = 0
+        render_time = 0.0
+        expand_stats = {'requests': 0, 'items': 0, 'time': 0.0}
+        for entry, related_items in self.expand(group_conf, data, expand_stats):
+            nb_rows += 1
+            rendering = time.perf_counter()
+            # Generate hostvars from the current entry (related items don't
+            # override them).
+            entry_hostvars = {param: render_template(template, entry)
+                              for param, template in hostvars}
+            if related_items:
+                for name, value in related_items.items():
+                    entry_hostvars.setdefault(name, value)
 
             # Sometime returned host can be a list of host (as when retrieving
             # virtual machines). For preventing code redundancy, manage everything
-            # as list.
-            host = replace_fields_values(group_conf['hostname'], entry)
+            # as list.
+            host = render_template(hostname, entry)
+            render_time += time.perf_counter() - rendering
             if not isinstance(host, list):
                 host = [host]
-            # Add host to the list of hosts for the group add update hostvars
-            # of the host in the inventory.
+            # Add host to the list of hosts for the group add update hostvars
+            # of the host in the inventory.
             for h in host:
                 #hosts.append(h.lower()) # Force host to be lowercase
+                nb_hosts += 1
                 self.inventory.add_host(h, group=group)
+                self.generated_hosts[h] = None
                 self.inventory.set_variable(h, 'glpi', entry_hostvars)
+
+        # The statistics of the search are reported by the first group using it.
+        # Groups filtered from a search added by the query planner have no base
+        # group.
+        filtered_from = self.local_groups.get(group, (None, None))[0]
+        group_stats = {
+            'search': search_key,
+            'filtered_from': filtered_from if filtered_from in self.inventory.groups else None,
+            'rows': nb_rows,
+            'hosts': nb_hosts,
+            'render_time': render_time,
+            'expand_requests': expand_stats['requests'],
+            'expand_time': expand_stats['time'],
+            'processing_time': (time.perf_counter() - started
+                                - (search_stats['search_time'] - search_time)),
+        }
+        if not search_stats.get('reported', False):
+            search_stats['reported'] = True
+            group_stats.update((stat, search_stats[stat])
+                               for stat in ('requests', 'search_time', 'response_size',
+                                            'retries'))
+        else:
+            group_stats.update(requests=0, search_time=0.0, response_size=0, retries=0)
+        group_stats['time'] = group_stats['search_time'] + group_stats['processing_time']
+        self.stats['groups'][group] = group_stats
+        display.vvv(
+            "GLPI stats: group '{:s}': {:d} rows, {:d} hosts, search {:.3f}s "
+            "({:d} requests, {:d} bytes{:s}{:s}){:s}, rendering {:.3f}s, "
+            "total {:.3f}s".format(
+                group, nb_rows, nb_hosts, group_stats['search_time'],
+                group_stats['requests'], group_stats['response_size'],
+                (', {:d} retries'.format(group_stats['retries'])
+                 if group_stats['retries'] else ''),
+                (", filtered from '{:s}'".format(group_stats['filtered_from'])
+                 if group_stats['filtered_from'] else
+                 ', merged search' if filtered_from else
+                 ', cached' if search_stats['cached'] else
+                 ', shared' if search_stats['shared'] else ''),
+                (', related items of {:d} items {:.3f}s ({:d} requests)'.format(
+                    expand_stats['items'], expand_stats['time'], expand_stats['requests'])
+                 if group_conf['expand'] else ''),
+                render_time, group_stats['time']))
+
+    def expand(self, group_conf, data, stats):
+        """Yield the entries of ``data`` with their related items of the `expand`
+        parameter of ``group_conf`` (by expansion name, None when the group
+        has no expansion). Related items are retrieved by getMultipleItems
+        requests of `expand_batch_size` items, up to `expand_workers` requests
+        being sent concurrently, for chunks of entries as they are generated.
+        Items whose related items have already been retrieved for another group
+        are not requested again. Requests, items and time are added to
+        ``stats``.
+        """
+        expand = group_conf['expand']
+        if not expand:
+            for entry in data:
+                yield entry, None
+            return
+
+        itemtype = group_conf['itemtype']
+        expanded_items = self.expanded_items.setdefault((itemtype, tuple(sorted(expand))), {})
+        params = dict(('with_' + name, True) for name in expand)
+        batch_size = self.get_option('expand_batch_size')
+        glpi = self.connect()
+
+        def get_items(items_ids):
+            items = glpi.get_multiple_items(*[{'itemtype': itemtype, 'items_id': item_id}
+                                              for item_id in items_ids],
+                                            **params)
+            # Items that can't be retrieved (deleted, no rights, ...) are
+            # returned as error messages.
+            return [(str(item['id']), dict((name, item.get('_' + name))
+                                           for name in expand))
+                    for item in items
+                    if isinstance(item, dict) and 'id' in item]
+
+        data = iter(data)
+        with ThreadPoolExecutor(max_workers=self.get_option('expand_workers')) as executor:
+            while True:
+                chunk = list(islice(data, batch_size * self.get_option('expand_workers')))
+                if not chunk:
+                    break
+                started = time.perf_counter()
+                items_ids = []
+                for entry in chunk:
+                    item_id = str(entry.get(str(ID_FIELD)))
+                    if item_id not in expanded_items:
+                        # Items are requested once.
+                        expanded_items[item_id] = None
+                        items_ids.append(item_id)
+                batches = [items_ids[start:start + batch_size]
+                           for start in range(0, len(items_ids), batch_size)]
+                for items in executor.map(get_items, batches):
+                    expanded_items.update(items)
+                stats['requests'] += len(batches)
+                stats['items'] += len(items_ids)
+                stats['time'] += time.perf_counter() - started
+                for entry in chunk:
+                    yield entry, (expanded_items[str(entry.get(str(ID_FIELD)))]
+                                  or dict.fromkeys(expand))
+
+    def construct(self):
+        """Set the variables of `compose` option and add the hosts to the groups
+        of `groups` and `keyed_groups` options, from the variables of each host
+        generated by the queries (with the `glpi` variable merged from all its
+        groups). Groups are thus generated from retrieved fields without other
+        GLPI searches.
+        """
+        compose = self.get_option('compose')
+        groups = self.get_option('groups')
+        keyed_groups = self.get_option('keyed_groups')
+        if not (compose or groups or keyed_groups):
+            return
+
+        started = time.perf_counter()
+        strict = self.get_option('strict')
+        templar = self.templar
+        self.templar = MemoizedTemplar(templar)
+        try:
+            for host in self.generated_hosts:
+                hostvars = self.inventory.get_host(host).get_vars()
+                self._set_composite_vars(compose, hostvars, host, strict=strict)
+                self._add_host_to_composed_groups(groups, hostvars, host, strict=strict)
+                self._add_host_to_keyed_groups(keyed_groups, hostvars, host, strict=strict)
+        finally:
+            self.templar = templar
+        self.stats['construct_time'] = time.perf_counter() - started
+
+    def report_stats(self, total_time):
+        """Display the statistics of the generation of the inventory and write
+        them in `stats_file` (see `update_inventory` for the statistics of the
+        groups). The slowest groups are displayed when `profile` option is set.
+        """
+        groups = self.stats['groups']
+        stats = {
+            'time': total_time,
+            'api_calls': self.stats['api_calls'],
+            'response_size': self.stats['response_size'],
+            'retries': self.stats['retries'],
+            'render_time': sum(group['render_time'] for group in groups.values()),
+            'construct_time': self.stats['construct_time'],
+            'hosts': len(self.inventory.hosts),
+            'groups': groups,
+            'searches': dict((search_key, dict((stat, value)
+                                               for stat, value in search_stats.items()
+                                               if stat != 'reported'))
+                             for search_key, search_stats in self.stats['searches'].items()),
+        }
+        display.vvv('GLPI stats: {:d} hosts generated in {:.3f}s ({:d} API requests, '
+                    '{:d} bytes, {:d} retries, templates rendered in {:.3f}s, '
+                    'constructed in {:.3f}s)'.format(
+                        stats['hosts'], total_time, stats['api_calls'],
+                        stats['response_size'], stats['retries'], stats['render_time'],
+                        stats['construct_time']))
+
+        if self.get_option('profile'):
+            # The output of ansible-inventory is on stdout.
+            display.display('GLPI profile: {:.3f}s spent rendering templates of {:d} '
+                            'groups, {:.3f}s in total'.format(stats['render_time'],
+                                                              len(groups), total_time),
+                            stderr=True)
+            for group, group_stats in sorted(groups.items(),
+                                             key=lambda item: -item[1]['time'])[:PROFILE_GROUPS]:
+                display.display("GLPI profile: group '{:s}': {:.3f}s (search {:.3f}s, "
+                                "rendering {:.3f}s, {:d} hosts)".format(
+                                    group, group_stats['time'], group_stats['search_time'],
+                                    group_stats['render_time'], group_stats['hosts']),
+                                stderr=True)
+
+        stats_file = self.get_option('stats_file')
+        if stats_file:
+            with open(stats_file, 'w') as fhandler:
+                json.dump(stats, fhandler, indent=2, sort_keys=True)
@@ -0,0 +1,334 @@
+# coding: utf-8
+
+import os
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from ansible.plugins.lookup import LookupBase
+from ansible.module_utils._text import to_native
+from ansible.errors import AnsibleError
+from ansible.utils.display import Display
+from glpi_api import GLPIError
+from ansible_collections.unistra.glpi.plugins.module_utils.shared_cache import share
+from ansible_collections.unistra.glpi.plugins.module_utils.session import (
+    glpi_client, connection_params)
+from ansible_collections.unistra.glpi.plugins.module_utils.search import search_pages
+from ansible_collections.unistra.glpi.plugins.module_utils.scheduler import RequestScheduler
+from ansible_collections.unistra.glpi.plugins.module_utils.search_options import (
+    SearchOptions, DEFAULT_CACHE_DIR)
+
+DOCUMENTATION = '''
+    name: glpi
+    short_description: Search GLPI items
+    description:
+        - Return the rows of the GLPI searches of the given item types (the rows
+          of all the searches are concatenated).
+        - Rows are dictionaries whose keys are the fields of I(forcedisplay), as
+          they are given (id or uid), or the ids of the fields returned by GLPI
+          when I(forcedisplay) is not set.
+        - Identical searches (same GLPI platform, credentials, item type, criteria,
+          metacriteria and fields) are done once by process (see I(cache_size)
+          option); concurrent identical searches wait for the result of the first
+          one.
+        - Results are also shared, through files, by the processes (forks) of the
+          same Ansible run so an identical lookup done for many hosts only sends
+          one search to GLPI (see I(shared_cache_dir) option).
+    options:
+        _terms:
+            description: Item types to search.
+            required: true
+        criteria:
+            description:
+                - Criteria of the search. Fields can be referenced by their id or
+                  their uid (like C(Domain.name)).
+            type: list
+            elements: dict
+            default: []
+        metacriteria:
+            description: Metacriteria of the search.
+            type: list
+            elements: dict
+            default: []
+        forcedisplay:
+            description:
+                - Fields (ids or uids) to retrieve. GLPI always returns the default
+                  fields of the item type.
+            type: list
+            default: []
+        glpi_url:
+            description: URL of the GLPI REST API.
+            env:
+                - name: GLPI_URL
+        glpi_apptoken:
+            description: Application token of the API client.
+            env:
+                - name: GLPI_APPTOKEN
+        glpi_usertoken:
+            description: User token (alternatively to username and password).
+            env:
+                - name: GLPI_USERTOKEN
+        glpi_username:
+            description: Username (alternatively to the user token).
+            env:
+                - name: GLPI_USERNAME
+        glpi_password:
+            description: Password (alternatively to the user token).
+            env:
+                - name: GLPI_PASSWORD
+        glpi_verify_certs:
+            description: Whether to check SSL certificates.
+            type: bool
+            default: true
+            env:
+                - name: GLPI_VERIFY_CERTS
+        glpi_use_headers:
+            description: Whether to send authentication parameters as HTTP headers.
+            type: bool
+            default: true
+            env:
+                - name: GLPI_USE_HEADERS
+        session_cache_dir:
+            description:
+                - Directory in which GLPI session tokens are cached (see the
+                  C(unistra.glpi.inv) inventory plugin).
+            type: path
+            env:
+                - name: GLPI_SESSION_CACHE_DIR
+        search_options_cache_dir:
+            description:
+                - Directory in which the search options of the item types (used for
+                  resolving fields uids) are cached.
+            type: path
+            default: ~/.ansible/tmp/glpi-search-options
+            env:
+                - name: GLPI_SEARCH_OPTIONS_CACHE_DIR
+        search_options_cache_ttl:
+            description: Number of seconds the search options of an item type are cached.
+            type: int
+            default: 86400
+        page_size:
+            description: Number of rows retrieved by each request to GLPI.
+            type: int
+            default: 1000
+        max_in_flight:
+            description:
+                - Maximum number of requests sent to GLPI at the same time by the
+                  process (C(0) means no limit).
+            type: int
+            default: 0
+        rate_limit:
+            description:
+                - Maximum number of requests sent to GLPI by second by the process
+                  (C(0) means no limit), adapted when GLPI is overloaded (see the
+                  C(unistra.glpi.inv) inventory plugin).
+            type: float
+            default: 0
+        retries:
+            description:
+                - Number of times a request failing with a server error or a
+                  timeout is sent again.
+            type: int
+            default: 3
+        retry_backoff:
+            description:
+                - Delay, in seconds, before the first retry of a request (doubled
+                  on each retry and randomized).
+            type: float
+            default: 0.5
+        request_timeout:
+            description:
+                - Number of seconds to wait for GLPI to respond to a request
+                  (C(0) means no timeout).
+            type: float
+            default: 0
+        cache_size:
+            description:
+                - Maximum number of search results kept in memory by the process
+                  (least recently used results are dropped first). C(0) disables
+                  the memoization.
+            type: int
+            default: 128
+        shared_cache_dir:
+            description:
+                - Directory in which search results are shared by the processes of
+                  an Ansible run. The first process doing a search holds a lock on
+                  it while the others wait for its result. Results are only
+                  readable by the current user. Empty for disabling this cache.
+            type: str
+            default: ~/.ansible/tmp/glpi-lookup
+            env:
+                - name: GLPI_LOOKUP_CACHE_DIR
+        shared_cache_ttl:
+            description:
+                - Maximum number of seconds a shared result is used. Results are
+                  not shared between runs but a lookup done by the main process
+                  (outside of a task) can reuse the results of a previous run
+                  during this delay.
+            type: int
+            default: 60
+'''
+
+EXAMPLES = '''
+- name: Show the contracts of the current host
+  debug:
+    msg: "{{ lookup('unistra.glpi.glpi', 'Contract',
+                    criteria=[{'field': 'Computer.name', 'searchtype': 'equals',
+                               'value': inventory_hostname_short}],
+                    forcedisplay=['name', 'end_date']) }}"
+
+- name: Show the network ports of the current host
+  debug:
+    msg: "{{ query('unistra.glpi.glpi', 'NetworkPort',
+                   criteria=[{'field': 'items_id', 'searchtype': 'contains',
+                              'value': '^' ~ inventory_hostname_short ~ '$'}],
+                   forcedisplay=['name', 'mac']) }}"
+'''
+
+RETURN = '''
+    _list:
+        description: Rows of the searches.
+        type: list
+        elements: dict
+'''
+
+display = Display()
+
+# Options of the connection to GLPI (see `session.connection_params`).
+CONNECTION_OPTIONS = ('glpi_url', 'glpi_apptoken', 'glpi_usertoken', 'glpi_username',
+                      'glpi_password', 'glpi_verify_certs', 'glpi_use_headers')
+
+# Results of the searches of the current process (least recently used first)
+# and searches in progress, by search key.
+_RESULTS = OrderedDict()
+_PENDING = {}
+_LOCK = threading.Lock()
+
+def memoize(key, cache_size, search):
+    '''
+    Helper function that return the result of ``search`` function for ``key``
+    from the memory of the process. When a search with the same key is already
+    in progress (in another thread), its result is waited for instead of
+    searching again.
+    '''
+    with _LOCK:
+        if key in _RESULTS:
+            _RESULTS.move_to_end(key)
+            return _RESULTS[key]
+        pending = _PENDING.get(key)
+        if pending is None:
+            pending = _PENDING[key] = Future()
+            owner = True
+        else:
+            owner = False
+    if not owner:
+        return pending.result()
+
+    try:
+        result = search()
+    except BaseException as err:
+        with _LOCK:
+            del _PENDING[key]
+        pending.set_exception(err)
+        raise
+    # The result is stored and the search is no longer pending at once, so a
+    # thread arriving meanwhile always finds one of them.
+    with _LOCK:
+        if cache_size > 0:
+            _RESULTS[key] = result
+            while len(_RESULTS) > cache_size:
+                _RESULTS.popitem(last=False)
+        pending.set_result(result)
+        del _PENDING[key]
+    return result
+
+class LookupModule(LookupBase):
+
+    def run(self, terms, variables=None, **kwargs):
+        self.set_options(var_options=variables, direct=kwargs)
+
+        # The session is only opened when a search is not in the caches (see
+        # `connect`).
+        self.glpi = None
+        try:
+            self.glpi_params = connection_params(dict(
+                (option, self.get_option(option)) for option in CONNECTION_OPTIONS
+                if self.get_option(option) is not None))
+        except ValueError as err:
+            raise AnsibleError(to_native(err))
+        self.search_options = SearchOptions(
+            self.connect,
+            self.glpi_params['url'],
+            self.get_option('search_options_cache_dir') or DEFAULT_CACHE_DIR,
+            self.get_option('search_options_cache_ttl')
+        )
+
+        rows = []
+        try:
+            for itemtype in terms:
+                rows.extend(self.lookup(str(itemtype)))
+        except (GLPIError, ValueError) as err:
+            raise AnsibleError('unable to search GLPI: {:s}'.format(to_native(err)))
+        finally:
+            if self.glpi is not None and not self.get_option('session_cache_dir'):
+                self.glpi.kill_session()
+        return rows
+
+    def connect(self):
+        """Return the GLPI object, opening a session on first call."""
+        if self.glpi is None:
+            scheduler = RequestScheduler(max_in_flight=self.get_option('max_in_flight'),
+                                         rate_limit=self.get_option('rate_limit'),
+                                         retries=self.get_option('retries'),
+                                         backoff=self.get_option('retry_backoff'),
+                                         timeout=self.get_option('request_timeout'))
+            self.glpi = glpi_client(session_cache_dir=self.get_option('session_cache_dir'),
+                                    scheduler=scheduler, **self.glpi_params)
+        return self.glpi
+
+    def lookup(self, itemtype):
+        """Return the rows of the search of ``itemtype`` (from the caches when
+        possible)."""
+        forcedisplay = self.get_option('forcedisplay')
+        search_params = {
+            'itemtype': itemtype,
+            'criteria': self.get_option('criteria'),
+            'metacriteria': self.get_option('metacriteria'),
+            'forcedisplay': forcedisplay
+        }
+        # Searches are identified by GLPI platform and credentials (rows depend
+        # on the rights of the user) and by Ansible run for the shared cache (the
+        # parent of forks being the main Ansible process).
+        key = json.dumps([self.glpi_params['url'], self.glpi_params['apptoken'],
+                          self.glpi_params['auth'], search_params], sort_keys=True)
+
+        def search():
+            display.vvv('GLPI lookup: searching {:s}'.format(json.dumps(search_params)))
+            return list(search_pages(
+                self.connect(),
+                self.get_option('page_size'),
+                itemtype=itemtype,
+                criteria=self.search_options.criteria(itemtype, search_params['criteria']),
+                metacriteria=self.search_options.criteria(itemtype,
+                                                          search_params['metacriteria']),
+                forcedisplay=self.search_options.fields_ids(itemtype, forcedisplay)
+            ))
+
+        shared_cache_dir = self.get_option('shared_cache_dir')
+        if shared_cache_dir:
+            shared_key = json.dumps([os.getppid(), key])
+            shared_search = lambda: share(shared_cache_dir,
+                                          self.get_option('shared_cache_ttl'),
+                                          shared_key, search)[0]
+        else:
+            shared_search = search
+        rows = memoize(key, self.get_option('cache_size'), shared_search)
+
+        # Rows are indexed by the fields as they are given.
+        fields = dict((str(field_id), field)
+                      for field_id, field in zip(self.search_options.fields_ids(itemtype,
+                                                                                forcedisplay),
+                                                 forcedisplay))
+        return [dict((fields.get(field_id, field_id), value)
+                     for field_id, value in row.items())
+                for row in rows]
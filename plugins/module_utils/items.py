@@ -0,0 +1,97 @@
+# coding: utf-8
+
+"""Management of GLPI items by batches, shared by the modules of the collection.
+
+Items to add, update or delete are collected by action with the result
+returned for each of them, then:
+
+* the items to update are compared with their current values, retrieved by
+  chunks, and only the fields having another value are updated (items already
+  up to date are not updated),
+* the actions are sent by chunks (GLPI accepts several items by request and
+  returns a result for each one, in order).
+"""
+
+from html import unescape
+
+from ansible.module_utils._text import to_native
+
+# Actions on items (GLPI client method and returned action).
+ACTIONS = {'add': 'added', 'update': 'updated', 'delete': 'deleted'}
+
+# Number of rows retrieved by each search request when resolving items.
+PAGE_SIZE = 1000
+
+
+def values_changes(current, values):
+    """Return the fields of ``values`` having another value in ``current`` (the
+    fields of an item as returned by GLPI). Values are compared as strings
+    (booleans being converted to integers as stored by GLPI)."""
+    def normalize(value):
+        if isinstance(value, bool):
+            value = int(value)
+        return to_native('' if value is None else value)
+    return dict((field, value)
+                for field, value in values.items()
+                if field != 'id' and normalize(current.get(field)) != normalize(value))
+
+def search_value(value):
+    """Normalize a value for comparing it like GLPI text search does (case
+    insensitive and ignoring HTML entities in returned data)."""
+    return unescape(to_native('' if value is None else value)).strip().lower()
+
+def changed_updates(glpi, itemtype, updates, chunk_size, diff_mode=False):
+    """Return the ``updates`` (couples of a result and the values of an item,
+    with its id) of the items having another value for some fields, with only
+    theses fields. Current values are retrieved by chunks of ``chunk_size``
+    items; the action of the results of the items up to date is set to
+    `nothing` and, in diff mode, the diff of the others is set."""
+    changed = []
+    for idx in range(0, len(updates), chunk_size):
+        chunk = updates[idx:idx + chunk_size]
+        currents = glpi.get_multiple_items(*[{'itemtype': itemtype, 'items_id': payload['id']}
+                                             for _, payload in chunk])
+        for (result, payload), current in zip(chunk, currents):
+            changes = values_changes(current, payload)
+            if not changes:
+                result['action'] = 'nothing'
+                continue
+            if diff_mode:
+                result['diff'] = {'before': dict((field, current.get(field)) for field in changes),
+                                  'after': changes}
+            changed.append((result, dict(changes, id=payload['id'])))
+    return changed
+
+def apply_actions(glpi, itemtype, actions, chunk_size, check_mode=False, purge=False):
+    """Send the ``actions`` (couples of a result and a payload by action) by
+    chunks of ``chunk_size`` items and update the results (action, id of added
+    items and error message). Deleted items are purged instead of being moved
+    to the trash when ``purge`` is set. In check mode, actions are considered
+    successful."""
+    for action, action_items in actions.items():
+        kwargs = {'force_purge': True} if action == 'delete' and purge else {}
+        for idx in range(0, len(action_items), chunk_size):
+            chunk = action_items[idx:idx + chunk_size]
+            if check_mode:
+                for result, _ in chunk:
+                    result.update(action=ACTIONS[action], changed=True)
+                continue
+            responses = getattr(glpi, action)(itemtype, *[payload for _, payload in chunk],
+                                              **kwargs)
+            for (result, payload), response in zip(chunk, responses):
+                # GLPI returns a list (error code and message) or a string
+                # instead of a dictionary for some errors.
+                if not isinstance(response, dict):
+                    result.update(action=ACTIONS[action], changed=False, failed=True,
+                                  msg=(', '.join(to_native(value) for value in response)
+                                       if isinstance(response, list)
+                                       else to_native(response)))
+                    continue
+                if action == 'add':
+                    item_id = response.get('id')
+                    result['id'] = item_id
+                else:
+                    item_id = response.get(str(payload['id']))
+                result.update(action=ACTIONS[action], changed=bool(item_id))
+                if not item_id:
+                    result.update(failed=True, msg=response.get('message', ''))
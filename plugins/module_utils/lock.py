@@ -0,0 +1,49 @@
+# coding: utf-8
+
+"""Locks on files, for serializing the accesses of concurrent processes (like
+Ansible forks) to files shared by the modules and plugins of the collection."""
+
+import os
+import time
+import errno
+import fcntl
+from contextlib import contextmanager
+
+# Number of seconds between two attempts to acquire a lock with a timeout.
+POLL_INTERVAL = 0.1
+
+
+class LockTimeout(Exception):
+    """Exception raised when a lock is not acquired in time."""
+
+
+@contextmanager
+def file_lock(path, timeout=None):
+    """Lock (exclusively) ``path`` file, creating it and its directory (only
+    accessible by the current user) if needed. When ``timeout`` is set,
+    `LockTimeout` is raised if the lock is not acquired within ``timeout``
+    seconds."""
+    lock_dir = os.path.dirname(path)
+    if lock_dir and not os.path.isdir(lock_dir):
+        os.makedirs(lock_dir, 0o700)
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        if timeout is None:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+        else:
+            deadline = time.time() + timeout
+            while True:
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except (IOError, OSError) as err:
+                    if err.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                if time.time() >= deadline:
+                    raise LockTimeout('{:s} still locked after {:g} seconds'
+                                      .format(path, timeout))
+                time.sleep(POLL_INTERVAL)
+        yield
+    finally:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
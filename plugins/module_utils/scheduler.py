@@ -0,0 +1,175 @@
+# coding: utf-8
+
+"""Scheduling of the requests sent to GLPI, shared by the modules and plugins
+of the collection, for getting throughput without overloading GLPI (or its
+front-end) when it is requested by many threads or processes at the same time.
+
+Requests are sent through a transport adapter of the HTTP session of the GLPI
+client (see `session.glpi_client`) which, for all the requests of a process:
+
+* limits the number of requests in flight (sent and waiting for their
+  response),
+* limits the rate of the requests with a token bucket holding one second of
+  requests. The rate is halved each time GLPI is overloaded (down to a
+  sixteenth of the limit) and restored progressively as requests succeed,
+* retries the requests failing with a server error (5xx or 429 status) or a
+  timeout, after an exponential delay with jitter (or the delay of the
+  `Retry-After` header). As a request that is not idempotent (`POST`) may have
+  been processed, it is only retried when the connection could not be
+  established.
+"""
+
+import time
+import random
+import threading
+
+try:
+    from requests.adapters import HTTPAdapter
+    from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
+except ImportError:
+    HTTPAdapter = object
+    ConnectionError = ConnectTimeout = Timeout = Exception
+
+# HTTP statuses of the responses for which requests are retried.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Methods of the requests retried after a response or a timeout (the others are
+# only retried when the connection could not be established).
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+# Maximum delay, in seconds, before retrying a request.
+MAX_BACKOFF = 30
+
+# Ratio between the rate limit and the minimal rate when GLPI is overloaded.
+MIN_RATE_RATIO = 16
+
+
+class RequestScheduler(object):
+    """Scheduler of the requests sent to GLPI: at most ``max_in_flight``
+    requests at the same time and ``rate_limit`` requests by second (no limit
+    when 0), failed requests being retried up to ``retries`` times after
+    ``backoff`` seconds (doubled on each retry). ``timeout`` is the timeout, in
+    seconds, of the requests (none if not set). ``on_retry`` is called with the
+    request and the response (or the exception) of each retried request.
+    """
+
+    def __init__(self, max_in_flight=0, rate_limit=0, retries=3, backoff=0.5,
+                 timeout=None, on_retry=None):
+        self.in_flight = (threading.BoundedSemaphore(max_in_flight)
+                          if max_in_flight > 0
+                          else None)
+        self.rate_limit = float(rate_limit or 0)
+        self.rate = self.rate_limit
+        self.tokens = max(1.0, self.rate_limit)
+        self.updated = time.time()
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout or None
+        self.on_retry = on_retry
+        self.nb_retries = 0
+        self.lock = threading.Lock()
+
+    def adapter(self, **kwargs):
+        """Return a transport adapter sending requests through the scheduler
+        (``kwargs`` are the parameters of `requests.adapters.HTTPAdapter`)."""
+        return ScheduledAdapter(self, **kwargs)
+
+    def throttle(self):
+        """Wait for a token of the bucket when the rate is limited. Tokens are
+        reserved so waiting threads are served in order."""
+        if not self.rate_limit:
+            return
+        with self.lock:
+            now = time.time()
+            self.tokens = min(max(1.0, self.rate),
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+    def acquire(self):
+        """Wait for a slot for sending a request."""
+        if self.in_flight is not None:
+            self.in_flight.acquire()
+
+    def release(self):
+        """Release the slot of a request which received its response."""
+        if self.in_flight is not None:
+            self.in_flight.release()
+
+    def succeeded(self):
+        """Restore progressively the rate after a successful request."""
+        if self.rate_limit and self.rate < self.rate_limit:
+            with self.lock:
+                self.rate = min(self.rate_limit, self.rate + self.rate_limit / 10)
+
+    def failed(self, request, result):
+        """Halve the rate and count the retry of ``request`` which failed with
+        ``result`` (a response or an exception)."""
+        with self.lock:
+            self.nb_retries += 1
+            if self.rate_limit:
+                self.rate = max(self.rate_limit / MIN_RATE_RATIO, self.rate / 2)
+        if self.on_retry is not None:
+            self.on_retry(request, result)
+
+    def delay(self, attempt, response=None):
+        """Return the number of seconds to wait before the ``attempt`` retry
+        (starting at 0) of a request which failed with ``response`` (if any)."""
+        retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+        if retry_after.isdigit():
+            return min(MAX_BACKOFF, int(retry_after))
+        return random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+
+    def retryable(self, request, response=None, error=None):
+        """Return whether ``request``, which failed with ``response`` or
+        ``error``, can be sent again."""
+        if isinstance(error, ConnectTimeout):
+            return True
+        if request.method not in IDEMPOTENT_METHODS:
+            return False
+        if error is not None:
+            return isinstance(error, (ConnectionError, Timeout))
+        return response.status_code in RETRY_STATUSES
+
+
+class ScheduledAdapter(HTTPAdapter):
+    """Transport adapter sending the requests through ``scheduler`` (see
+    `RequestScheduler`)."""
+
+    def __init__(self, scheduler, **kwargs):
+        self.scheduler = scheduler
+        super(ScheduledAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        scheduler = self.scheduler
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = scheduler.timeout
+        attempt = 0
+        while True:
+            scheduler.throttle()
+            scheduler.acquire()
+            try:
+                response = super(ScheduledAdapter, self).send(request, **kwargs)
+                error = None
+            except (ConnectionError, Timeout) as err:
+                response, error = None, err
+            finally:
+                scheduler.release()
+
+            if (attempt >= scheduler.retries
+                    or not scheduler.retryable(request, response, error)):
+                if error is not None:
+                    raise error
+                if response.status_code < 500:
+                    scheduler.succeeded()
+                return response
+
+            scheduler.failed(request, error if response is None else response)
+            delay = scheduler.delay(attempt, response)
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+            attempt += 1
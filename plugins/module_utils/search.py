@@ -0,0 +1,48 @@
+# coding: utf-8
+
+"""Paged searches shared by the modules and plugins of the collection.
+
+GLPI returns the rows of a search by ranges (``range`` parameter), so searches
+are done page by page, the rows being yielded as each page is retrieved.
+"""
+
+import copy
+import time
+import threading
+
+# Statistics of the search in progress in the current thread, for the hooks
+# of the HTTP session counting the responses and retries (see the inventory
+# plugin).
+current_search = threading.local()
+
+
+def search_pages(glpi, page_size, stats=None, **kwargs):
+    """Search GLPI page by page (using ``range`` parameter) and yield the rows
+    of each page as it is retrieved. ``kwargs`` are the parameters of the
+    search. As the client does not expose the total count of the search, the
+    last page is the first page having less rows than ``page_size``. Requests,
+    time and rows are added to ``stats``, if set."""
+    start = 0
+    while True:
+        # Parameters are copied as GLPI client alters criteria.
+        current_search.stats = stats
+        started = time.perf_counter()
+        try:
+            page = glpi.search(
+                range='{:d}-{:d}'.format(start, start + page_size - 1),
+                **copy.deepcopy(kwargs)
+            )
+        finally:
+            current_search.stats = None
+        if stats is not None:
+            stats['requests'] += 1
+            stats['search_time'] += time.perf_counter() - started
+            stats['rows'] += len(page)
+        for row in page:
+            yield row
+        # The page is released before retrieving the next one.
+        nb_rows = len(page)
+        del page
+        if nb_rows < page_size:
+            break
+        start += page_size
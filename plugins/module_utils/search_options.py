@@ -0,0 +1,179 @@
+# coding: utf-8
+
+"""Cache of GLPI search options shared by the modules and plugins of the
+collection, for resolving symbolic fields names (fields *uid* like
+``Domain.name``) to fields ids.
+
+Search options (only the map between fields uid and fields id and, when
+needed, the fields having several values by item) are kept by item type and,
+when a cache directory is set, persisted in a file by GLPI platform (the name
+of the file being a hash of the URL) so resolving fields needs no API call
+while the cache is valid. The search options of an item
+type are retrieved again when they are older than the TTL and all the item
+types are invalidated when the version of GLPI changed.
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+
+# Default directory of the cache.
+DEFAULT_CACHE_DIR = '~/.ansible/tmp/glpi-search-options'
+
+# Join types of GLPI search options joining a table with at most one row by
+# item (other join types, like `child` or `itemtype_item`, join several rows).
+SINGLE_JOINTYPES = (None, '', 'standard', 'dropdown')
+
+
+def is_multivalued(option):
+    """Return whether the raw search ``option`` may have several values by
+    item: values are grouped (`forcegroupby`) or its table is joined (maybe
+    through other tables, see `beforejoin`) with several rows by item."""
+    if option.get('forcegroupby'):
+        return True
+
+    def joins(joinparams):
+        if not isinstance(joinparams, dict):
+            return
+        yield joinparams
+        beforejoins = joinparams.get('beforejoin') or []
+        for beforejoin in (beforejoins if isinstance(beforejoins, list) else [beforejoins]):
+            if isinstance(beforejoin, dict):
+                for join in joins(beforejoin.get('joinparams')):
+                    yield join
+    return any(join.get('jointype') not in SINGLE_JOINTYPES
+               for join in joins(option.get('joinparams')))
+
+
+class SearchOptions(object):
+    """Resolve fields of ``url`` GLPI platform. ``connect`` is a function
+    returning the GLPI client (only called when search options need to be
+    retrieved)."""
+
+    def __init__(self, connect, url, cache_dir=None, ttl=86400):
+        self.connect = connect
+        self.ttl = ttl
+        self.version_checked = False
+        self.path = (os.path.join(os.path.expanduser(cache_dir),
+                                  hashlib.sha256(url.encode('utf-8')).hexdigest() + '.json')
+                     if cache_dir
+                     else None)
+        self.data = self.load()
+
+    def load(self):
+        """Load search options from the cache file."""
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as fhandler:
+                return json.load(fhandler)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save(self):
+        """Save search options in the cache file (replaced atomically)."""
+        if self.path is None:
+            return
+        cache_dir = os.path.dirname(self.path)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir, 0o700)
+        tmp_file = '{:s}.{:d}'.format(self.path, os.getpid())
+        with open(tmp_file, 'w') as fhandler:
+            json.dump(self.data, fhandler)
+        os.rename(tmp_file, self.path)
+
+    def fields(self, itemtype):
+        """Return the map between fields uid and fields id of ``itemtype``."""
+        now = time.time()
+        cached = self.data.get('itemtypes', {}).get(itemtype)
+        if cached is not None and now - cached['time'] < self.ttl:
+            return cached['fields']
+
+        # The version of GLPI is checked once.
+        glpi = self.connect()
+        if not self.version_checked:
+            version = glpi.get_config()['cfg_glpi'].get('version')
+            if version != self.data.get('version'):
+                self.data = {'version': version, 'itemtypes': {}}
+            self.version_checked = True
+        fields = dict(
+            (re.sub(r'^{:s}\.'.format(re.escape(itemtype)), '', option['uid']), field_id)
+            for field_id, option in glpi.list_search_options(itemtype).items()
+            if isinstance(option, dict) and 'uid' in option
+        )
+        self.data['itemtypes'][itemtype] = {'time': now, 'fields': fields}
+        self.save()
+        return fields
+
+    def multivalued(self, itemtype, connect=True):
+        """Return the ids (as strings) of the fields of ``itemtype`` that may
+        have several values, ie: the fields of tables joined with several rows
+        by item (like virtual machines or operating systems of computers).
+        GLPI filters the joined rows with the criteria on theses fields, so the
+        values returned for an item depend on the criteria of the search.
+
+        They are found from the raw search options (join parameters) and kept
+        with the fields of the item type. When ``connect`` is unset, GLPI is
+        not requested: the cached fields are returned, even expired, or None
+        if they are not cached."""
+        if not connect:
+            cached = self.data.get('itemtypes', {}).get(itemtype) or {}
+            return set(cached['multivalued']) if 'multivalued' in cached else None
+        self.fields(itemtype)
+        cached = self.data['itemtypes'][itemtype]
+        if 'multivalued' not in cached:
+            cached['multivalued'] = sorted(
+                str(field_id)
+                for field_id, option in self.connect().list_search_options(
+                    itemtype, raw=True).items()
+                if isinstance(option, dict) and is_multivalued(option)
+            )
+            self.save()
+        return set(cached['multivalued'])
+
+    def field_id(self, itemtype, field):
+        """Return the id (as string) of ``field`` of ``itemtype``. ``field`` is
+        either an id or an uid (optionally prefixed by the item type). Search
+        options are only needed for uids. Raise ``ValueError`` for unknown
+        fields."""
+        if re.match(r'^\d+$', str(field)):
+            return str(field)
+        fields = self.fields(itemtype)
+        uid = re.sub(r'^{:s}\.'.format(re.escape(itemtype)), '', str(field))
+        if uid not in fields:
+            raise ValueError("unknown field '{:s}' for item type '{:s}'"
+                           .format(str(field), itemtype))
+        return str(fields[uid])
+
+    def fields_ids(self, itemtype, fields):
+        """Return ``fields`` with the ids (as integers) of fields uids (fields
+        ids are kept as is)."""
+        return [field
+                if re.match(r'^\d+$', str(field))
+                else int(self.field_id(itemtype, field))
+                for field in fields]
+
+    def criteria(self, itemtype, criteria):
+        """Return a copy of ``criteria`` (or metacriteria, using the item type of
+        each criterion if set) with the ids of fields uids (see `fields_ids`)."""
+        resolved = []
+        for criterion in criteria:
+            criterion = dict(criterion)
+            criterion_itemtype = criterion.get('itemtype', itemtype)
+            if 'criteria' in criterion:
+                criterion['criteria'] = self.criteria(criterion_itemtype,
+                                                      criterion['criteria'])
+            if 'field' in criterion:
+                criterion['field'] = self.fields_ids(criterion_itemtype,
+                                                     [criterion['field']])[0]
+            resolved.append(criterion)
+        return resolved
+
+    def template(self, itemtype, value):
+        """Return template ``value`` with fields uids between braces (like
+        ``${Domain.name}``) replaced by their ids (``${33}``)."""
+        return re.sub(r'\$\{([^}]+)\}',
+                      lambda match: '${{{:s}}}'.format(self.field_id(itemtype, match.group(1))),
+                      value)
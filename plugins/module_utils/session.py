@@ -0,0 +1,213 @@
+# coding: utf-8
+
+"""Cache of GLPI session tokens shared by the modules and plugins of the
+collection.
+
+Session tokens are stored in a directory, in a file by GLPI platform and
+credentials (the name of the file being a hash of the URL, the application
+token and the credentials), so successive modules calls and inventory parses
+reuse the same GLPI session instead of initializing (and killing) a new one.
+Accesses to a file are serialized with a lock on a companion file so
+concurrent processes don't all initialize a session at the same time.
+
+A cached token is not validated beforehand: the first request using it is
+the validation. When GLPI returns a 401 error (session expired or killed), a
+new session is initialized (or the token renewed by another process is used)
+and the request is sent again.
+
+Clients can also send their requests through a scheduler (see
+`scheduler.RequestScheduler`) limiting and retrying them.
+
+The parameters of the clients of the plugins are resolved from their
+``glpi_*`` options (or environment variables) by `connection_params`.
+"""
+
+import os
+import json
+import hashlib
+from contextlib import contextmanager
+
+from ansible_collections.unistra.glpi.plugins.module_utils.lock import file_lock
+
+try:
+    from glpi_api import GLPI
+    HAS_GLPI = True
+except ImportError:
+    GLPI = object
+    HAS_GLPI = False
+
+
+class SessionCache(object):
+    """File containing the session token for an URL and credentials."""
+
+    def __init__(self, cache_dir, url, apptoken, auth):
+        key = hashlib.sha256(
+            json.dumps([url, apptoken, auth]).encode('utf-8')
+        ).hexdigest()
+        self.path = os.path.join(os.path.expanduser(cache_dir), key)
+
+    def lock(self):
+        """Lock (exclusively) the cache file."""
+        return file_lock(self.path + '.lock')
+
+    def get(self):
+        """Return the cached token (None if there is none)."""
+        try:
+            with open(self.path) as fhandler:
+                return fhandler.read().strip() or None
+        except (IOError, OSError):
+            return None
+
+    def set(self, token):
+        """Cache ``token`` (readable only by the current user)."""
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fhandler:
+            fhandler.write(token)
+
+
+class CachedSessionGLPI(GLPI):
+    """GLPI client reusing the session token cached in ``cache_dir`` (see
+    `SessionCache`) and renewing it when GLPI rejects it. The session must not
+    be killed as other processes may use it."""
+
+    def __init__(self, url, apptoken, auth, verify_certs=True, use_headers=True,
+                 user_agent=None, cache_dir=None):
+        self._session_cache = SessionCache(cache_dir, url, apptoken, auth)
+        self._session_params = (apptoken, auth, user_agent, use_headers)
+        super(CachedSessionGLPI, self).__init__(url, apptoken, auth, verify_certs,
+                                                use_headers, user_agent)
+        self.session.hooks['response'].append(self._renew_session)
+
+    def _init_session(self, apptoken, auth, user_agent, use_headers=True):
+        """Return the cached token or initialize a new session."""
+        with self._session_cache.lock():
+            token = self._session_cache.get()
+            if token is None:
+                token = super(CachedSessionGLPI, self)._init_session(
+                    apptoken, auth, user_agent, use_headers=use_headers)
+                self._session_cache.set(token)
+        return token
+
+    def _renew_session(self, response, **kwargs):
+        """Hook of the HTTP session that, when a request is rejected with a 401
+        error, renews the session token and sends the request again (once)."""
+        request = response.request
+        expired_token = request.headers.get('Session-Token')
+        if (response.status_code != 401
+                or expired_token is None
+                or getattr(request, 'session_renewed', False)):
+            return response
+
+        with self._session_cache.lock():
+            token = self._session_cache.get()
+            if token in (None, expired_token):
+                # The expired token must not be sent when initializing the
+                # new session.
+                self.session.headers.pop('Session-Token', None)
+                apptoken, auth, user_agent, use_headers = self._session_params
+                token = super(CachedSessionGLPI, self)._init_session(
+                    apptoken, auth, user_agent, use_headers=use_headers)
+                self._session_cache.set(token)
+        self.session.headers['Session-Token'] = token
+
+        request = request.copy()
+        request.headers['Session-Token'] = token
+        request.session_renewed = True
+        return self.session.send(request, **kwargs)
+
+
+class SchedulerMixin(object):
+    """Mixin of GLPI clients sending their requests (including the
+    initialization of the session) through the ``scheduler`` keyword argument
+    (see `scheduler.RequestScheduler`)."""
+
+    def __init__(self, *args, **kwargs):
+        self._scheduler = kwargs.pop('scheduler')
+        super(SchedulerMixin, self).__init__(*args, **kwargs)
+
+    def _init_session(self, *args, **kwargs):
+        # The HTTP session is created just before initializing the GLPI session.
+        self.session.mount(self.url, self._scheduler.adapter())
+        return super(SchedulerMixin, self)._init_session(*args, **kwargs)
+
+
+class ScheduledGLPI(SchedulerMixin, GLPI):
+    """GLPI client sending its requests through a scheduler."""
+
+
+class ScheduledCachedSessionGLPI(SchedulerMixin, CachedSessionGLPI):
+    """GLPI client using the session cache and sending its requests through a
+    scheduler."""
+
+
+def glpi_client(url, apptoken, auth, verify_certs=True, use_headers=True,
+                user_agent=None, session_cache_dir=None, scheduler=None):
+    """Return a GLPI client using the session cache when ``session_cache_dir``
+    is set and sending its requests through ``scheduler`` when set."""
+    kwargs = {}
+    if scheduler is not None:
+        kwargs['scheduler'] = scheduler
+    if session_cache_dir:
+        cls = ScheduledCachedSessionGLPI if scheduler is not None else CachedSessionGLPI
+        return cls(url, apptoken, auth, verify_certs, use_headers, user_agent,
+                   cache_dir=session_cache_dir, **kwargs)
+    cls = ScheduledGLPI if scheduler is not None else GLPI
+    return cls(url, apptoken, auth, verify_certs, use_headers, user_agent, **kwargs)
+
+
+@contextmanager
+def connect(url, apptoken, auth, verify_certs=True, use_headers=True,
+            user_agent=None, session_cache_dir=None, scheduler=None):
+    """Like ``glpi_api.connect`` but, when ``session_cache_dir`` is set, the
+    session is taken from the cache and not killed when leaving."""
+    glpi = glpi_client(url, apptoken, auth, verify_certs, use_headers, user_agent,
+                       session_cache_dir, scheduler)
+    try:
+        yield glpi
+    finally:
+        if not session_cache_dir:
+            glpi.kill_session()
+
+
+def connection_params(config):
+    """Return the parameters of the GLPI client (see `glpi_client`) from the
+    ``glpi_*`` parameters of ``config`` (or environment variables). Raise
+    ``ValueError`` when the URL, the application token or the credentials are
+    missing."""
+    glpi_url = config.get('glpi_url', os.environ.get('GLPI_URL'))
+    glpi_apptoken = config.get('glpi_apptoken', os.environ.get('GLPI_APPTOKEN'))
+    glpi_usertoken = config.get('glpi_usertoken', os.environ.get('GLPI_USERTOKEN'))
+    glpi_username = config.get('glpi_username', os.environ.get('GLPI_USERNAME'))
+    glpi_password = config.get('glpi_password', os.environ.get('GLPI_PASSWORD'))
+    glpi_verify_certs = config.get(
+        'glpi_verify_certs',
+        os.environ.get('GLPI_VERIFY_CERTS', 'True').lower() not in ('false', '0')
+    )
+    glpi_use_headers = config.get(
+        'glpi_use_headers',
+        os.environ.get('GLPI_USE_HEADERS', 'True').lower() not in ('false', '0')
+    )
+
+    if glpi_url is None:
+        raise ValueError('GLPI url not provided')
+
+    if glpi_apptoken is None:
+        raise ValueError('GLPI application token not provided')
+
+    if glpi_usertoken is not None:
+        # Force str for vaulted string
+        glpi_auth = str(glpi_usertoken)
+    else:
+        if glpi_username is None or glpi_password is None:
+            raise ValueError('GLPI auth invalid: usertoken or username/password required ')
+        # Force str for vaulted strings
+        glpi_auth = (str(glpi_username), str(glpi_password))
+
+    # Force str for vaulted strings.
+    return {
+        'url': str(glpi_url),
+        'apptoken': str(glpi_apptoken),
+        'auth': glpi_auth,
+        'verify_certs': glpi_verify_certs,
+        'use_headers': glpi_use_headers
+    }
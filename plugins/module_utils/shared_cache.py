@@ -0,0 +1,65 @@
+# coding: utf-8
+
+"""Results shared through files by concurrent processes (like Ansible forks)
+of the plugins of the collection.
+
+Each result is stored in a file named from a hash of its key, written to a
+temporary file then renamed so readers never see a partial result. Processes
+sharing a key are serialized with a lock on a companion file (see
+`lock.file_lock`) so only the first one computes the result.
+"""
+
+import os
+import json
+import time
+import hashlib
+
+from ansible_collections.unistra.glpi.plugins.module_utils.lock import file_lock
+
+# Shared results older than this number of seconds (left by previous runs) are
+# removed.
+SHARED_CACHE_MAX_AGE = 86400
+
+
+def share(cache_dir, ttl, key, fetch, pack=None, max_wait=None):
+    """Return the result of ``fetch`` function for ``key`` from ``cache_dir``
+    directory and whether it was fetched by another process. Processes sharing
+    a key are serialized with a lock so only the first one fetches and saves
+    the result (packed by ``pack``, if set), the others loading it while it is
+    younger than ``ttl`` seconds. When ``max_wait`` is set, `lock.LockTimeout`
+    is raised if the lock is not acquired within ``max_wait`` seconds."""
+    cache_dir = os.path.expanduser(cache_dir)
+    path = os.path.join(cache_dir, hashlib.sha256(key.encode('utf-8')).hexdigest())
+    with file_lock(path + '.lock', timeout=max_wait):
+        try:
+            if time.time() - os.path.getmtime(path + '.json') < ttl:
+                with open(path + '.json') as fhandler:
+                    return json.load(fhandler), True
+        except (IOError, OSError, ValueError):
+            pass
+
+        result = fetch()
+        tmp_file = '{:s}.{:d}'.format(path, os.getpid())
+        fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fhandler:
+            json.dump(pack(result) if pack is not None else result, fhandler)
+        os.rename(tmp_file, path + '.json')
+
+    remove_stale(cache_dir)
+    return result, False
+
+
+def remove_stale(cache_dir):
+    """Remove the results (and temporary files) left in ``cache_dir`` by
+    previous runs. Lock files are kept: a lock only exists on its file, whose
+    modification time is not updated by locking, so a file removed while a
+    process holds its lock would let another process lock a new file."""
+    for filename in os.listdir(cache_dir):
+        if filename.endswith('.lock'):
+            continue
+        filepath = os.path.join(cache_dir, filename)
+        try:
+            if time.time() - os.path.getmtime(filepath) > SHARED_CACHE_MAX_AGE:
+                os.remove(filepath)
+        except OSError:
+            pass
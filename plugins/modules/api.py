@@ -1,9 +1,17 @@
 #!/usr/bin/python
 # coding: utf-8
 
-from ansible.module_utils.basic import AnsibleModule
+from ansible.module_utils.basic import AnsibleModule, env_fallback
 from ansible.module_utils._text import to_native
+from ansible_collections.unistra.glpi.plugins.module_utils.session import connect
+from ansible_collections.unistra.glpi.plugins.module_utils.scheduler import RequestScheduler
+from ansible_collections.unistra.glpi.plugins.module_utils.search_options import (
+    SearchOptions, DEFAULT_CACHE_DIR)
+from ansible_collections.unistra.glpi.plugins.module_utils.search import search_pages
+from ansible_collections.unistra.glpi.plugins.module_utils.items import (
+    ACTIONS, values_changes, PAGE_SIZE, search_value, changed_updates, apply_actions)
 
+import itertools
 import traceback
 try:
     import glpi_api
@@ -13,7 +21,7 @@ except ImportError:
 
 STATES = ['present', 'absent']
 
-def core(module):
+def core(module, scheduler=None):
     state = module.params.pop('state')
     url = module.params.pop('url')
     apptoken = module.params.pop('apptoken')
@@ -22,19 +30,37 @@ def core(module):
     criteria = module.params.pop('criteria')
     values = module.params.pop('values')
     ignore_actions = module.params.pop('ignore_actions')
+    items = module.params.pop('items')
+    chunk_size = module.params.pop('chunk_size')
+    session_cache_dir = module.params.pop('session_cache_dir')
+    search_options_cache_dir = (module.params.pop('search_options_cache_dir')
+                                or DEFAULT_CACHE_DIR)
+    search_options_cache_ttl = module.params.pop('search_options_cache_ttl')
+    check_mode = module.check_mode
+    diff_mode = module._diff
 
     try:
-        with glpi_api.connect(url, apptoken, auth['usertoken']) as glpi:
+        with connect(url, apptoken, auth['usertoken'],
+                     session_cache_dir=session_cache_dir, scheduler=scheduler) as glpi:
+            # Fields uids are resolved with cached search options.
+            search_options = SearchOptions(lambda: glpi, url, search_options_cache_dir,
+                                           search_options_cache_ttl)
+            if items is not None:
+                return core_items(glpi, search_options, itemtype, items, state,
+                                  values or {}, ignore_actions, chunk_size,
+                                  check_mode, diff_mode)
+
             glpi_criteria = [
                 {
                     'link': 'AND',
-                    'field': field,
+                    'field': search_options.field_id(itemtype, field),
                     'searchtype': 'contains',
                     'value': '^{:s}$'.format(value)
                 }
                 for field, value in criteria.items()
             ]
-            glpi_forcedisplay = ['id'] + list(criteria.keys())
+            glpi_forcedisplay = search_options.fields_ids(itemtype,
+                                                          ['id'] + list(criteria.keys()))
             results = glpi.search(
                 itemtype,
                 criteria=glpi_criteria,
@@ -55,35 +81,175 @@ def core(module):
                         return {'changed': False, 'action': 'added',
                                 'msg': "action ignored as specified by 'ignore_actions'"
                                        "parameter"}
-                    glpi.add(itemtype, values)
-                    return {'changed': True, 'action': 'added'}
+                    if not check_mode:
+                        glpi.add(itemtype, values)
+                    return with_diff({'changed': True, 'action': 'added'},
+                                     diff_mode, {}, values or {})
                 else:
                     # nothing
                     return {'changed': False, 'action': 'nothing'}
             else:
-                item_id = results[0][glpi.field_id(itemtype, 'id')]
+                item_id = results[0][search_options.field_id(itemtype, 'id')]
                 if state == 'present':
                     # update
                     if 'update' in ignore_actions:
                         return {'changed': False, 'action': 'updated',
                                 'msg': "action ignored as specified by 'ignore_actions'"
                                        "parameter"}
+                    # Only fields having another value are updated.
+                    current = glpi.get_item(itemtype, item_id)
+                    changes = values_changes(current, values or {})
+                    if not changes:
+                        return {'changed': False, 'action': 'nothing'}
                     doc = {'id': item_id}
-                    doc.update(values)
-                    glpi.update(itemtype, doc)
-                    return {'changed': True, 'action': 'updated'}
+                    doc.update(changes)
+                    if not check_mode:
+                        glpi.update(itemtype, doc)
+                    return with_diff({'changed': True, 'action': 'updated'}, diff_mode,
+                                     dict((field, current.get(field)) for field in changes),
+                                     changes)
                 else:
                     # delete
                     if 'delete' in ignore_actions:
                         return {'changed': False, 'action': 'updated',
                                 'msg': "action ignored as specified by 'ignore_actions'"
                                        "parameter"}
-                    glpi.delete(itemtype, {'id': item_id})
-                    return {'changed': True, 'action': 'deleted'}
+                    if not check_mode:
+                        glpi.delete(itemtype, {'id': item_id})
+                    return with_diff({'changed': True, 'action': 'deleted'},
+                                     diff_mode, {'id': item_id}, {})
 
-    except glpi_api.GLPIError as err:
+    except (glpi_api.GLPIError, ValueError) as err:
         return {'failed': True, 'msg': to_native(err)}
 
+def core_items(glpi, search_options, itemtype, items, state, values, ignore_actions,
+               chunk_size, check_mode=False, diff_mode=False):
+    """Manage multiple items in one session. Items are resolved with a minimal
+    number of searches (see `find_items`), partitioned by action and the
+    actions are sent by chunks of ``chunk_size`` items. Current values of the
+    items to update are retrieved by chunks too and items already up to date
+    are not updated. ``state`` and ``values`` are the defaults of the items."""
+    items = [
+        {
+            'criteria': dict((str(field), value)
+                             for field, value in (item.get('criteria') or {}).items()),
+            'values': dict(list(values.items()) + list((item.get('values') or {}).items())),
+            'state': item.get('state') or state
+        }
+        for item in items
+    ]
+    for item in items:
+        if not item['criteria']:
+            return {'failed': True, 'msg': 'all items must have criteria'}
+        if item['state'] not in STATES:
+            return {'failed': True,
+                    'msg': "invalid state '{:s}' for item with criteria {:s}"
+                           .format(to_native(item['state']), to_native(item['criteria']))}
+
+    # Compute the action of each item and its payload.
+    results = []
+    actions = dict((action, []) for action in ACTIONS)
+    for item, item_ids in zip(items, find_items(glpi, search_options, itemtype, items)):
+        result = {'criteria': item['criteria'], 'changed': False}
+        results.append(result)
+        if len(item_ids) > 1:
+            result.update(failed=True, action='nothing',
+                          msg='criteria must return only one result ({:d} returned)'
+                              .format(len(item_ids)))
+            continue
+
+        if not item_ids:
+            action = 'add' if item['state'] == 'present' else None
+            payload = item['values']
+        else:
+            result['id'] = item_ids[0]
+            action = 'update' if item['state'] == 'present' else 'delete'
+            payload = dict(item['values'] if action == 'update' else {}, id=item_ids[0])
+
+        if action is None:
+            result['action'] = 'nothing'
+        elif action in ignore_actions:
+            result.update(action=ACTIONS[action],
+                          msg="action ignored as specified by 'ignore_actions' parameter")
+        else:
+            actions[action].append((result, payload))
+
+    # Only keep the fields to update having another value (all fields being
+    # compared, items already up to date are not updated).
+    actions['update'] = changed_updates(glpi, itemtype, actions['update'], chunk_size,
+                                        diff_mode)
+    if diff_mode:
+        for result, payload in actions['add']:
+            result['diff'] = {'before': {}, 'after': payload}
+        for result, payload in actions['delete']:
+            result['diff'] = {'before': payload, 'after': {}}
+
+    # Send actions by chunks (GLPI returns a result for each item, in order).
+    apply_actions(glpi, itemtype, actions, chunk_size, check_mode)
+
+    module_result = {'changed': any(result['changed'] for result in results),
+                     'results': results}
+    if diff_mode:
+        module_result['diff'] = [result['diff'] for result in results if 'diff' in result]
+    failed = [result for result in results if result.get('failed')]
+    if failed:
+        module_result.update(failed=True, msg='{:d} items failed'.format(len(failed)))
+    return module_result
+
+def with_diff(result, diff_mode, before, after):
+    """Add the diff (with the ``before`` and ``after`` values) to ``result``
+    when the module is run in diff mode."""
+    if diff_mode:
+        result['diff'] = {'before': before, 'after': after}
+    return result
+
+def find_items(glpi, search_options, itemtype, items):
+    """Return, for each item of ``items``, the ids of the GLPI items matching
+    its criteria (field's values are matched like the `^value$` text search).
+
+    Items are grouped by the fields of their criteria and one search (page by
+    page) is done for each group. Fields having the same value for all the items
+    of a group are used as search criteria; others are only retrieved and
+    matched locally.
+    """
+    groups = {}
+    for idx, item in enumerate(items):
+        fields = tuple(sorted(item['criteria']))
+        groups.setdefault(fields, []).append(idx)
+
+    items_ids = [[] for _ in items]
+    for fields, indexes in groups.items():
+        keys = [tuple(search_value(items[idx]['criteria'][field]) for field in fields)
+                for idx in indexes]
+        fields_ids = [search_options.field_id(itemtype, field) for field in fields]
+        criteria = [
+            {
+                'link': 'AND',
+                'field': fields_ids[field_idx],
+                'searchtype': 'contains',
+                'value': '^{:s}$'.format(to_native(items[indexes[0]]['criteria'][field]))
+            }
+            for field_idx, field in enumerate(fields)
+            if len(set(key[field_idx] for key in keys)) == 1
+        ]
+
+        # Index rows by the values of the fields (multi-valued fields generate
+        # a key for each value).
+        id_field = search_options.field_id(itemtype, 'id')
+        rows_ids = {}
+        for row in search_pages(glpi, PAGE_SIZE, itemtype=itemtype, criteria=criteria,
+                                forcedisplay=[id_field] + fields_ids):
+            values = [row.get(field_id) if isinstance(row.get(field_id), list)
+                      else [row.get(field_id)]
+                      for field_id in fields_ids]
+            for key in itertools.product(*values):
+                rows_ids.setdefault(tuple(search_value(value) for value in key),
+                                    []).append(row[id_field])
+
+        for idx, key in zip(indexes, keys):
+            items_ids[idx] = rows_ids.get(key, [])
+    return items_ids
+
 def main():
     module = AnsibleModule(
         argument_spec = {
@@ -92,20 +258,42 @@ def main():
             'auth': dict(type='dict', required=True),
             'state': dict(type='str', choices=STATES, default='present'),
             'itemtype': dict(type='str', required=True),
-            'criteria': dict(type='dict', required=True),
+            'criteria': dict(type='dict', required=False),
             'values': dict(type='dict', required=False),
-            'ignore_actions': dict(type='list', required=False, default=[])
+            'ignore_actions': dict(type='list', required=False, default=[]),
+            'items': dict(type='list', elements='dict', required=False),
+            'chunk_size': dict(type='int', required=False, default=100),
+            'session_cache_dir': dict(type='path', required=False,
+                                      fallback=(env_fallback, ['GLPI_SESSION_CACHE_DIR'])),
+            'search_options_cache_dir': dict(
+                type='path', required=False,
+                fallback=(env_fallback, ['GLPI_SEARCH_OPTIONS_CACHE_DIR'])),
+            'search_options_cache_ttl': dict(type='int', required=False, default=86400),
+            'max_in_flight': dict(type='int', required=False, default=0),
+            'rate_limit': dict(type='float', required=False, default=0),
+            'retries': dict(type='int', required=False, default=3),
+            'retry_backoff': dict(type='float', required=False, default=0.5),
+            'request_timeout': dict(type='float', required=False, default=0)
         },
-        supports_check_mode=False
+        mutually_exclusive=[('criteria', 'items')],
+        required_one_of=[('criteria', 'items')],
+        supports_check_mode=True
     )
 
     if not HAS_GLPI:
         module.fail_json(msg="Missing required 'glpi_api' module")
 
+    # Requests failing with a server error or a timeout are retried.
+    scheduler = RequestScheduler(max_in_flight=module.params.pop('max_in_flight'),
+                                 rate_limit=module.params.pop('rate_limit'),
+                                 retries=module.params.pop('retries'),
+                                 backoff=module.params.pop('retry_backoff'),
+                                 timeout=module.params.pop('request_timeout'))
     try:
-        result = core(module)
+        result = core(module, scheduler)
     except Exception as err:
         module.fail_json(msg=to_native(err), exception=traceback.format_exc())
+    result['retries'] = scheduler.nb_retries
 
     if 'failed' in result:
         module.fail_json(**result)
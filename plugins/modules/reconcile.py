@@ -0,0 +1,234 @@
+#!/usr/bin/python
+# coding: utf-8
+
+from ansible.module_utils.basic import AnsibleModule, env_fallback
+from ansible.module_utils._text import to_native
+from ansible_collections.unistra.glpi.plugins.module_utils.session import connect
+from ansible_collections.unistra.glpi.plugins.module_utils.scheduler import RequestScheduler
+from ansible_collections.unistra.glpi.plugins.module_utils.search_options import (
+    SearchOptions, DEFAULT_CACHE_DIR)
+from ansible_collections.unistra.glpi.plugins.module_utils.search import search_pages
+from ansible_collections.unistra.glpi.plugins.module_utils.items import (
+    ACTIONS, PAGE_SIZE, search_value, changed_updates, apply_actions)
+
+import traceback
+try:
+    import glpi_api
+    HAS_GLPI = True
+except ImportError:
+    HAS_GLPI = False
+
+def core(module, scheduler=None):
+    url = module.params.pop('url')
+    apptoken = module.params.pop('apptoken')
+    auth = module.params.pop('auth')
+    itemtype = module.params.pop('itemtype')
+    key = module.params.pop('key')
+    items = module.params.pop('items')
+    values = module.params.pop('values')
+    criteria = module.params.pop('criteria')
+    ignore_actions = module.params.pop('ignore_actions')
+    purge = module.params.pop('purge')
+    chunk_size = module.params.pop('chunk_size')
+    session_cache_dir = module.params.pop('session_cache_dir')
+    search_options_cache_dir = (module.params.pop('search_options_cache_dir')
+                                or DEFAULT_CACHE_DIR)
+    search_options_cache_ttl = module.params.pop('search_options_cache_ttl')
+
+    try:
+        with connect(url, apptoken, auth['usertoken'],
+                     session_cache_dir=session_cache_dir, scheduler=scheduler) as glpi:
+            # Fields uids are resolved with cached search options.
+            search_options = SearchOptions(lambda: glpi, url, search_options_cache_dir,
+                                           search_options_cache_ttl)
+            return reconcile(glpi, search_options, itemtype, key, items, values or {},
+                             criteria, ignore_actions, purge, chunk_size,
+                             module.check_mode, module._diff)
+    except (glpi_api.GLPIError, ValueError) as err:
+        return {'failed': True, 'msg': to_native(err)}
+
+def reconcile(glpi, search_options, itemtype, key, items, values, criteria,
+              ignore_actions, purge, chunk_size, check_mode=False, diff_mode=False):
+    """Make the items of ``itemtype`` matching ``criteria`` (the population) be
+    the desired ``items``, identified by their ``key`` field. ``values`` are
+    the defaults of the items.
+
+    The current population is retrieved by one search (page by page) with the
+    id and the key of the items, and indexed by key so the desired items are
+    matched in linear time: desired items not found are added, found items are
+    updated (only when a field has another value, see `changed_updates`) and
+    the items of the population not desired are deleted. Actions are sent by
+    chunks of ``chunk_size`` items.
+
+    As the items of the population not desired are deleted, ``criteria`` must
+    not be empty (the population would be all the items of ``itemtype``) unless
+    deletions are ignored.
+    """
+    if not criteria and 'delete' not in ignore_actions:
+        return {'failed': True,
+                'msg': "'criteria' must not be empty (all the items of '{:s}' not "
+                       "desired would be deleted) unless 'delete' action is ignored"
+                       .format(itemtype)}
+
+    # Index the desired items by key (compared like GLPI text search does).
+    desired = {}
+    for desired_item in items:
+        # Items may have non-string keys (fields ids).
+        item = dict(values)
+        item.update(desired_item)
+        if item.get(key) is None:
+            return {'failed': True, 'msg': "all items must have a '{:s}' value".format(key)}
+        desired.setdefault(search_value(item[key]), []).append(item)
+    duplicates = sorted(to_native(desired_items[0][key])
+                        for desired_items in desired.values() if len(desired_items) > 1)
+    if duplicates:
+        return {'failed': True,
+                'msg': "items must have distinct '{:s}' values (duplicates: {:s})"
+                       .format(key, ', '.join(duplicates))}
+
+    # Index the current population by key (multi-valued fields generate a key
+    # for each value).
+    id_field = search_options.field_id(itemtype, 'id')
+    key_field = search_options.field_id(itemtype, key)
+    glpi_criteria = [
+        {
+            'link': 'AND',
+            'field': search_options.field_id(itemtype, field),
+            'searchtype': 'contains',
+            'value': '^{:s}$'.format(to_native(value))
+        }
+        for field, value in criteria.items()
+    ]
+    current = {}
+    for row in search_pages(glpi, PAGE_SIZE, itemtype=itemtype,
+                            criteria=glpi_criteria, forcedisplay=[id_field, key_field]):
+        row_keys = row.get(key_field)
+        for row_key in (row_keys if isinstance(row_keys, list) else [row_keys]):
+            current.setdefault(search_value(row_key), {})[row[id_field]] = row_key
+
+    # Partition the items by action.
+    results = []
+    actions = dict((action, []) for action in ACTIONS)
+    def register(action, result, payload):
+        results.append(result)
+        if action in ignore_actions:
+            result.update(action=ACTIONS[action],
+                          msg="action ignored as specified by 'ignore_actions' parameter")
+        else:
+            actions[action].append((result, payload))
+
+    matched_ids = set()
+    for item_key, (item,) in desired.items():
+        items_ids = current.get(item_key, {})
+        result = {'key': item[key], 'changed': False}
+        if len(items_ids) > 1:
+            results.append(result)
+            result.update(failed=True, action='nothing',
+                          msg="'{:s}' matches {:d} items".format(key, len(items_ids)))
+            matched_ids.update(items_ids)
+        elif not items_ids:
+            register('add', result, item)
+        else:
+            item_id = list(items_ids)[0]
+            result['id'] = item_id
+            matched_ids.add(item_id)
+            # The key is not updated as it matched (it may only differ in case).
+            payload = dict((field, value) for field, value in item.items() if field != key)
+            register('update', result, dict(payload, id=item_id))
+
+    deleted_ids = set()
+    for item_key, items_ids in current.items():
+        if item_key in desired:
+            continue
+        for item_id, row_key in items_ids.items():
+            if item_id in matched_ids or item_id in deleted_ids:
+                continue
+            deleted_ids.add(item_id)
+            register('delete', {'key': row_key, 'id': item_id, 'changed': False},
+                     {'id': item_id})
+
+    # Only keep the fields to update having another value.
+    actions['update'] = changed_updates(glpi, itemtype, actions['update'], chunk_size,
+                                        diff_mode)
+    if diff_mode:
+        for result, payload in actions['add']:
+            result['diff'] = {'before': {}, 'after': payload}
+        for result, payload in actions['delete']:
+            result['diff'] = {'before': dict(payload, **{key: result['key']}), 'after': {}}
+
+    # Send actions by chunks.
+    apply_actions(glpi, itemtype, actions, chunk_size, check_mode, purge)
+
+    # Items up to date are only counted.
+    counts = dict((action, 0)
+                  for action in list(ACTIONS.values()) + ['unchanged', 'ignored', 'failed'])
+    for result in results:
+        if result.get('failed'):
+            counts['failed'] += 1
+        elif 'msg' in result:
+            counts['ignored'] += 1
+        elif result['action'] == 'nothing':
+            counts['unchanged'] += 1
+        else:
+            counts[result['action']] += 1
+    module_result = {'changed': any(result['changed'] for result in results),
+                     'counts': counts,
+                     'results': [result for result in results
+                                 if result['action'] != 'nothing' or 'msg' in result]}
+    if diff_mode:
+        module_result['diff'] = [result['diff'] for result in results if 'diff' in result]
+    if counts['failed']:
+        module_result.update(failed=True, msg='{:d} items failed'.format(counts['failed']))
+    return module_result
+
+def main():
+    module = AnsibleModule(
+        argument_spec = {
+            'url': dict(type='str', required=True),
+            'apptoken': dict(type='str', required=True),
+            'auth': dict(type='dict', required=True),
+            'itemtype': dict(type='str', required=True),
+            'key': dict(type='str', required=True),
+            'items': dict(type='list', elements='dict', required=True),
+            'values': dict(type='dict', required=False),
+            'criteria': dict(type='dict', required=True),
+            'ignore_actions': dict(type='list', required=False, default=[]),
+            'purge': dict(type='bool', required=False, default=False),
+            'chunk_size': dict(type='int', required=False, default=100),
+            'session_cache_dir': dict(type='path', required=False,
+                                      fallback=(env_fallback, ['GLPI_SESSION_CACHE_DIR'])),
+            'search_options_cache_dir': dict(
+                type='path', required=False,
+                fallback=(env_fallback, ['GLPI_SEARCH_OPTIONS_CACHE_DIR'])),
+            'search_options_cache_ttl': dict(type='int', required=False, default=86400),
+            'max_in_flight': dict(type='int', required=False, default=0),
+            'rate_limit': dict(type='float', required=False, default=0),
+            'retries': dict(type='int', required=False, default=3),
+            'retry_backoff': dict(type='float', required=False, default=0.5),
+            'request_timeout': dict(type='float', required=False, default=0)
+        },
+        supports_check_mode=True
+    )
+
+    if not HAS_GLPI:
+        module.fail_json(msg="Missing required 'glpi_api' module")
+
+    # Requests failing with a server error or a timeout are retried.
+    scheduler = RequestScheduler(max_in_flight=module.params.pop('max_in_flight'),
+                                 rate_limit=module.params.pop('rate_limit'),
+                                 retries=module.params.pop('retries'),
+                                 backoff=module.params.pop('retry_backoff'),
+                                 timeout=module.params.pop('request_timeout'))
+    try:
+        result = core(module, scheduler)
+    except Exception as err:
+        module.fail_json(msg=to_native(err), exception=traceback.format_exc())
+    result['retries'] = scheduler.nb_retries
+
+    if 'failed' in result:
+        module.fail_json(**result)
+    else:
+        module.exit_json(**result)
+
+if __name__ == '__main__':
+    main()
@@ -7,11 +7,16 @@ import os
 import sys
 import re
 import copy
+import time
+import random
 import argparse
 import json
+import sqlite3
 import yaml
 import yamlloader
 import requests
+from requests.adapters import HTTPAdapter
+from datetime import datetime, timedelta
 from glpi_api import GLPI, GLPIError
 
 PY_VERSION = sys.version_info.major
@@ -36,12 +41,143 @@ GROUP_PARAMS = ('itemtype',         # GLPI item type
                 'vars',             # Ansible vars for the group
                 'hostvars',         # Ansible hostvars attached to group hosts
                 'children',         # Children of the group
-                'retrieve')         # Force retrieval of data
+                'retrieve',         # Force retrieval of data
+                'union',            # Hosts of any of the listed groups
+                'intersection',     # Hosts of all the listed groups
+                'difference')       # Hosts of the first listed group only
+
+# Operations of the groups generated from the hosts of other groups (see
+# `update_set_groups`) and the other parameters they accept.
+SET_OPERATIONS = ('union', 'intersection', 'difference')
+SET_GROUP_PARAMS = ('vars',)
+
+# Fields of the id and of the modification date of the items (used by
+# incremental synchronization) and format of dates returned by GLPI.
+ID_FIELD = 2
+DATE_MOD_FIELD = 19
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+# Number of seconds subtracted from the start of a synchronization for the
+# next one (see `sync_watermark`), covering the clock differences between the
+# servers of GLPI.
+SYNC_MARGIN = 60
+
+# Search types that can be evaluated locally on retrieved data (see
+# ``--host`` option).
+LOCAL_SEARCHTYPES = ('contains', 'notcontains', 'equals', 'notequals')
+
+# Maximum number of ways of generating the host from the hostname template of
+# a group before falling back to the generation of the whole inventory.
+MAX_HOST_SPLITS = 32
+
+# Schema of the inventory database (see ``--inventory-db`` option). Names of
+# tables and columns are used as primary keys or indexed.
+INVENTORY_DB_SCHEMA = '''
+    CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE host (name TEXT PRIMARY KEY, vars TEXT);
+    CREATE TABLE inventory_group (name TEXT PRIMARY KEY, data TEXT);
+    CREATE TABLE group_host (group_name TEXT, host_name TEXT);
+    CREATE INDEX group_host_group_name ON group_host (group_name);
+    CREATE INDEX group_host_host_name ON group_host (host_name);
+'''
+
+# HTTP statuses of the responses for which requests are retried, methods of the
+# requests retried after a response or a timeout (the others are only retried
+# when the connection could not be established) and maximum delay, in seconds,
+# before a retry (see ``--retries`` option).
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+MAX_BACKOFF = 30
+
+# Ratio between the rate limit and the minimal rate when GLPI is overloaded.
+MIN_RATE_RATIO = 16
 
 class GLPIInventoryError(Exception):
     """Exception for this program (catched in `main`)."""
     pass
 
+class ScheduledAdapter(HTTPAdapter):
+    """Transport adapter limiting the rate of the requests to ``rate_limit``
+    requests by second (no limit if 0) and sending again, up to ``retries``
+    times, the requests failing with a server error or a timeout (``timeout``
+    seconds) after an exponential delay with jitter starting at ``backoff``
+    seconds. Requests are sent one at a time so the rate is limited by spacing
+    them; it is halved each time GLPI is overloaded and restored progressively
+    as requests succeed."""
+
+    def __init__(self, rate_limit=0, retries=3, backoff=0.5, timeout=None, **kwargs):
+        self.rate_limit = float(rate_limit or 0)
+        self.rate = self.rate_limit
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout or None
+        self.last_request = 0
+        self.nb_retries = 0
+        super(ScheduledAdapter, self).__init__(**kwargs)
+
+    def throttle(self):
+        """Wait until the next request can be sent."""
+        if self.rate:
+            delay = self.last_request + 1 / self.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        self.last_request = time.time()
+
+    def retryable(self, request, response=None, error=None):
+        """Return whether ``request``, which failed with ``response`` or
+        ``error``, can be sent again."""
+        if isinstance(error, requests.exceptions.ConnectTimeout):
+            return True
+        if request.method not in IDEMPOTENT_METHODS:
+            return False
+        if error is not None:
+            return True
+        return response.status_code in RETRY_STATUSES
+
+    def send(self, request, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        attempt = 0
+        while True:
+            self.throttle()
+            try:
+                response = super(ScheduledAdapter, self).send(request, **kwargs)
+                error = None
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+                response, error = None, err
+
+            if attempt >= self.retries or not self.retryable(request, response, error):
+                if error is not None:
+                    raise error
+                if response.status_code < 500 and self.rate < self.rate_limit:
+                    self.rate = min(self.rate_limit, self.rate + self.rate_limit / 10)
+                return response
+
+            self.nb_retries += 1
+            if self.rate_limit:
+                self.rate = max(self.rate_limit / MIN_RATE_RATIO, self.rate / 2)
+            retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+            if retry_after.isdigit():
+                delay = min(MAX_BACKOFF, int(retry_after))
+            else:
+                delay = random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+            attempt += 1
+
+class ScheduledGLPI(GLPI):
+    """GLPI client sending its requests, including the initialization of the
+    session, through ``adapter`` (see `ScheduledAdapter`)."""
+
+    def __init__(self, adapter, *args, **kwargs):
+        self.adapter = adapter
+        super(ScheduledGLPI, self).__init__(*args, **kwargs)
+
+    def _init_session(self, *args, **kwargs):
+        self.session.mount(self.url, self.adapter)
+        return super(ScheduledGLPI, self)._init_session(*args, **kwargs)
+
 def main():
     """Main function.
 
@@ -49,26 +185,64 @@ def main():
     passing theses arguments, some variables are set globaly:
 
         * ``glpi```: object for interacting with GLPI,
-        * ``inventory```: the generated inventory
+        * ``inventory```: the generated inventory, ``all_hosts`` the hosts
+          of its groups, ``parsed_groups`` the groups of the configuration
+          and ``set_groups`` the ones computed from other groups
         * ``config``: groups configuration loaded from the configuration file
           passed as option
+        * ``args``: arguments of the command-line
+        * ``snapshots``: snapshots of the searches loaded from the snapshot
+          file and ``synced_snapshots`` the snapshots synchronized by this run
+          (when ``--snapshot-file`` option is used)
+
+    With ``--host`` option, only the rows that could generate the host are
+    searched (see `host_vars`) unless ``--inventory-db`` option is used (the
+    whole inventory is then generated for updating the database).
     """
     # args is returned as a dictionnary and contains the arguments with their
     # values. config is the configuration loaded from the configuration file
     # passed as option.
-    global config
+    global args, config
     args, config = init_cli()
+
+    # With --host option, variables of the host are returned from the
+    # inventory database if it is up to date. The source identifies the
+    # configuration from which the database was generated.
+    source = json.dumps([args['glpi_url'], config])
+    if args['host'] and args['inventory_db']:
+        hostvars = load_host_vars(args['host'], source)
+        if hostvars is not None:
+            print_json(hostvars)
+            sys.exit(0)
+
+    # Load snapshots of the searches for incremental synchronization.
+    global snapshots, synced_snapshots, watermarks
+    snapshots, synced_snapshots, watermarks = load_snapshots(), {}, {}
     try:
         # Connect to GLPI API.
         global glpi
-        glpi = GLPI(url=args['glpi_url'],
-                    apptoken=args['glpi_apptoken'],
-                    auth=args['glpi_usertoken'])
+        adapter = ScheduledAdapter(rate_limit=args['rate_limit'],
+                                   retries=args['retries'],
+                                   backoff=args['retry_backoff'],
+                                   timeout=args['request_timeout'])
+        glpi = ScheduledGLPI(adapter,
+                             url=args['glpi_url'],
+                             apptoken=args['glpi_apptoken'],
+                             auth=args['glpi_usertoken'])
+
+        # Variables of a single host are generated from its rows only, when
+        # its groups allow it.
+        if args['host'] and not args['inventory_db']:
+            hostvars = host_vars(args['host'], copy.deepcopy(config))
+            if hostvars is not None:
+                print_json(hostvars)
+                sys.exit(0)
 
         # Initialize inventory.
-        global inventory
+        global inventory, all_hosts, parsed_groups, set_groups
         inventory = {'_meta': {'hostvars': {}},
                      'all': {'hosts': [], 'children': []}}
+        all_hosts, parsed_groups, set_groups = set(), set(), {}
 
         # Recursively update inventory from configuration. Groups are popped
         # from config as they are parsed so this loop only pop root groups.
@@ -76,20 +250,31 @@ def main():
             group = list(config.keys())[0]
             group_conf = config.pop(group)
             update_inventory_from_group(group, group_conf, parents_conf={})
+        update_set_groups()
 
-        # Generate 'all' group from inventory.
+        # Generate 'all' group from inventory (hosts being added to
+        # ``all_hosts`` by the groups).
         for group in set(inventory.keys()) - set(['all', 'ungrouped', '_meta']):
             inventory['all']['children'].append(group)
-            inventory['all']['hosts'].extend(inventory[group].get('hosts', []))
-        inventory['all']['hosts'] = sorted(set(inventory['all']['hosts']))
+        inventory['all']['hosts'] = sorted(all_hosts)
+
+        # Only keep snapshots of the current searches.
+        if args['snapshot_file']:
+            save_snapshots(synced_snapshots)
+
+        # Save the inventory in the database for next --host calls.
+        if args['inventory_db']:
+            save_inventory_db(inventory, source)
 
         # If --host option is used, return variables of the host generated by
         # the inventory.
         if args['host']:
-            inventory = inventory['_meta']['hostvars'][args['host']]
-
-        # Print inventory as JSON as required.
-        print(json.dumps(inventory, indent=4))
+            print_json(inventory['_meta']['hostvars'][args['host']])
+        # Print inventory as JSON as required (streamed in compact mode).
+        elif args['compact']:
+            write_inventory(inventory, sys.stdout)
+        else:
+            print(json.dumps(inventory, indent=4))
     except GLPIError as err:
         print('unable to connect to GLPI: {:s}'.format(str(err)))
         sys.exit(1)
@@ -141,6 +326,82 @@ def init_cli():
                              'variable $ANSIBLE_GLPI_FILE or the file glpi-api.yml '
                              'beside this file)')
 
+    # Number of rows retrieved by each request.
+    parser.add_argument('--page-size', type=int,
+                        default=int(os.environ.get('ANSIBLE_GLPI_PAGE_SIZE', 1000)),
+                        help='Number of rows retrieved by each request to GLPI '
+                             '(default from environment variable '
+                             '$ANSIBLE_GLPI_PAGE_SIZE or 1000).')
+
+    # Rate limiting and retries of the requests.
+    parser.add_argument('--rate-limit', type=float,
+                        default=float(os.environ.get('ANSIBLE_GLPI_RATE_LIMIT', 0)),
+                        help='Maximum number of requests sent to GLPI by second, '
+                             'halved while GLPI is overloaded (default from '
+                             'environment variable $ANSIBLE_GLPI_RATE_LIMIT or 0, '
+                             'no limit).')
+    parser.add_argument('--retries', type=int,
+                        default=int(os.environ.get('ANSIBLE_GLPI_RETRIES', 3)),
+                        help='Number of times a request failing with a server '
+                             'error or a timeout is sent again (default from '
+                             'environment variable $ANSIBLE_GLPI_RETRIES or 3).')
+    parser.add_argument('--retry-backoff', type=float,
+                        default=float(os.environ.get('ANSIBLE_GLPI_RETRY_BACKOFF', 0.5)),
+                        help='Delay, in seconds, before the first retry of a '
+                             'request, doubled on each retry and randomized '
+                             '(default from environment variable '
+                             '$ANSIBLE_GLPI_RETRY_BACKOFF or 0.5).')
+    parser.add_argument('--request-timeout', type=float,
+                        default=float(os.environ.get('ANSIBLE_GLPI_REQUEST_TIMEOUT', 0)),
+                        help='Number of seconds to wait for GLPI to respond to a '
+                             'request (default from environment variable '
+                             '$ANSIBLE_GLPI_REQUEST_TIMEOUT or 0, no timeout).')
+
+    # Incremental synchronization options.
+    parser.add_argument('--snapshot-file',
+                        default=os.environ.get('ANSIBLE_GLPI_SNAPSHOT_FILE'),
+                        metavar='SNAPSHOT_PATH',
+                        help='Keep a snapshot of the rows of each search in this '
+                             'file and only retrieve items modified since the '
+                             'last run (default from environment variable '
+                             '$ANSIBLE_GLPI_SNAPSHOT_FILE; disabled if not set).')
+    parser.add_argument('--sweep-interval', type=int,
+                        default=int(os.environ.get('ANSIBLE_GLPI_SWEEP_INTERVAL', 3600)),
+                        help='Minimal number of seconds between two retrievals '
+                             'of the ids of the items of a search, for removing '
+                             'deleted items from the snapshot (default from '
+                             'environment variable $ANSIBLE_GLPI_SWEEP_INTERVAL '
+                             'or 3600).')
+    parser.add_argument('--full-refresh-interval', type=int,
+                        default=int(os.environ.get('ANSIBLE_GLPI_FULL_REFRESH_INTERVAL', 86400)),
+                        help='Maximal age, in seconds, of the snapshot of a '
+                             'search before all its rows are retrieved again '
+                             '(default from environment variable '
+                             '$ANSIBLE_GLPI_FULL_REFRESH_INTERVAL or 86400).')
+
+    # Inventory database options.
+    parser.add_argument('--inventory-db',
+                        default=os.environ.get('ANSIBLE_GLPI_INVENTORY_DB'),
+                        metavar='DB_PATH',
+                        help='SQLite database in which the generated inventory '
+                             'is saved and from which --host is answered while '
+                             'it is up to date (default from environment variable '
+                             '$ANSIBLE_GLPI_INVENTORY_DB; disabled if not set).')
+    parser.add_argument('--inventory-db-max-age', type=int,
+                        default=int(os.environ.get('ANSIBLE_GLPI_INVENTORY_DB_MAX_AGE', 3600)),
+                        help='Maximal age, in seconds, of the inventory database '
+                             'for answering --host (default from environment '
+                             'variable $ANSIBLE_GLPI_INVENTORY_DB_MAX_AGE or 3600).')
+
+    # Output options.
+    parser.add_argument('--compact', action='store_true',
+                        default=os.environ.get('ANSIBLE_GLPI_COMPACT', '').lower()
+                                in ('1', 'true', 'yes'),
+                        help='Output compact JSON, the inventory being written '
+                             'group by group and host by host instead of '
+                             'indented (default from environment variable '
+                             '$ANSIBLE_GLPI_COMPACT).')
+
     # Ansible inventory options.
     ansible_group = parser.add_mutually_exclusive_group(required=True)
     ansible_group.add_argument('--list', action='store_true',
@@ -197,12 +458,24 @@ def update_inventory_from_group(group, group_conf, parents_conf):
     *hostname* and *hostvars* are generated from string in which fields number,
     prefixed by a dollar, are replaced by the corresponding values from retrieve
     data.
+
+    Groups with a `union`, `intersection` or `difference` parameter are only
+    registered, their hosts being computed once all groups are generated (see
+    `update_set_groups`).
     """
     # Check input configuration.
     unknow_params = [param for param in group_conf if param not in GROUP_PARAMS]
     if unknow_params:
         raise GLPIInventoryError("group '{:s}' has invalid parameters: '{:s}'"
                                  .format(group, ', '.join(unknow_params)))
+    parsed_groups.add(group)
+
+    operation = set_operation(group, group_conf)
+    if operation is not None:
+        if group_conf.get('vars'):
+            inventory.setdefault(group, {}).update(vars=group_conf['vars'])
+        set_groups[group] = (operation, group_conf[operation])
+        return
 
     # Get children list.
     children = group_conf.pop('children', [])
@@ -226,6 +499,68 @@ def update_inventory_from_group(group, group_conf, parents_conf):
         child_conf = config.pop(child)
         update_inventory_from_group(child, child_conf, group_conf)
 
+def set_operation(group, group_conf):
+    """Return the set operation (`union`, `intersection` or `difference`) of
+    ``group`` after checking ``group_conf``, or None if it is not a set
+    group."""
+    operations = [param for param in SET_OPERATIONS if param in group_conf]
+    if not operations:
+        return None
+    if len(operations) > 1:
+        raise GLPIInventoryError("group '{:s}' has several set operations: '{:s}'"
+                                 .format(group, ', '.join(operations)))
+    operation = operations[0]
+    invalid_params = [param for param in group_conf
+                      if param != operation and param not in SET_GROUP_PARAMS]
+    if invalid_params:
+        raise GLPIInventoryError("group '{:s}' has invalid parameters for a '{:s}' "
+                                 "group: '{:s}'".format(group, operation,
+                                                        ', '.join(invalid_params)))
+    members = group_conf[operation]
+    if not isinstance(members, list) or not members:
+        raise GLPIInventoryError("group '{:s}' must have a list of groups in '{:s}'"
+                                 .format(group, operation))
+    return operation
+
+def update_set_groups():
+    """Add to the groups of ``set_groups`` the hosts computed by their set
+    operation from the hosts of their member groups (with the hosts of their
+    children), once all groups are generated. The hosts keep the variables
+    generated by their groups. Members can be other set groups, which are
+    computed first."""
+    def group_hosts(group):
+        hosts = set(inventory.get(group, {}).get('hosts', []))
+        for child in inventory.get(group, {}).get('children', []):
+            hosts.update(group_hosts(child))
+        return hosts
+
+    updated = set()
+    def update(group, dependents):
+        if group in updated:
+            return
+        if group in dependents:
+            raise GLPIInventoryError("group '{:s}' is a member of itself".format(group))
+        operation, members = set_groups[group]
+        for member in members:
+            if member in set_groups:
+                update(member, dependents + (group,))
+            elif member not in parsed_groups:
+                raise GLPIInventoryError("group '{:s}' has an unknown member group: "
+                                         "'{:s}'".format(group, member))
+        members_hosts = [group_hosts(member) for member in members]
+        if operation == 'union':
+            hosts = set().union(*members_hosts)
+        elif operation == 'intersection':
+            hosts = members_hosts[0].intersection(*members_hosts[1:])
+        else:
+            hosts = members_hosts[0].difference(*members_hosts[1:])
+        if hosts:
+            inventory.setdefault(group, {}).update(hosts=sorted(hosts))
+        updated.add(group)
+
+    for group in set_groups:
+        update(group, ())
+
 def merge_parents_conf(group_conf, parents_conf):
     """Merge in-place ``group_conf`` with ``parents_conf``."""
     # Merge itemtype and hostname (set to None if not defined).
@@ -257,24 +592,34 @@ def update_inventory(group, group_conf):
             "group '{:s}' has no itemtype defined when calling API"
             .format(group))
 
-    # Retrieve data using GLPI API.
-    data = glpi.search(itemtype=group_conf['itemtype'],
-                       forcedisplay=group_conf['forcedisplay'],
-                       criteria=group_conf['criteria'],
-                       metacriteria=group_conf['metacriteria'],
-                       range='0-9999')
+    # Retrieve data using GLPI API. Rows are retrieved page by page and hosts
+    # are added to the inventory as each page is retrieved, except in
+    # incremental mode where the snapshot of the search is synchronized.
+    search_params = {'itemtype': group_conf['itemtype'],
+                     'forcedisplay': group_conf['forcedisplay'],
+                     'criteria': group_conf['criteria'],
+                     'metacriteria': group_conf['metacriteria']}
+    if args['snapshot_file']:
+        data = sync(search_params)
+    else:
+        data = search_pages(**search_params)
+
+    # Templates of hostname and hostvars are compiled once for all entries.
+    hostname = compile_template(group_conf['hostname'])
+    hostvars = [(param, compile_template(value))
+                for param, value in group_conf['hostvars'].items()]
 
     # Retrieve group's hosts and manage hostvars.
     hosts = []
     for entry in data:
         # Generate hostvars from the current entry.
-        entry_hostvars = {param: replace_fields_values(value, entry)
-                          for param, value in group_conf['hostvars'].items()}
+        entry_hostvars = {param: render_template(template, entry)
+                          for param, template in hostvars}
 
         # Sometime returned host can be a list of host (as when retrieving
         # virtual machines). For preventing code redundancy, manage everything
-        # as list.
-        host = replace_fields_values(group_conf['hostname'], entry)
+        # as list.
+        host = render_template(hostname, entry)
         if not isinstance(host, list):
             host = [host]
         # Add host to the list of hosts for the group add update hostvars
@@ -289,27 +634,524 @@ def update_inventory(group, group_conf):
     # Add group to inventory.
     if hosts:
         inventory.setdefault(group, {}).update(hosts=sorted(hosts))
+        all_hosts.update(hosts)
 
-def replace_fields_values(value, data, default=''):
-    """Replace all occurences starting by a dollar and followed by a
-    number with the corresponding field index in the data."""
-    value = str(value)
-    for field_idx in re.findall(r'\$(\d*)', value):
+def search_pages(**kwargs):
+    """Search GLPI page by page (using ``range`` parameter and ``--page-size``
+    rows by page) and yield the rows of each page as it is retrieved. As the
+    client does not expose the total count of the search, the last page is the
+    first page having less rows than the page size."""
+    page_size = args['page_size']
+    start = 0
+    while True:
+        # Parameters are copied as GLPI client alters criteria.
+        page = glpi.search(range='{:d}-{:d}'.format(start, start + page_size - 1),
+                           **copy.deepcopy(kwargs))
+        for row in page:
+            yield row
+        if len(page) < page_size:
+            break
+        start += page_size
+
+#
+# Single host
+#
+def host_vars(host, groups_config):
+    """Return the variables of ``host`` without generating the whole inventory,
+    or None when it can't be done (the whole inventory must then be generated).
+    ``groups_config`` is consumed.
+
+    For each group, the hostname template is split back into the values of
+    its fields that could generate the host. Groups sharing an item type are
+    then searched at once, only for the rows having theses values, and their
+    criteria are evaluated locally on the returned rows. Groups whose criteria
+    can't be evaluated locally (metacriteria, search types other than
+    `contains`, `equals` and their negations, ...) are searched with their
+    own criteria. Variables are merged in the order of the groups, like when
+    generating the inventory.
+    """
+    # Searches by item type (for groups evaluated locally) or by group.
+    searches = {}
+    groups = []
+    for group, group_conf in retrieved_groups(groups_config):
+        hostname = compile_template(group_conf['hostname'])
+        candidates = split_hostname(hostname, host)
+        if candidates is None:
+            return None
+        if not candidates:
+            continue
+        criteria = host_criteria(hostname, candidates, host)
+        if criteria is None:
+            return None
+
+        fields = (group_conf['forcedisplay']
+                  + criteria_fields(group_conf['criteria'])
+                  + list(hostname[1]))
+        if not group_conf['metacriteria'] and is_local_criteria(group_conf['criteria']):
+            search_key = group_conf['itemtype']
+            match = compile_criteria(group_conf['criteria'])
+            search = searches.setdefault(search_key, {'itemtype': search_key,
+                                                      'criteria': [],
+                                                      'metacriteria': [],
+                                                      'forcedisplay': []})
+            search['criteria'].extend(criteria)
+        else:
+            search_key = group
+            match = lambda entry: True
+            search = searches[search_key] = {
+                'itemtype': group_conf['itemtype'],
+                'criteria': (([{'criteria': group_conf['criteria']}]
+                              if group_conf['criteria'] else [])
+                             + [{'link': 'AND', 'criteria': criteria}]),
+                'metacriteria': group_conf['metacriteria'],
+                'forcedisplay': []
+            }
+        for field in fields:
+            if str(field) not in [str(f) for f in search['forcedisplay']]:
+                search['forcedisplay'].append(field)
+        groups.append((search_key, match, hostname, group_conf))
+
+    rows = dict((search_key, list(search_pages(**search)))
+                for search_key, search in searches.items())
+
+    hostvars = {}
+    for search_key, match, hostname, group_conf in groups:
+        templates = [(param, compile_template(value))
+                     for param, value in group_conf['hostvars'].items()]
+        for entry in rows[search_key]:
+            if not match(entry):
+                continue
+            hosts = render_template(hostname, entry)
+            if host not in (hosts if isinstance(hosts, list) else [hosts]):
+                continue
+            (hostvars.setdefault('glpi', {})
+                .update((param, render_template(template, entry))
+                        for param, template in templates))
+    return hostvars
+
+def retrieved_groups(groups_config):
+    """Return the merged configurations of the groups of ``groups_config``
+    whose data are retrieved, in the order `update_inventory_from_group` would
+    retrieve them. ``groups_config`` is consumed."""
+    groups = []
+    def walk(group, group_conf, parents_conf):
+        unknow_params = [param for param in group_conf if param not in GROUP_PARAMS]
+        if unknow_params:
+            raise GLPIInventoryError("group '{:s}' has invalid parameters: '{:s}'"
+                                     .format(group, ', '.join(unknow_params)))
+        if set_operation(group, group_conf) is not None:
+            return
+        children = group_conf.pop('children', [])
+        merge_parents_conf(group_conf, parents_conf)
+        if not children or group_conf.get('retrieve', False):
+            if not group_conf.get('itemtype', None):
+                raise GLPIInventoryError(
+                    "group '{:s}' has no itemtype defined when calling API"
+                    .format(group))
+            groups.append((group, group_conf))
+        for child in children:
+            walk(child, groups_config.pop(child), group_conf)
+
+    while groups_config:
+        group = list(groups_config.keys())[0]
+        walk(group, groups_config.pop(group), {})
+    return groups
+
+def split_hostname(template, host):
+    """Return the possible values of the fields of the compiled hostname
+    ``template`` generating ``host`` (as dictionaries indexed by field), or
+    None if there is too many possibilities. Empty values are ignored."""
+    literals, fields = template
+    if not host.startswith(literals[0]):
+        return []
+    splits = []
+
+    def split(value, idx, values):
+        if len(splits) > MAX_HOST_SPLITS:
+            return
+        if idx == len(fields):
+            if not value:
+                splits.append(values)
+            return
+        literal = literals[idx + 1]
+        ends = ([len(value) - len(literal)]
+                if idx == len(fields) - 1
+                else [pos for pos in range(len(value) + 1)
+                      if value.startswith(literal, pos)])
+        for end in ends:
+            if end < 0 or not value.startswith(literal, end):
+                continue
+            field_value = value[:end]
+            if values.get(fields[idx], field_value) != field_value:
+                continue
+            split(value[end + len(literal):], idx + 1,
+                  dict(values, **{fields[idx]: field_value}))
+
+    split(host[len(literals[0]):], 0, {})
+    if len(splits) > MAX_HOST_SPLITS:
+        return None
+    return [dict((field, value) for field, value in values.items() if value)
+            for values in splits]
+
+def host_criteria(template, candidates, host):
+    """Return the criteria of the rows matching one of the ``candidates``
+    values of the fields of ``template`` (see `split_hostname`), or None if
+    they can't be filtered. As the hostname is the value of the first
+    multi-valued field of the template, ``host`` is also searched in each
+    field."""
+    candidates = candidates + [{field: host}
+                               for field in sorted(set(template[1]), key=int)]
+    if not template[1] or not all(candidates):
+        return None
+    criteria = []
+    for candidate in candidates:
+        criterion = {
+            'link': 'OR',
+            'criteria': [{'link': 'AND',
+                          'field': field,
+                          'searchtype': 'contains',
+                          'value': '^{:s}$'.format(value)}
+                         for field, value in sorted(candidate.items())]
+        }
+        if criterion not in criteria:
+            criteria.append(criterion)
+    return criteria
+
+def text_search_regex(value):
+    """Convert the value of a GLPI text search (`contains` search type) to a
+    compiled regular expression. Like GLPI, the search is case insensitive,
+    ``^`` and ``$`` anchor the value at the start and the end of the field,
+    ``^`` alone match non empty fields and ``NULL`` (or an empty value) match
+    empty fields."""
+    value = str(value).strip()
+    if value in ('', '^$', '$', 'NULL', 'null'):
+        return re.compile(r'^$')
+    if value == '^':
+        return re.compile(r'.')
+
+    start, end = value.startswith('^'), value.endswith('$')
+    value = value[1 if start else 0:-1 if end else None]
+    return re.compile(
+        '{:s}{:s}{:s}'.format('^' if start else '', re.escape(value), '$' if end else ''),
+        re.IGNORECASE
+    )
+
+def compile_criterion(criterion):
+    """Return a function checking whether an entry of the data returned by
+    the API match ``criterion``. Multi-valued fields match when one of their
+    values match."""
+    field = str(criterion['field'])
+    searchtype = criterion.get('searchtype', 'contains')
+    if searchtype in ('contains', 'notcontains'):
+        regex = text_search_regex(criterion['value'])
+        test = lambda value: regex.search(value) is not None
+    else:
+        expected = str(criterion['value']).lower()
+        test = lambda value: value.lower() == expected
+    negate = searchtype.startswith('not')
+
+    def match(entry):
+        values = entry.get(field)
+        if not isinstance(values, list):
+            values = [values]
+        return any(test('' if value is None else str(value))
+                   for value in values) != negate
+    return match
+
+def compile_criteria(criteria):
+    """Return a function checking whether an entry of the data returned by
+    the API match GLPI search ``criteria``. Like in the SQL request generated
+    by GLPI, `AND` links take precedence over `OR` links and the link of the
+    first criterion is ignored (except for the negation)."""
+    # Criteria are converted to a disjunction of conjunctions of matching
+    # functions (with their negation).
+    terms = []
+    for idx, criterion in enumerate(criteria):
+        link = criterion.get('link', 'AND').upper()
+        match = (compile_criteria(criterion['criteria'])
+                 if 'criteria' in criterion
+                 else compile_criterion(criterion))
+        if idx == 0 or link.startswith('OR'):
+            terms.append([])
+        terms[-1].append((match, link.endswith('NOT')))
+
+    if not terms:
+        return lambda entry: True
+    return lambda entry: any(all(match(entry) != negate for match, negate in term)
+                             for term in terms)
+
+def is_local_criteria(criteria):
+    """Check whether ``criteria`` can be evaluated locally. As `equals` search
+    type compare ids for dropdowns, numeric values are not evaluated
+    locally."""
+    for criterion in criteria:
+        if 'criteria' in criterion:
+            if not is_local_criteria(criterion['criteria']):
+                return False
+        elif (criterion.get('meta')
+                or not re.match(r'^\d+$', str(criterion.get('field')))
+                or criterion.get('searchtype', 'contains') not in LOCAL_SEARCHTYPES
+                or (criterion.get('searchtype', 'contains').endswith('equals')
+                    and re.match(r'^\d+$', str(criterion.get('value'))))):
+            return False
+    return True
+
+def criteria_fields(criteria):
+    """Return the fields used by ``criteria``."""
+    fields = []
+    for criterion in criteria:
+        fields.extend(criteria_fields(criterion['criteria'])
+                      if 'criteria' in criterion
+                      else [criterion['field']])
+    return fields
+
+#
+# Incremental synchronization
+#
+def load_snapshots():
+    """Load the snapshots from the file of ``--snapshot-file`` option. An
+    empty dictionary is returned if the option is not set or the file can't
+    be loaded (all rows are then retrieved)."""
+    if not args['snapshot_file']:
+        return {}
+    try:
+        with open(args['snapshot_file']) as fhandler:
+            return json.load(fhandler)
+    except (IOError, ValueError):
+        return {}
+
+def save_snapshots(snapshots):
+    """Save ``snapshots`` in the file of ``--snapshot-file`` option. The file
+    is replaced atomically so concurrent runs never read a partial file."""
+    tmp_file = '{:s}.{:d}'.format(args['snapshot_file'], os.getpid())
+    try:
+        with open(tmp_file, 'w') as fhandler:
+            json.dump(snapshots, fhandler)
+        os.rename(tmp_file, args['snapshot_file'])
+    except (IOError, OSError) as err:
+        raise GLPIInventoryError('unable to save snapshot file ({:s}): {:s}'
+                                 .format(args['snapshot_file'], str(err)))
+
+def sync(search_params):
+    """Synchronize the snapshot of the search ``search_params`` and return its
+    rows.
+
+    A snapshot is a dictionary containing the rows indexed by item id
+    (`rows`), the modification date from which the items are retrieved by the
+    next synchronization (`date_mod`, see `sync_watermark`) and the times of
+    the last full refresh (`refreshed`) and of the last sweep (`swept`). Only
+    the items modified since the last synchronization are retrieved and
+    merged into the snapshot. Every ``--sweep-interval`` seconds, only the ids
+    of the items of the search are retrieved for removing the others (deleted,
+    moved to the trash or no longer matching the criteria). All rows are
+    retrieved again when there is no snapshot, when it is older than
+    ``--full-refresh-interval`` seconds or when the sweep finds items missing
+    from the snapshot."""
+    search_key = json.dumps(search_params, sort_keys=True)
+    if search_key not in synced_snapshots:
+        synced_snapshots[search_key] = sync_snapshot(
+            dict(search_params, forcedisplay=sync_fields(search_params['forcedisplay'])),
+            snapshots.get(search_key))
+    return list(synced_snapshots[search_key]['rows'].values())
+
+def sync_snapshot(search_params, snapshot=None):
+    """Synchronize and return ``snapshot`` (see `sync`)."""
+    now = time.time()
+    id_field = str(ID_FIELD)
+    itemtype = search_params['itemtype']
+    if itemtype not in watermarks:
+        watermarks[itemtype] = sync_watermark(itemtype)
+    if snapshot is None or now - snapshot['refreshed'] >= args['full_refresh_interval']:
+        rows = list(search_pages(**search_params))
+        return {'rows': dict((str(row[id_field]), row) for row in rows),
+                'date_mod': watermarks[itemtype],
+                'refreshed': now,
+                'swept': now}
+
+    rows = list(search_pages(**dict(
+        search_params,
+        criteria=delta_criteria(search_params['criteria'], snapshot['date_mod']))))
+    snapshot['rows'].update((str(row[id_field]), row) for row in rows)
+    snapshot['date_mod'] = watermarks[itemtype]
+
+    if now - snapshot['swept'] >= args['sweep_interval']:
+        ids = set(str(row[id_field])
+                  for row in search_pages(**dict(search_params, forcedisplay=[ID_FIELD])))
+        if ids - set(snapshot['rows']):
+            return sync_snapshot(search_params)
+        for item_id in set(snapshot['rows']) - ids:
+            del snapshot['rows'][item_id]
+        snapshot['swept'] = now
+    return snapshot
+
+def sync_fields(forcedisplay):
+    """Return ``forcedisplay`` with the fields needed by incremental
+    synchronization (id and modification date of the items)."""
+    fields = [str(field) for field in forcedisplay]
+    return forcedisplay + [field
+                           for field in (ID_FIELD, DATE_MOD_FIELD)
+                           if str(field) not in fields]
+
+def sync_watermark(itemtype):
+    """Return the modification date from which the items of ``itemtype`` must
+    be retrieved by the next synchronization: the start of the current one on
+    the clock of GLPI (the most recent modification date of the items,
+    retrieved before the rows) minus `SYNC_MARGIN` seconds. So items modified
+    while the rows are retrieved, or whose modification date is older than
+    the one of other rows, are retrieved again the next time."""
+    rows = glpi.search(itemtype=itemtype, range='0-0', forcedisplay=[DATE_MOD_FIELD],
+                       sort=DATE_MOD_FIELD, order='DESC')
+    date_mod = rows[0].get(str(DATE_MOD_FIELD)) if rows else None
+    if not date_mod:
+        return None
+    try:
+        return (datetime.strptime(date_mod, DATE_FORMAT) - timedelta(seconds=SYNC_MARGIN)
+               ).strftime(DATE_FORMAT)
+    except ValueError:
+        return date_mod
+
+def delta_criteria(criteria, date_mod):
+    """Return the criteria for searching the items matching ``criteria`` and
+    modified since ``date_mod``. As GLPI dates have a precision of one second,
+    items modified during this second are searched again."""
+    if date_mod is None:
+        return criteria
+    try:
+        date_mod = (datetime.strptime(date_mod, DATE_FORMAT) - timedelta(seconds=1)
+                   ).strftime(DATE_FORMAT)
+    except ValueError:
+        pass
+
+    # Criteria are nested for not mixing the new criterion with their links.
+    delta = [{'link': 'AND', 'field': DATE_MOD_FIELD,
+              'searchtype': 'morethan', 'value': date_mod}]
+    return ([{'criteria': criteria}] if criteria else []) + delta
+
+#
+# Output
+#
+def print_json(data):
+    """Print ``data`` as JSON, compact with ``--compact`` option or indented."""
+    if args['compact']:
+        print(json.dumps(data, separators=(',', ':')))
+    else:
+        print(json.dumps(data, indent=4))
+
+def write_inventory(inventory, stream):
+    """Write ``inventory`` to ``stream`` as compact JSON. The document is written
+    host by host and group by group, so only the JSON of one host or group is
+    held in memory at a time (the C encoder of ``json.dump`` builds the whole
+    document before writing it)."""
+    encode = json.JSONEncoder(separators=(',', ':')).encode
+    stream.write('{"_meta":{"hostvars":{')
+    separator = ''
+    for host, hostvars in inventory['_meta']['hostvars'].items():
+        stream.write(separator + encode(host) + ':' + encode(hostvars))
+        separator = ','
+    stream.write('}}')
+    for group, group_inventory in inventory.items():
+        if group != '_meta':
+            stream.write(',' + encode(group) + ':' + encode(group_inventory))
+    stream.write('}\n')
+
+#
+# Inventory database
+#
+def save_inventory_db(inventory, source):
+    """Save ``inventory`` in the SQLite database of ``--inventory-db`` option
+    with the ``source`` of the inventory and the current time. The database is
+    generated in a temporary file which replaces the previous database."""
+    tmp_file = '{:s}.{:d}'.format(args['inventory_db'], os.getpid())
+    try:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        conn = sqlite3.connect(tmp_file)
+        try:
+            conn.executescript(INVENTORY_DB_SCHEMA)
+            conn.executemany('INSERT INTO meta VALUES (?, ?)',
+                             [('source', source), ('generated', str(time.time()))])
+            conn.executemany('INSERT INTO host VALUES (?, ?)',
+                             ((host, json.dumps(hostvars))
+                              for host, hostvars in inventory['_meta']['hostvars'].items()))
+            conn.executemany('INSERT INTO inventory_group VALUES (?, ?)',
+                             ((group, json.dumps(group_inventory))
+                              for group, group_inventory in inventory.items()
+                              if group != '_meta'))
+            conn.executemany('INSERT INTO group_host VALUES (?, ?)',
+                             ((group, host)
+                              for group, group_inventory in inventory.items()
+                              if group != '_meta'
+                              for host in group_inventory.get('hosts', [])))
+            conn.commit()
+        finally:
+            conn.close()
+        os.rename(tmp_file, args['inventory_db'])
+    except (sqlite3.Error, OSError) as err:
+        raise GLPIInventoryError('unable to save inventory database ({:s}): {:s}'
+                                 .format(args['inventory_db'], str(err)))
+
+def load_host_vars(host, source):
+    """Return the variables of ``host`` from the database of ``--inventory-db``
+    option, or None if the database does not exist, has not been generated from
+    ``source``, is older than ``--inventory-db-max-age`` seconds or does not
+    contain the host."""
+    if not os.path.exists(args['inventory_db']):
+        return None
+    try:
+        conn = sqlite3.connect(args['inventory_db'])
+        try:
+            meta = dict(conn.execute('SELECT key, value FROM meta'))
+            if (meta.get('source') != source
+                    or time.time() - float(meta.get('generated', 0)) > args['inventory_db_max_age']):
+                return None
+            row = conn.execute('SELECT vars FROM host WHERE name = ?', (host,)).fetchone()
+        finally:
+            conn.close()
+    except sqlite3.Error:
+        return None
+    return json.loads(row[0]) if row is not None else None
+
+#
+# Templates
+#
+def compile_template(value):
+    """Split a template, in which occurences starting by a dollar and followed
+    by a number are fields index, into its literal strings and its fields index.
+    The result is a tuple of two tuples, the literal strings having one more
+    element than the fields index."""
+    parts = re.split(r'\$(\d+)', str(value))
+    return tuple(parts[0::2]), tuple(parts[1::2])
+
+def render_template(template, data, default=''):
+    """Generate a value from a template compiled by ``compile_template`` by
+    replacing fields index with the corresponding values in the data."""
+    literals, fields = template
+    if not fields:
+        return literals[0]
+
+    parts = [literals[0]]
+    for field_idx, literal in zip(fields, literals[1:]):
+        field_value = data[field_idx]
         # If current field is not defined or empty, add the default value.
-        if not data[field_idx]:
-            value = re.sub(r'\${}'.format(field_idx), default, value)
+        if not field_value:
+            parts.append(default)
         # If the current field is a list, return it (all other elements
         # will be ignored).
-        elif isinstance(data[field_idx], list):
-            return data[field_idx]
-        # Replace in string with the value from data.
+        elif isinstance(field_value, list):
+            return field_value
+        # Add the value from data.
         else:
             # Ugly hack for Python 2.7 and ensuring values are str/unicode.
-            data_value = (unicode(data[field_idx])
-                          if PY_VERSION < 3
-                          else str(data[field_idx]))
-            value = re.sub(r'\${}'.format(field_idx), data_value, value)
-    return value
+            parts.append(unicode(field_value)
+                         if PY_VERSION < 3
+                         else str(field_value))
+        parts.append(literal)
+    return ''.join(parts)
+
+def replace_fields_values(value, data, default=''):
+    """Replace all occurences starting by a dollar and followed by a
+    number with the corresponding field index in the data."""
+    return render_template(compile_template(value), data, default)
 
 if __name__ == '__main__':
     main()